@@ -0,0 +1,133 @@
+# Color correction references of Multi-frame rendering: times the WebUI computation on the whole
+# composite (`processing.setup_color_correction`, a LAB conversion) against the histograms of the
+# columns that `ColumnColorStatistics` converts, on a loop of composites shaped like the ones of
+# the script. Then runs the script with color correction for every loopback source and third
+# column, and checks that the histograms of each reference match those of the full composite and
+# that the histogram matching of the WebUI gives the same image within `--tolerance` levels;
+# exits with status 1 otherwise. Needs OpenCV.
+#
+# Usage (from the repository root):
+#     python -m bench.bench_color [--frames 24] [--size 1024x768] [--tolerance 1]
+
+import argparse
+import itertools
+import os
+import tempfile
+import time
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from bench.headless import make_dataset, parse_size, run_script
+from bench.webui_stub import StubGenerator, StubProcessing, install
+from scripts.ei_composite import ColumnColorStatistics, CompositeBuilder
+
+
+def setup_color_correction(image):
+    # As in modules/processing.py of the WebUI
+    return cv2.cvtColor(np.asarray(image.copy()), cv2.COLOR_RGB2LAB)
+
+
+def match_histograms(image, reference):
+    """
+    The histogram matching of `apply_color_correction()` in the WebUI, i.e. the uint8 path of
+    `skimage.exposure.match_histograms(image, reference, channel_axis=2)`.
+    """
+
+    matched = np.empty(image.shape, dtype=np.float64)
+    for channel in range(image.shape[-1]):
+        source, template = image[..., channel], reference[..., channel]
+        source_counts = np.bincount(source.ravel(), minlength=256)
+        template_counts = np.bincount(template.ravel(), minlength=256)
+        source_values, template_values = np.nonzero(source_counts)[0], np.nonzero(template_counts)[0]
+        source_quantiles = np.cumsum(source_counts[source_values]) / source.size
+        template_quantiles = np.cumsum(template_counts[template_values]) / template.size
+        lut = np.zeros(256)
+        lut[source_values] = np.interp(source_quantiles, template_quantiles, template_values)
+        matched[..., channel] = lut[source]
+    return matched
+
+
+def histograms(lab):
+    return np.stack([np.bincount(lab[..., channel].ravel(), minlength=256) for channel in range(3)])
+
+
+class Recorder(object):
+    """
+    A generator that checks the color correction reference of every composite it is given.
+    """
+
+    def __init__(self, tolerance):
+        self.generator = StubGenerator(transform='blur')
+        self.tolerance = tolerance
+        self.checked = 0
+        self.failures = []
+
+    def __call__(self, p):
+        outputs = self.generator(p)
+        if p.color_corrections:
+            composite = p.init_images[0]
+            expected, reference = setup_color_correction(composite), p.color_corrections[0]
+            if not np.array_equal(histograms(expected), histograms(reference)):
+                self.failures.append('histograms differ')
+            else:
+                output = cv2.cvtColor(np.asarray(outputs[0].convert('RGB')), cv2.COLOR_RGB2LAB)
+                difference = np.abs(match_histograms(output, expected) - match_histograms(output, reference)).max()
+                if difference > self.tolerance:
+                    self.failures.append(f'matched images differ by {difference:.1f} levels')
+            self.checked += 1
+        return outputs
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--frames', type=int, default=24)
+    parser.add_argument('--size', type=parse_size, default=(1024, 768), help='size of a column')
+    parser.add_argument('--tolerance', type=float, default=1.0, help='in levels of the LAB channels')
+    args = parser.parse_args()
+
+    w, h = args.size
+    rng = np.random.default_rng(0)
+
+    def frame():
+        return Image.fromarray(rng.integers(0, 256, (h, w, 3), dtype=np.uint8), 'RGB')
+
+    # The previous output is new every frame, the loopback image too with the
+    # Current source, the third column stays
+    first = frame()
+    for source in ('Previous', 'Current'):
+        composite, statistics = CompositeBuilder(w, h), ColumnColorStatistics(w, h)
+        frames = [(frame(), frame()) for _ in range(args.frames)]
+        full = incremental = 0.0
+        for output, current in frames:
+            columns = [output, output if source == 'Previous' else current, first]
+            img = composite.build('init', columns)
+            start = time.perf_counter()
+            setup_color_correction(img)
+            full += time.perf_counter() - start
+            start = time.perf_counter()
+            statistics.correction(img, columns)
+            incremental += time.perf_counter() - start
+        print(f'{source:<9} {w}x{h} columns: full composite {full * 1000 / args.frames:.1f} ms/frame, '
+              f'by column {incremental * 1000 / args.frames:.1f} ms/frame, '
+              f'{statistics.misses} of {statistics.hits + statistics.misses} columns converted')
+
+    recorder = Recorder(args.tolerance)
+    install(recorder)
+    with tempfile.TemporaryDirectory() as directory:
+        dirs = make_dataset(directory, 8, (320, 240))
+        for source, third in itertools.product(('Previous', 'Current', 'First'), ('None', 'FirstGen', 'Historical')):
+            p = StubProcessing(256, 192, 'bench', 3, 1, 0.6)
+            run_script(
+                'multiframe', p, input_dir=dirs['input'], output_dir=os.path.join(directory, f'{source}-{third}'),
+                color_correction_enabled=True, loopback_source=source, third_frame_image=third, trace=False)
+
+    if recorder.failures or not recorder.checked:
+        print(f'FAIL: {len(recorder.failures)} of {recorder.checked} reference(s): {", ".join(recorder.failures[:4])}')
+        raise SystemExit(1)
+    print(f'OK: {recorder.checked} references match the full composite')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+# Benchmark of CropUtils.crop_img against the previous PIL/lambda implementation, scanning the mask
+# and with the bbox known from the mask prepass as in Enhanced img2img.
+#
+# Usage (from the repository root):
+#     python -m bench.bench_crop [--repeat N] [--coverage 0.2]
+
+import argparse
+import time
+
+import numpy as np
+from PIL import Image
+
+from scripts.crop_utils import CropUtils
+
+SIZES = {
+    '1080p': (1920, 1080),
+    '4K': (3840, 2160),
+    '8K': (7680, 4320),
+}
+
+
+def legacy_crop_img(img, mask, threshold=50):
+    mask = mask.resize(img.size) if img.size[0] != mask.size[0] else mask
+
+    bbox = mask.convert('L').point(
+        lambda x: 255 if x > threshold else 0,
+        mode='1').getbbox()
+
+    if bbox:
+        img, mask = img.crop(bbox), mask.crop(bbox)
+        size = img.size
+        if size[0] != size[1]:
+            bigside = size[0] if size[0] > size[1] else size[1]
+
+            img_np = np.zeros((bigside, bigside, 4), dtype=np.uint8)
+            mask_np = np.zeros((bigside, bigside, 4), dtype=np.uint8)
+
+            offset = (
+                round(
+                    (bigside - size[0]) / 2),
+                round(
+                    (bigside - size[1]) / 2))
+
+            img_np[offset[1]:offset[1] + size[1],
+                   offset[0]:offset[0] + size[0]] = img
+            mask_np[offset[1]:offset[1] + size[1],
+                    offset[0]:offset[0] + size[0]] = mask
+
+            img = Image.fromarray(img_np)
+            mask = Image.fromarray(mask_np)
+
+        return img, mask, bbox + size
+
+    return img, None, None
+
+
+def synthetic_frame(size, coverage, seed=0):
+    """
+    Return a random RGBA image and a binary RGBA mask whose masked rectangle covers `coverage`
+    of the frame.
+    """
+
+    rng = np.random.default_rng(seed)
+    w, h = size
+    img = Image.fromarray(rng.integers(0, 256, (h, w, 4), dtype=np.uint8), 'RGBA')
+    mw, mh = max(1, int(w * coverage ** 0.5)), max(1, int(h * coverage ** 0.5 * 0.6))
+    x0, y0 = (w - mw) // 3, (h - mh) // 2
+    a = np.zeros((h, w), dtype=np.uint8)
+    a[y0:y0 + mh, x0:x0 + mw] = 255
+    mask = Image.merge('RGBA', [Image.fromarray(a, 'L')] * 4)
+    return img, mask
+
+
+def timeit(fn, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--coverage', type=float, default=0.2)
+    args = parser.parse_args()
+
+    print(f'{"size":>6} {"legacy ms":>10} {"current ms":>10} {"speedup":>8} {"bbox ms":>8} {"speedup":>8}')
+    for name, size in SIZES.items():
+        img, mask = synthetic_frame(size, args.coverage)
+
+        old = legacy_crop_img(img, mask)
+        new = CropUtils.crop_img(img, mask)
+        assert tuple(old[2]) == tuple(new[2])
+        assert old[0].tobytes() == new[0].tobytes() and old[1].tobytes() == new[1].tobytes()
+
+        legacy = timeit(lambda: legacy_crop_img(img, mask), args.repeat)
+        current = timeit(lambda: CropUtils.crop_img(img, mask), args.repeat)
+        known = timeit(lambda: CropUtils.crop_img(img, mask, bbox=new[2].bbox), args.repeat)
+        print(f'{name:>6} {legacy * 1000:>10.1f} {current * 1000:>10.1f} {legacy / current:>7.2f}x '
+              f'{known * 1000:>8.1f} {legacy / known:>7.2f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+# Generation cache of Enhanced img2img: makes a dataset where some frames repeat the previous one
+# (input, mask and ControlNet input), renders it without the cache, with the cache, and again with
+# the cache into another folder. Checks that the cached runs write the same images and infotext,
+# that the first one only generates the distinct frames and the rerun nothing, and that the cache
+# stays under its size; exits with status 1 otherwise.
+#
+# Usage (from the repository root):
+#     python -m bench.bench_dedup [--frames 24] [--size 1024x768] [--batch-size 2] [--repeat 4]
+
+import argparse
+import os
+import shutil
+import tempfile
+
+from PIL import Image
+
+from bench.headless import Timed, make_dataset, parse_size, run_script
+from bench.webui_stub import StubGenerator, StubProcessing, install
+from scripts.ei_results import ResultCache
+
+
+def outputs(directory):
+    images = {}
+    for name in sorted(os.listdir(directory)):
+        if name.endswith('.png'):
+            with Image.open(os.path.join(directory, name)) as img:
+                images[name] = (img.tobytes(), img.info.get('parameters'), img.info.get('generated_for'))
+    return images
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--frames', type=int, default=24)
+    parser.add_argument('--size', type=parse_size, default=(1024, 768))
+    parser.add_argument('--batch-size', type=int, default=2)
+    parser.add_argument('--repeat', type=int, default=4, help='every Nth frame repeats the previous one')
+    parser.add_argument('--latency', type=float, default=0.0, help='stub latency per call in seconds')
+    args = parser.parse_args()
+
+    timed = Timed(StubGenerator(args.latency))
+    install(timed)
+    import scripts.enhanced_img2img as enhanced
+
+    with tempfile.TemporaryDirectory() as directory:
+        dirs = make_dataset(directory, args.frames, args.size, 0.3, 1)
+        # Like the duplicated frames of a telecined video
+        repeated = set(range(args.repeat - 1, args.frames, args.repeat))
+        for i in repeated:
+            for folder in [dirs['input'], dirs['mask']] + dirs['cn']:
+                shutil.copy(os.path.join(folder, f'{i:05d}.png'), os.path.join(folder, f'{i + 1:05d}.png'))
+        # Keeps the cache of the bench out of the extension folder
+        enhanced.default_cache_dir = lambda name: os.path.join(directory, 'cache', name)
+
+        def run(name, **overrides):
+            p = StubProcessing(512, 512, 'bench', 1, args.batch_size, 0.6)
+            images, seconds = timed.images, timed.seconds
+            run_script(
+                'enhanced', p, dirs['cn'], input_dir=dirs['input'], output_dir=os.path.join(directory, name),
+                mask_dir=dirs['mask'], use_img_mask=True, is_crop=True, use_cn=True, is_rerun=True,
+                trace=False, **overrides)
+            images, seconds = timed.images - images, timed.seconds - seconds
+            print(f'{name:<10} {images:>4} images generated, {seconds:.2f} s generating')
+            return images, outputs(os.path.join(directory, name))
+
+        _, expected = run('uncached')
+        first_images, first = run('cached', result_cache=True)
+        rerun_images, rerun = run('rerun', result_cache=True)
+
+        for name, images in (('cached', first), ('rerun', rerun)):
+            different = [k for k in expected if k not in images or images[k][:2] != expected[k][:2]]
+            if different:
+                print(f'FAIL: {len(different)} {name} output(s) differ in pixels or infotext: {", ".join(different[:8])}')
+                raise SystemExit(1)
+        distinct = args.frames - len(repeated)
+        # Both passes of every distinct frame
+        if first_images != 2 * distinct or rerun_images:
+            print(f'FAIL: generated {first_images} then {rerun_images} image(s), expected {2 * distinct} then 0')
+            raise SystemExit(1)
+        reused = sum(1 for _, _, source in first.values() if source is not None)
+        if reused != len(repeated) or any(source is None for _, _, source in rerun.values()):
+            print(f'FAIL: {reused} output(s) of the first run and not every rerun output name their source')
+            raise SystemExit(1)
+
+        with ResultCache(os.path.join(directory, 'cache', 'results')) as cache:
+            nbytes = cache.nbytes
+        run('capped', result_cache=True, result_cache_size=max(1, nbytes // 3 // 1024 // 1024))
+        with ResultCache(os.path.join(directory, 'cache', 'results')) as cache:
+            if cache.nbytes > max(1, nbytes // 3 // 1024 // 1024) * 1024 * 1024:
+                print(f'FAIL: the cache holds {cache.nbytes} bytes over its size')
+                raise SystemExit(1)
+
+    print(f'OK: {len(expected)} outputs match, {len(repeated)} repeated frame(s) rendered once, the rerun generated nothing')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+# Output encoders: saves synthetic RGB and RGBA frames with every encoder of the output encoder
+# option and reports the encoding throughput (MB of pixels per second), the file size and the
+# ratio to the pixel data, then the throughput of `ImageWriter` with several encoding threads.
+# Checks that every encoder is lossless and keeps the infotext; exits with status 1 otherwise.
+#
+# Usage (from the repository root):
+#     python -m bench.bench_encoders [--frames 4] [--size 3840x2160] [--threads 1,2,4]
+
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+from PIL import Image
+
+from bench.headless import parse_size
+from scripts.ei_writer import ENCODERS, ImageWriter, output_filename, read_pnginfo, save_image
+
+INFOTEXT = 'bench\nSteps: 20, Sampler: Euler a, CFG scale: 7, Seed: 1, Size: 512x512'
+
+
+def make_frames(count, size, mode, seed=0):
+    """
+    Return `count` frames of `size` in `mode`: smooth gradients with some noise, like rendered
+    frames, and a soft alpha channel for RGBA.
+    """
+
+    rng = np.random.default_rng(seed)
+    w, h = size
+    y = np.arange(h, dtype=np.int32)[:, None]
+    x = np.arange(w, dtype=np.int32)[None, :]
+    frames = []
+    for i in range(count):
+        pixels = np.empty((h, w, len(mode)), dtype=np.int16)
+        pixels[..., 0] = (x + i * 8) * 255 // w
+        pixels[..., 1] = y * 255 // h
+        pixels[..., 2] = (x + y + i * 8) * 255 // (w + h)
+        pixels[..., :3] += rng.integers(-6, 7, (h, w, 3), dtype=np.int16)
+        if mode == 'RGBA':
+            pixels[..., 3] = np.clip((x - w // 4) * 255 // max(1, w // 8), 0, 255)
+        frames.append(Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8), mode))
+    return frames
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--frames', type=int, default=4)
+    parser.add_argument('--size', type=parse_size, default=(3840, 2160))
+    parser.add_argument('--threads', default='1,2,4', help='encoding threads of the writer')
+    parser.add_argument('--writer-encoder', default='PNG, fast (level 1, RLE)', choices=list(ENCODERS)[1:])
+    args = parser.parse_args()
+
+    w, h = args.size
+    failures = []
+    with tempfile.TemporaryDirectory() as directory:
+        for mode in ('RGB', 'RGBA'):
+            frames = make_frames(args.frames, args.size, mode)
+            nbytes = w * h * len(mode)
+            print(f'{args.frames} {mode} frame(s) of {w}x{h}, {nbytes / 1e6:.1f} MB each:')
+            for encoder in list(ENCODERS)[1:]:
+                path = os.path.join(directory, output_filename(f'{mode}.png', encoder))
+                seconds, size = 0.0, 0
+                for img in frames:
+                    start = time.perf_counter()
+                    save_image(img, path, {'parameters': INFOTEXT}, encoder)
+                    seconds += time.perf_counter() - start
+                    size += os.path.getsize(path)
+                with Image.open(path) as saved:
+                    if saved.mode != mode or saved.tobytes() != frames[-1].tobytes():
+                        failures.append(f'{encoder} is not lossless in {mode}')
+                if read_pnginfo(path).get('parameters') != INFOTEXT:
+                    failures.append(f'{encoder} lost the infotext')
+                print(f'  {encoder:<26} {nbytes * len(frames) / seconds / 1e6:>8.1f} MB/s '
+                      f'{seconds * 1000 / len(frames):>8.1f} ms/frame {size / len(frames) / 1e6:>7.1f} MB/frame '
+                      f'({size / (nbytes * len(frames)):.0%})')
+
+        frames = make_frames(max(args.frames, 8), args.size, 'RGB')
+        print(f'ImageWriter with {args.writer_encoder}, {len(frames)} RGB frame(s):')
+        for threads in (int(n) for n in args.threads.split(',')):
+            start = time.perf_counter()
+            with ImageWriter(threads, encoder=args.writer_encoder) as writer:
+                for i, img in enumerate(frames):
+                    writer.save(img, os.path.join(directory, output_filename(f'{i:05d}.png', args.writer_encoder)),
+                                {'parameters': INFOTEXT})
+            seconds = time.perf_counter() - start
+            print(f'  {threads:>2} thread(s) {w * h * 3 * len(frames) / seconds / 1e6:>8.1f} MB/s '
+                  f'{len(frames) / seconds:>6.2f} frames/s')
+
+    if failures:
+        print('FAIL: ' + ', '.join(failures))
+        raise SystemExit(1)
+    print(f'OK: {len(ENCODERS) - 1} encoders are lossless and keep the infotext')
+
+
+if __name__ == '__main__':
+    main()
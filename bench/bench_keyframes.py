@@ -0,0 +1,99 @@
+# Keyframe-sparse Multi-frame rendering: renders a clip of scrolling scenes every frame, every
+# Nth frame and with adaptive keyframes, the frames in between synthesized by warping the
+# keyframes along the optical flow. Reports the generator calls, the time and how far the
+# synthesized frames are from the ones rendered every frame. Checks that every frame is written,
+# that the frames around a scene cut are diffused, and that the synthesized frames stay within
+# `--tolerance` of the rendered ones; exits with status 1 otherwise. Needs OpenCV.
+#
+# Usage (from the repository root):
+#     python -m bench.bench_keyframes [--scenes 2] [--length 24] [--size 320x240] [--interval 6]
+
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+from PIL import Image
+
+from bench.bench_scenes import make_clip
+from bench.headless import Timed, parse_size, run_script
+from bench.webui_stub import StubGenerator, StubProcessing, install
+from scripts.ei_flow import FlowWarper, plan_keyframes
+
+
+def outputs(directory):
+    images = {}
+    for name in sorted(os.listdir(directory)):
+        if name.endswith('.png'):
+            with Image.open(os.path.join(directory, name)) as img:
+                images[name] = (np.asarray(img.convert('RGB'), dtype=np.float32), img.info.get('inbetween'))
+    return images
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--scenes', type=int, default=2)
+    parser.add_argument('--length', type=int, default=24, help='frames per scene')
+    parser.add_argument('--size', type=parse_size, default=(320, 240))
+    parser.add_argument('--interval', type=int, default=6, help='keyframe interval')
+    parser.add_argument('--threshold', type=float, default=3.0, help='warp error threshold in percent')
+    parser.add_argument('--tolerance', type=float, default=4.0,
+                        help='largest mean difference of a synthesized frame in percent')
+    args = parser.parse_args()
+
+    # Inverting would flip every other output of a chain of frames
+    timed = Timed(StubGenerator(transform='blur'))
+    install(timed)
+
+    with tempfile.TemporaryDirectory() as directory:
+        clip = os.path.join(directory, 'clip')
+        cuts = make_clip(clip, [args.length] * args.scenes, args.size)
+        paths = [os.path.join(clip, name) for name in sorted(os.listdir(clip))]
+
+        def reference(j):
+            with Image.open(paths[j]) as img:
+                return img.convert('RGB')
+
+        start = time.perf_counter()
+        keys, fallbacks = plan_keyframes(
+            FlowWarper(), reference, 0, len(paths), args.interval, args.threshold / 100)
+        elapsed = time.perf_counter() - start
+        print(f'planning: {len(keys)} keyframe(s) of {len(paths)} frames, {fallbacks} fallback(s), '
+              f'{elapsed * 1000 / len(paths):.1f} ms/frame')
+        missed = [cut for cut in cuts if cut - 1 not in keys or cut not in keys]
+        if missed:
+            print(f'FAIL: the frames around the cut(s) at {missed} are synthesized')
+            raise SystemExit(1)
+
+        def render(name, **overrides):
+            p = StubProcessing(256, 192, 'bench', 3, 1, 0.6)
+            calls = timed.generator.calls
+            start = time.perf_counter()
+            run_script(
+                'multiframe', p, input_dir=clip, output_dir=os.path.join(directory, name),
+                keyframe_interval=args.interval, warp_threshold=args.threshold, trace=False, **overrides)
+            elapsed = time.perf_counter() - start
+            return timed.generator.calls - calls, elapsed, outputs(os.path.join(directory, name))
+
+        calls, elapsed, expected = render('every', keyframes='Every frame')
+        print(f'{"Every frame":<16} {calls:>4} generator calls, {elapsed:.2f} s')
+        for mode in ('Every Nth frame', 'Adaptive'):
+            calls, elapsed, images = render(mode.split()[0].lower(), keyframes=mode)
+            if images.keys() != expected.keys():
+                print(f'FAIL: {mode} wrote {len(images)} frame(s) instead of {len(expected)}')
+                raise SystemExit(1)
+            errors = [
+                np.abs(img - expected[name][0]).mean() / 255
+                for name, (img, inbetween) in images.items() if inbetween is not None]
+            print(f'{mode:<16} {calls:>4} generator calls, {elapsed:.2f} s, {len(errors)} synthesized frame(s) '
+                  f'{np.mean(errors):.2%} from the rendered ones on average, {max(errors):.2%} at most')
+            if not errors or max(errors) > args.tolerance / 100:
+                print(f'FAIL: {mode} synthesized frames are further than {args.tolerance}% from the rendered ones')
+                raise SystemExit(1)
+
+    print('OK: every frame written, cuts diffused, synthesized frames within the tolerance')
+
+
+if __name__ == '__main__':
+    main()
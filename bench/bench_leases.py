@@ -0,0 +1,75 @@
+# Simulation of the distributed mode of Enhanced img2img: several processes on this machine
+# claim chunks of a job through `LeaseManager`, with uneven per-frame times, and one of them
+# dies while holding a chunk. Checks that every chunk is finished and reports how the work was
+# shared.
+#
+# Usage (from the repository root):
+#     python -m bench.bench_leases [--workers 6] [--chunks 60] [--kill 1]
+
+import argparse
+import collections
+import json
+import multiprocessing
+import os
+import random
+import tempfile
+import time
+
+from scripts.ei_leases import LeaseManager
+
+
+def worker(directory, chunks, frame_time, ttl, die_after, seed):
+    rng = random.Random(seed)
+    leases = LeaseManager(directory, ttl=ttl)
+    done = 0
+    for chunk in leases.claims(range(chunks), poll=ttl / 4):
+        if die_after is not None and done == die_after:
+            # Dies holding the chunk, without releasing it
+            os._exit(1)
+        time.sleep(frame_time * rng.uniform(0.5, 2.0))
+        leases.mark_done(chunk)
+        done += 1
+    leases.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--workers', type=int, default=6)
+    parser.add_argument('--chunks', type=int, default=60)
+    parser.add_argument('--frame-time', type=float, default=0.05)
+    parser.add_argument('--ttl', type=float, default=1.0)
+    parser.add_argument('--kill', type=int, default=1, help='number of workers that die')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        start = time.perf_counter()
+        processes = [
+            multiprocessing.Process(
+                target=worker,
+                args=(directory, args.chunks, args.frame_time, args.ttl, 2 if i < args.kill else None, i))
+            for i in range(args.workers)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        elapsed = time.perf_counter() - start
+
+        by_worker = collections.Counter()
+        reclaimed = 0
+        for chunk in range(args.chunks):
+            path = os.path.join(directory, f'{chunk:06d}.done')
+            assert os.path.exists(path), f'chunk {chunk} was not finished'
+            with open(path, encoding='utf-8') as f:
+                entry = json.load(f)
+            by_worker[entry['worker']] += 1
+            reclaimed += entry['generation'] > 0
+
+    ideal = args.chunks * args.frame_time * 1.25 / (args.workers - args.kill)
+    print(f'{args.chunks} chunks finished by {len(by_worker)} worker(s) in {elapsed:.2f} s '
+          f'(ideal {ideal:.2f} s + ttl {args.ttl:.2f} s), {reclaimed} lease(s) reclaimed')
+    for name, count in sorted(by_worker.items()):
+        print(f'  {name}: {count}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+# Benchmark of the mask preparation of Enhanced img2img: thresholding a mask file with
+# `point()` and `Image.merge`, then scanning it again in `crop_img`, against `binary_mask` and
+# a `crop_img` that reads its bounding box from a `MaskTable`.
+#
+# Usage (from the repository root):
+#     python -m bench.bench_masks [--repeat N] [--coverage 0.2]
+
+import argparse
+import os
+import tempfile
+
+import numpy as np
+from PIL import Image
+
+from bench.bench_crop import SIZES, synthetic_frame, timeit
+from scripts.crop_utils import CropUtils
+from scripts.ei_masks import MaskTable, binary_mask
+
+
+def legacy_prepare(img, path, threshold=50):
+    mask = Image.open(path)
+    a = mask.split()[-1].convert('L').point(
+        lambda x: 255 if x > threshold else 0)
+    mask = Image.merge('RGBA', (a, a, a, a.convert('L')))
+    return CropUtils.crop_img(img.copy(), mask, threshold)
+
+
+def current_prepare(img, path, table, threshold=50):
+    with Image.open(path) as mask_file:
+        mask = binary_mask(mask_file, threshold)
+    return CropUtils.crop_img(img.copy(), mask, threshold, table.bbox(0))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--coverage', type=float, default=0.2)
+    args = parser.parse_args()
+
+    print(f'{"size":>6} {"legacy ms":>10} {"current ms":>10} {"speedup":>8} {"prepass ms":>11}')
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, size in SIZES.items():
+            img, mask = synthetic_frame(size, args.coverage)
+            # Soft edges so the threshold matters
+            mask = Image.fromarray(np.asarray(mask) // 2 + 20)
+            path = os.path.join(tmp, f'{name}.png')
+            mask.save(path)
+
+            table = MaskTable.build([0], [path], 50)
+            old = legacy_prepare(img, path)
+            new = current_prepare(img, path, table)
+            assert tuple(old[2]) == tuple(new[2])
+            assert old[0].tobytes() == new[0].tobytes() and old[1].tobytes() == new[1].tobytes()
+
+            prepass = timeit(lambda: MaskTable.build([0], [path], 50), args.repeat)
+            legacy = timeit(lambda: legacy_prepare(img, path), args.repeat)
+            current = timeit(lambda: current_prepare(img, path, table), args.repeat)
+            print(f'{name:>6} {legacy * 1000:>10.1f} {current * 1000:>10.1f} {legacy / current:>7.2f}x '
+                  f'{prepass * 1000:>11.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+# Peak memory of Enhanced img2img on synthetic 8K frames: runs the zoom-in (crop) path headless
+# with the CPU stub generator under a memory budget, samples the RSS while it runs, and exits
+# with status 1 if the peak grows more than the budget plus `--allowance` frames above the RSS
+# before the run. The frames being generated, restored and encoded are the allowance.
+#
+# Usage (from the repository root):
+#     python -m bench.bench_memory [--frames 4] [--size 7680x4320] [--budget 512] [--allowance 2] [--quick]
+#
+# The 8K run takes about 40 s; `--quick` checks the bound on 4K frames under a smaller budget
+# in about 15 s, without the unbudgeted run.
+
+import argparse
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+
+from bench.headless import make_dataset, parse_size, run_script
+from bench.webui_stub import StubGenerator, StubProcessing, install
+from scripts.ei_trace import current_rss
+
+
+class PeakRSS(object):
+    """
+    Samples the RSS of this process on a background thread and keeps the largest value.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.peak = current_rss() or 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self._stop.set()
+        self._thread.join()
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, current_rss() or 0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--frames', type=int, default=4)
+    parser.add_argument('--size', type=parse_size, default=(7680, 4320))
+    parser.add_argument('--coverage', type=float, default=0.05)
+    parser.add_argument('--batch-size', type=int, default=2)
+    parser.add_argument('--prefetch', type=int, default=2)
+    parser.add_argument('--budget', type=int, default=512, help='memory budget in MB')
+    parser.add_argument('--allowance', type=float, default=2.0,
+                        help='frames allowed above the budget for generation, restore and encoding')
+    parser.add_argument('--quick', action='store_true', help='4K frames, a 128 MB budget and no unbudgeted run')
+    args = parser.parse_args()
+    if args.quick:
+        args.size, args.budget = (3840, 2160), 128
+
+    if current_rss() is None:
+        print('Cannot read the RSS of this process (install psutil)')
+        return
+
+    install(StubGenerator(transform='identity'))
+    # Imported before the baseline is taken
+    import scripts.enhanced_img2img  # noqa: F401
+
+    w, h = args.size
+    frame = w * h * 4  # RGB frame and L mask
+    with tempfile.TemporaryDirectory() as directory:
+        # Made in another process, so that its memory is not counted
+        maker = multiprocessing.Process(
+            target=make_dataset, args=(directory, args.frames, args.size, args.coverage, 0))
+        start = time.perf_counter()
+        maker.start()
+        maker.join()
+        print(f'{args.frames} frames of {w}x{h} made in {time.perf_counter() - start:.1f} s')
+
+        peaks = {}
+        # The budgeted run goes first, memory freed by a run is not always returned to the system
+        for budget in (args.budget,) if args.quick else (args.budget, 0):
+            p = StubProcessing(512, 512, 'bench', 1, args.batch_size)
+            baseline = current_rss()
+            with PeakRSS() as sampler:
+                seconds, _, _ = run_script(
+                    'enhanced', p, input_dir=os.path.join(directory, 'input'),
+                    output_dir=os.path.join(directory, f'out_{budget}'), mask_dir=os.path.join(directory, 'mask'),
+                    use_img_mask=True, is_crop=True, prefetch_depth=args.prefetch, memory_budget=budget,
+                    trace=False)
+            peaks[budget] = (sampler.peak - baseline) / 1024 / 1024
+            print(f'budget {budget or "none":>5} MB: {seconds:.1f} s, peak RSS {peaks[budget]:.0f} MB above '
+                  f'{baseline / 1024 / 1024:.0f} MB')
+
+    bound = args.budget + args.allowance * frame / 1024 / 1024
+    if peaks[args.budget] > bound:
+        print(f'FAIL: peak {peaks[args.budget]:.0f} MB > {bound:.0f} MB')
+        raise SystemExit(1)
+    print(f'OK: peak {peaks[args.budget]:.0f} MB <= {bound:.0f} MB (budget + {args.allowance:g} frames)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+# Pass-major Loopback in Enhanced img2img: runs the two passes of every frame back to back, then
+# the first passes of every chunk before their second passes, and a rerun that only changes the
+# second-pass denoising strength. Checks that both schedules write the same outputs and that the
+# rerun generates no first pass, and that the first pass cache evicts down to its size; exits
+# with status 1 otherwise. Run with a `--latency` to see the generation time the rerun saves.
+#
+# Usage (from the repository root):
+#     python -m bench.bench_passes [--frames 24] [--size 1024x768] [--batch-size 2] [--latency 0.05]
+
+import argparse
+import os
+import tempfile
+
+from PIL import Image
+
+from bench.headless import Timed, make_dataset, parse_size, run_script
+from bench.webui_stub import StubGenerator, StubProcessing, install
+from scripts.ei_results import ResultCache
+
+
+def outputs(directory):
+    images = {}
+    for name in sorted(os.listdir(directory)):
+        if name.endswith('.png'):
+            with Image.open(os.path.join(directory, name)) as img:
+                images[name] = (img.tobytes(), img.info.get('parameters'))
+    return images
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--frames', type=int, default=24)
+    parser.add_argument('--size', type=parse_size, default=(1024, 768))
+    parser.add_argument('--batch-size', type=int, default=2)
+    parser.add_argument('--chunk', type=int, default=8, help='images per first-pass chunk')
+    parser.add_argument('--latency', type=float, default=0.0, help='stub latency per call in seconds')
+    args = parser.parse_args()
+
+    timed = Timed(StubGenerator(args.latency))
+    install(timed)
+    import scripts.enhanced_img2img as enhanced
+
+    with tempfile.TemporaryDirectory() as directory:
+        dirs = make_dataset(directory, args.frames, args.size, 0.3, 1)
+        # Keeps the cache of the bench out of the extension folder
+        enhanced.default_cache_dir = lambda name: os.path.join(directory, 'cache', name)
+
+        def run(name, strength=0.75, **overrides):
+            p = StubProcessing(512, 512, 'bench', 1, args.batch_size, strength)
+            calls, seconds = timed.generator.calls, timed.seconds
+            run_script(
+                'enhanced', p, dirs['cn'], input_dir=dirs['input'], output_dir=os.path.join(directory, name),
+                mask_dir=dirs['mask'], use_img_mask=True, is_crop=True, use_cn=True, is_rerun=True,
+                pass_chunk=args.chunk, trace=False, **overrides)
+            calls, seconds = timed.generator.calls - calls, timed.seconds - seconds
+            print(f'{name:<14} {calls:>4} generator calls, {seconds:.2f} s generating')
+            return calls, outputs(os.path.join(directory, name))
+
+        frame_calls, frame_major = run('frame-major')
+        pass_calls, pass_major = run('pass-major', pass_major=True)
+        rerun_calls, rerun = run('rerun', 0.5, pass_major=True)
+
+        if frame_major != pass_major:
+            print('FAIL: pass-major outputs differ from frame-major ones')
+            raise SystemExit(1)
+        if pass_calls != frame_calls or rerun_calls * 2 != pass_calls:
+            print(f'FAIL: the rerun made {rerun_calls} generator calls, expected {pass_calls // 2}')
+            raise SystemExit(1)
+        if rerun == pass_major:
+            print('FAIL: the second-pass strength of the rerun was not used')
+            raise SystemExit(1)
+
+        # A cache of two and a half entries keeps the two most recently used
+        with ResultCache(os.path.join(directory, 'cache', 'evict')) as cache:
+            img = Image.effect_noise((256, 256), 64).convert('RGB')
+            cache.put('a', img)
+            cache.max_bytes = cache.nbytes * 5 // 2
+            cache.put('b', img)
+            cache.get('a')
+            cache.put('c', img)
+            if 'b' in cache or 'a' not in cache or 'c' not in cache or cache.nbytes > cache.max_bytes:
+                print(f'FAIL: eviction kept the wrong entries: {cache.summary()}')
+                raise SystemExit(1)
+
+    print(f'OK: {len(pass_major)} outputs match, the rerun skipped every first pass')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+# Benchmark of CropUtils.restore_by_file against the previous full-frame implementation.
+#
+# Usage (from the repository root):
+#     python -m bench.bench_restore [--repeat N] [--coverage 0.05]
+
+import argparse
+
+import numpy as np
+from PIL import Image, ImageFilter
+
+from bench.bench_crop import SIZES, timeit
+from scripts.crop_utils import CropUtils
+
+
+def legacy_restore_by_file(
+        raw,
+        img,
+        ref_img,
+        blur_mask,
+        info,
+        mask_blur=0.5):
+    raw_size = raw.size
+    ref_size = ref_img.size
+
+    upper_left_x = info[0]
+    upper_left_y = info[1]
+
+    img = img.resize(ref_size).convert('RGBA')
+    blur_mask = blur_mask.resize(ref_size).convert('RGBA')
+    raw = raw.convert('RGBA')
+
+    bbox = ref_img.split(
+    )[-1].convert('L').point(lambda x: 255 if x > 0 else 0, mode='1').getbbox()
+    bbox = list(bbox)
+    w, h = bbox[2] - bbox[0], bbox[3] - bbox[1]
+
+    img = img.crop(bbox)
+    blur_mask = blur_mask.crop(bbox)
+
+    blur_img = np.zeros((raw_size[1], raw_size[0], 4), dtype=np.uint8)
+    blur_img[upper_left_y:upper_left_y +
+             h, upper_left_x:upper_left_x +
+             w, :] = np.array(blur_mask)
+    blur_img = Image.fromarray(blur_img, 'RGBA')
+    blur_img = blur_img.filter(ImageFilter.GaussianBlur(mask_blur))
+
+    new_img = np.zeros((raw_size[1], raw_size[0], 4), dtype=np.uint8)
+    new_img[upper_left_y:upper_left_y +
+            h, upper_left_x:upper_left_x +
+            w, :] = np.array(img)
+    new_img = Image.fromarray(new_img, 'RGBA')
+
+    new_img = Image.alpha_composite(raw, new_img)
+    new_img.putalpha(blur_img.split()[-1].convert('L'))
+    new_img = Image.alpha_composite(raw, new_img)
+
+    return new_img
+
+
+def synthetic_crop(size, coverage, output_size=512, seed=0):
+    """
+    Return an opaque RGBA frame, the result of `CropUtils.crop_img` on a rectangular mask covering
+    `coverage` of it, and a fake RGB generation of `output_size` x `output_size`.
+    """
+
+    rng = np.random.default_rng(seed)
+    w, h = size
+    pixels = rng.integers(0, 256, (h, w, 4), dtype=np.uint8)
+    pixels[..., 3] = 255
+    raw = Image.fromarray(pixels, 'RGBA')
+    mw, mh = max(1, int(w * coverage ** 0.5)), max(1, int(h * coverage ** 0.5))
+    x0, y0 = (w - mw) // 3, (h - mh) // 2
+    a = np.zeros((h, w), dtype=np.uint8)
+    a[y0:y0 + mh, x0:x0 + mw] = 255
+    mask = Image.merge('RGBA', [Image.fromarray(a, 'L')] * 4)
+    cropped, cropped_mask, geometry = CropUtils.crop_img(raw, mask)
+    output = cropped.convert('RGB').resize((output_size, output_size)).transpose(Image.Transpose.FLIP_LEFT_RIGHT)
+    return raw, output, cropped, cropped_mask, geometry
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--coverage', type=float, default=0.05)
+    parser.add_argument('--mask-blur', type=float, default=5)
+    args = parser.parse_args()
+
+    print(f'{"size":>6} {"legacy ms":>10} {"current ms":>10} {"speedup":>8}')
+    for name, size in SIZES.items():
+        raw, output, cropped, cropped_mask, geometry = synthetic_crop(size, args.coverage)
+
+        old = legacy_restore_by_file(raw, output, cropped, cropped_mask, tuple(geometry), args.mask_blur)
+        new = CropUtils.restore_by_file(raw.copy(), output, cropped, cropped_mask, geometry, args.mask_blur)
+        assert old.tobytes() == new.tobytes()
+
+        legacy = timeit(lambda: legacy_restore_by_file(
+            raw, output, cropped, cropped_mask, tuple(geometry), args.mask_blur), args.repeat)
+        # restore_by_file updates an RGBA frame in place, so every run gets the same frame back
+        current = timeit(lambda: CropUtils.restore_by_file(
+            raw, output, cropped, cropped_mask, geometry, args.mask_blur), args.repeat)
+        print(f'{name:>6} {legacy * 1000:>10.1f} {current * 1000:>10.1f} {legacy / current:>7.2f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,147 @@
+# Scene cuts in Multi-frame rendering: makes a clip of moving scenes with different palettes,
+# detects the cuts, renders the clip split at the cuts, every scene on its own, and the clip
+# again with several worker processes sharing it in distributed mode. Checks that the detected
+# cuts are the planted ones, that a scene renders the same inside the clip as on its own, and
+# that the distributed outputs match; exits with status 1 otherwise.
+#
+# Usage (from the repository root):
+#     python -m bench.bench_scenes [--scenes 6] [--length 12] [--size 320x240] [--workers 3]
+
+import argparse
+import collections
+import json
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+from PIL import Image
+
+from bench.headless import parse_size, run_script
+from bench.webui_stub import StubGenerator, StubProcessing, install
+from scripts.ei_leases import LEASE_DIR_NAME
+from scripts.ei_motion import histogram_distances, scene_cuts, sequence_thumbnails
+
+
+def make_clip(directory, scenes, size, seed=0):
+    """
+    Write `scenes` (a list of lengths) of frames to `directory`. Each scene is a gradient of its
+    own colors scrolling across the frame, and returns the index of the first frame of every
+    scene but the first.
+    """
+
+    rng = np.random.default_rng(seed)
+    w, h = size
+    y = np.arange(h, dtype=np.float32)[:, None] / h
+    x = np.arange(w, dtype=np.float32)[None, :] / w
+    os.makedirs(directory, exist_ok=True)
+    cuts, index = [], 0
+    for k, length in enumerate(scenes):
+        if k:
+            cuts.append(index)
+        low, high = rng.uniform(0, 160, 3), rng.uniform(60, 255, 3)
+        for i in range(length):
+            t = (x + y * 0.5 + i * 0.02) % 1.0
+            frame = low + (high - low) * t[..., None]
+            frame += rng.normal(0, 6, frame.shape)
+            Image.fromarray(np.clip(frame, 0, 255).astype(np.uint8), 'RGB').save(
+                os.path.join(directory, f'{index + 1:05d}.png'))
+            index += 1
+    return cuts
+
+
+def outputs(directory):
+    images = {}
+    for name in sorted(os.listdir(directory)):
+        if name.endswith('.png'):
+            with Image.open(os.path.join(directory, name)) as img:
+                images[name] = img.tobytes()
+    return images
+
+
+def render(input_dir, output_dir, **overrides):
+    install(StubGenerator())
+    p = StubProcessing(256, 192, 'bench', 3, 1, 0.6)
+    run_script('multiframe', p, input_dir=input_dir, output_dir=output_dir, trace=False, **overrides)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--scenes', type=int, default=6)
+    parser.add_argument('--length', type=int, default=12, help='average frames per scene')
+    parser.add_argument('--size', type=parse_size, default=(320, 240))
+    parser.add_argument('--workers', type=int, default=3)
+    parser.add_argument('--threshold', type=float, default=40)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(1)
+    lengths = [int(n) for n in rng.integers(args.length // 2 + 8, args.length * 3 // 2 + 8, args.scenes)]
+    with tempfile.TemporaryDirectory() as directory:
+        clip = os.path.join(directory, 'clip')
+        planted = make_clip(clip, lengths, args.size)
+        paths = [os.path.join(clip, name) for name in sorted(os.listdir(clip))]
+
+        start = time.perf_counter()
+        thumbs = sequence_thumbnails(paths)
+        decode = time.perf_counter() - start
+        start = time.perf_counter()
+        distances = histogram_distances(thumbs)
+        metric = time.perf_counter() - start
+        cuts = scene_cuts(distances, args.threshold / 100)
+        print(f'{len(paths)} frames of {args.size[0]}x{args.size[1]}: thumbnails {decode * 1000 / len(paths):.2f} ms/frame, '
+              f'histogram distances {metric * 1e6 / len(paths):.1f} us/frame')
+        inside = np.delete(distances, [cut - 1 for cut in planted])
+        print(f'distances: {distances[[cut - 1 for cut in planted]].min() * 100:.0f}% or more at the cuts, '
+              f'{inside.max() * 100:.0f}% at most inside the scenes')
+        if cuts != planted:
+            print(f'FAIL: detected cuts {cuts}, planted {planted}')
+            raise SystemExit(1)
+
+        split = os.path.join(directory, 'split')
+        render(clip, split, split_scenes=True, scene_threshold=args.threshold)
+        expected = outputs(split)
+
+        # Every scene rendered as a clip of its own
+        for first, end in zip([0] + planted, planted + [len(paths)]):
+            scene = os.path.join(directory, f'scene{first}')
+            os.makedirs(scene)
+            for path in paths[first:end]:
+                shutil.copy(path, scene)
+            render(scene, os.path.join(directory, 'alone'))
+        alone = outputs(os.path.join(directory, 'alone'))
+        if alone != expected:
+            different = sorted(name for name in expected if alone.get(name) != expected[name])
+            print(f'FAIL: {len(different)} frame(s) differ from the scenes rendered alone: {", ".join(different[:8])}')
+            raise SystemExit(1)
+
+        shared = os.path.join(directory, 'shared')
+        start = time.perf_counter()
+        processes = [
+            multiprocessing.Process(
+                target=render, args=(clip, shared),
+                kwargs=dict(split_scenes=True, scene_threshold=args.threshold, shard=True))
+            for _ in range(args.workers)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        elapsed = time.perf_counter() - start
+        if outputs(shared) != expected:
+            print('FAIL: the distributed outputs differ')
+            raise SystemExit(1)
+        by_worker = collections.Counter()
+        for root, _, files in os.walk(os.path.join(shared, LEASE_DIR_NAME)):
+            for name in files:
+                if name.endswith('.done'):
+                    with open(os.path.join(root, name), encoding='utf-8') as f:
+                        by_worker[json.load(f)['worker']] += 1
+
+    print(f'{len(planted) + 1} scenes of {", ".join(map(str, lengths))} frames, shared by {len(by_worker)} '
+          f'worker(s) in {elapsed:.2f} s: ' + ', '.join(str(n) for n in sorted(by_worker.values(), reverse=True)))
+    print('OK: cuts detected, scenes render the same split or alone, distributed outputs match')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+# Benchmark of the frame store: reading the input and mask frames of a synthetic sequence from
+# their PNG files against reading them from a `FrameStore`, the cost of ingesting them and of
+# checking an up-to-date store, and the mask prepass from both. Checks that stored frames are
+# identical to the decoded ones, that they are found when the directory is given with a trailing
+# slash, and that a changed file is decoded again rather than read from the store; exits with
+# status 1 otherwise.
+#
+# Usage (from the repository root):
+#     python -m bench.bench_store [--frames 16] [--size 1920x1080]
+
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+from PIL import Image
+
+from bench.headless import make_dataset, parse_size
+from scripts.ei_masks import MaskTable
+from scripts.ei_store import FrameStore
+from scripts.ei_video import close_videos, decode_frame, frame_array, frame_source, open_frame, use_store
+
+
+def read_all(paths):
+    start = time.perf_counter()
+    for path in paths:
+        with open_frame(path) as img:
+            img.load()
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--frames', type=int, default=16)
+    parser.add_argument('--size', type=parse_size, default=(1920, 1080))
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        dirs = make_dataset(directory, args.frames, args.size, 0.3, 0)
+        indexes = [frame_source(dirs['input']), frame_source(dirs['mask'])]
+        paths = [path for index in indexes for path in index]
+        mask_paths = list(indexes[1])
+
+        decoded = read_all(paths)
+        start = time.perf_counter()
+        prepass_decoded = MaskTable.build(mask_paths, mask_paths, 50)
+        prepass_decoded_s = time.perf_counter() - start
+
+        start = time.perf_counter()
+        stores = [FrameStore.ingest(index, os.path.join(directory, f'store{i}')) for i, index in enumerate(indexes)]
+        ingest = time.perf_counter() - start
+        start = time.perf_counter()
+        stores = [FrameStore.ingest(index, store.directory) for index, store in zip(indexes, stores)]
+        check = time.perf_counter() - start
+        if any(store.ingested for store in stores):
+            print('FAIL: an up-to-date store was ingested again')
+            raise SystemExit(1)
+        for index, store in zip(indexes, stores):
+            use_store(index.directory, store)
+
+        stored = read_all(paths)
+        start = time.perf_counter()
+        prepass_stored = MaskTable.build(mask_paths, mask_paths, 50)
+        prepass_stored_s = time.perf_counter() - start
+
+        for path in paths:
+            with decode_frame(path) as img, open_frame(path) as mapped:
+                if img.mode != mapped.mode or img.tobytes() != mapped.tobytes():
+                    print(f'FAIL: {path} differs in the store')
+                    raise SystemExit(1)
+        if not np.array_equal(prepass_decoded.rows, prepass_stored.rows):
+            print('FAIL: the mask prepass differs with the store')
+            raise SystemExit(1)
+
+        # A directory given with a trailing slash is found from its frame paths
+        close_videos()
+        slashed = frame_source(dirs['input'] + os.sep)
+        use_store(slashed.directory, stores[0])
+        missing = [path for path in slashed if frame_array(path) is None]
+        if missing:
+            print(f'FAIL: {len(missing)} frame(s) of {slashed.directory} are not read from the store')
+            raise SystemExit(1)
+
+        # A changed file is decoded again until the store is updated
+        changed = indexes[0].paths[0]
+        Image.new('RGB', args.size, (255, 0, 0)).save(changed)
+        os.utime(changed, ns=(time.time_ns(), time.time_ns() + 10 ** 9))
+        with open_frame(changed) as img:
+            if img.getpixel((0, 0)) != (255, 0, 0):
+                print('FAIL: a changed file was read from the store')
+                raise SystemExit(1)
+        store = FrameStore.ingest(indexes[0], stores[0].directory)
+        if (store.ingested, store.reused) != (1, len(indexes[0]) - 1):
+            print(f'FAIL: updating the store: {store.summary()}')
+            raise SystemExit(1)
+        close_videos()
+
+        n = len(paths)
+        print(f'{n} frames of {args.size[0]}x{args.size[1]} (inputs and masks)')
+        print(f'decode from PNG:   {decoded * 1000 / n:>8.2f} ms/frame')
+        print(f'read from store:   {stored * 1000 / n:>8.2f} ms/frame ({decoded / stored:.0f}x)')
+        print(f'ingest:            {ingest * 1000 / n:>8.2f} ms/frame')
+        print(f'up-to-date check:  {check * 1000 / n:>8.2f} ms/frame')
+        print(f'mask prepass:      {prepass_decoded_s * 1000 / len(mask_paths):>8.2f} ms/frame from PNG, '
+              f'{prepass_stored_s * 1000 / len(mask_paths):.2f} ms/frame from the store')
+        print('OK: stored frames match and changed files are decoded again')
+
+
+if __name__ == '__main__':
+    main()
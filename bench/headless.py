@@ -0,0 +1,333 @@
+# Headless runner for Enhanced img2img and Multi-frame rendering: drives `Script.run()` on a
+# directory or video file with the WebUI replaced by the stand-ins of `bench.webui_stub`, and a
+# pluggable generator in place of the model. Runs on a machine without a GPU, gradio or the WebUI.
+#
+# Usage (from the repository root):
+#     python -m bench.headless make DIR [--frames 48] [--size 512x512] [--coverage 0.3] [--cn 1]
+#     python -m bench.headless enhanced INPUT OUTPUT [--mask-dir DIR] [--set crop_buckets=512] ...
+#     python -m bench.headless multiframe INPUT OUTPUT [--set use_cn=True] ...
+#     python -m bench.headless bench [--frames 48] [--max-overhead-ms 50]
+#
+# `--generator module:attr` names a callable `generator(p)` returning the output images (or a
+# factory of one, called with no argument); the default is a `StubGenerator` sleeping
+# `--latency` seconds per call. `bench` makes a synthetic dataset in a temporary directory, runs
+# both scripts on it with tracing, and exits with status 1 if the time spent outside the
+# generator exceeds `--max-overhead-ms` per frame, so it can gate overhead regressions in CI.
+
+import argparse
+import ast
+import importlib
+import inspect
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+from PIL import Image
+
+from bench.webui_stub import StubGenerator, StubProcessing, install
+from scripts.ei_video import close_videos, frame_source
+
+# Run arguments after `p`, by script, up to `*cn_dirs`
+ENHANCED_DEFAULTS = dict(
+    input_dir='',
+    output_dir='',
+    mask_dir='',
+    use_mask=False,
+    use_img_mask=False,
+    as_output_alpha=False,
+    is_crop=False,
+    crop_buckets='',
+    use_cn=False,
+    alpha_threshold=50,
+    rotate_img='0',
+    given_file=False,
+    specified_filename='',
+    process_deepbooru=False,
+    deepbooru_prev=False,
+    pretag=False,
+    use_txt=False,
+    txt_path='',
+    use_csv=False,
+    table_content=None,
+    is_rerun=False,
+    rerun_width=512,
+    rerun_height=512,
+    rerun_strength=0.2,
+    pass_major=False,
+    pass_chunk=16,
+    pass_cache_size=2048,
+    result_cache=False,
+    result_cache_size=4096,
+    prefetch_depth=2,
+    memory_budget=0,
+    encoder='Same as input',
+    encoder_threads=2,
+    frame_store=False,
+    resume=False,
+    shard=False,
+    chunk_size=8,
+    trace=True,
+    trace_memory=False,
+)
+
+MULTIFRAME_DEFAULTS = dict(
+    append_interrogation='None',
+    input_dir='',
+    output_dir='',
+    first_denoise=1.0,
+    third_frame_image='FirstGen',
+    color_correction_enabled=False,
+    unfreeze_seed=False,
+    loopback_source='Previous',
+    skip_static=False,
+    static_threshold=1.0,
+    split_scenes=False,
+    scene_threshold=40,
+    keyframes='Every frame',
+    keyframe_interval=4,
+    warp_threshold=3.0,
+    use_csv=False,
+    table_content=None,
+    given_file=False,
+    specified_filename='',
+    use_txt=False,
+    txt_path='',
+    use_cn=False,
+    encoder='Same as input',
+    encoder_threads=2,
+    frame_store=False,
+    resume=False,
+    shard=False,
+    trace=True,
+    trace_memory=False,
+)
+
+SCRIPTS = {
+    'enhanced': ('scripts.enhanced_img2img', ENHANCED_DEFAULTS),
+    'multiframe': ('scripts.multi_frame_rendering', MULTIFRAME_DEFAULTS),
+}
+
+
+def parse_size(text):
+    w, h = text.lower().split('x')
+    return int(w), int(h)
+
+
+def parse_value(text, default):
+    # Text arguments are kept as typed, the others are Python literals
+    if isinstance(default, str):
+        return text
+    try:
+        return ast.literal_eval(text)
+    except (ValueError, SyntaxError):
+        return text
+
+
+def make_dataset(directory, frames=48, size=(512, 512), coverage=0.3, cn=0, seed=0):
+    """
+    Write a synthetic dataset to `directory`: `input/` with `frames` noisy frames of `size`,
+    `mask/` with an ellipse covering `coverage` of each frame and moving across it, and `cn0/`,
+    `cn1/`... with `cn` ControlNet directories of edge-like images.
+
+    Returns:
+        A dict with the `input`, `mask` and `cn` (list) directories.
+    """
+
+    rng = np.random.default_rng(seed)
+    w, h = size
+    dirs = {'input': os.path.join(directory, 'input'), 'mask': os.path.join(directory, 'mask'),
+            'cn': [os.path.join(directory, f'cn{k}') for k in range(cn)]}
+    for path in [dirs['input'], dirs['mask']] + dirs['cn']:
+        os.makedirs(path, exist_ok=True)
+
+    # A smooth background with some noise, so PNG encoding costs what it does on real frames.
+    # Small dtypes and broadcasting keep 8K frames affordable.
+    y = np.arange(h, dtype=np.int32)[:, None]
+    x = np.arange(w, dtype=np.int32)[None, :]
+    base = np.empty((h, w, 3), dtype=np.int16)
+    base[..., 0] = x * 255 // max(1, w - 1)
+    base[..., 1] = y * 255 // max(1, h - 1)
+    base[..., 2] = (x + y) * 255 // max(1, w + h - 2)
+    rx, ry = w * (coverage / np.pi) ** 0.5, h * (coverage / np.pi) ** 0.5
+    for i in range(frames):
+        name = f'{i + 1:05d}.png'
+        frame = base + rng.integers(-16, 16, (h, w, 3), dtype=np.int16)
+        frame += i
+        frame = np.clip(frame, 0, 255).astype(np.uint8)
+        Image.fromarray(frame, 'RGB').save(os.path.join(dirs['input'], name))
+
+        cx = rx + (w - 2 * rx) * (i / max(1, frames - 1))
+        inside = ((x - cx) / max(rx, 1)) ** 2 + ((y - h / 2) / max(ry, 1)) ** 2 <= 1
+        alpha = Image.fromarray(np.where(inside, np.uint8(255), np.uint8(0)), 'L')
+        Image.merge('RGBA', [alpha] * 4).save(os.path.join(dirs['mask'], name))
+
+        if dirs['cn']:
+            gray = np.asarray(Image.fromarray(frame, 'RGB').convert('L'), dtype=np.int16)
+            edges = Image.fromarray(np.where(np.abs(np.diff(gray, axis=1, append=0)) > 8, np.uint8(255), np.uint8(0)), 'L')
+            for path in dirs['cn']:
+                edges.save(os.path.join(path, name))
+    return dirs
+
+
+def load_generator(spec, latency, per_image):
+    """
+    Return the generator named by `spec` (`module:attr`), or a `StubGenerator` if `spec` is empty.
+    A class or a function taking no argument is called to make the generator.
+    """
+
+    if not spec:
+        return StubGenerator(latency, per_image)
+    module, _, attr = spec.partition(':')
+    generator = getattr(importlib.import_module(module), attr)
+    if inspect.isclass(generator) or not inspect.signature(generator).parameters:
+        generator = generator()
+    return generator
+
+
+class Timed(object):
+    """
+    Wraps a generator to measure the time spent in it, whatever it is.
+    """
+
+    def __init__(self, generator):
+        self.generator = generator
+        self.seconds = 0.0
+        self.images = 0
+
+    def __call__(self, p):
+        start = time.perf_counter()
+        outputs = self.generator(p)
+        self.seconds += time.perf_counter() - start
+        self.images += len(outputs)
+        return outputs
+
+
+def run_script(name, p, cn_dirs=(), **overrides):
+    """
+    Run the script `name` ('enhanced' or 'multiframe') with `p` and the default arguments updated
+    with `overrides`, and return `(seconds, Processed, Script)`.
+    """
+
+    module_name, defaults = SCRIPTS[name]
+    unknown = set(overrides) - set(defaults)
+    if unknown:
+        raise ValueError(f'Unknown argument(s) for {name}: {", ".join(sorted(unknown))}')
+    module = importlib.import_module(module_name)
+    script = module.Script()
+    params = list(inspect.signature(script.run).parameters)
+    args = dict(defaults, **overrides)
+    # The run arguments are positional in the WebUI, check the table above still matches them
+    expected = params[1:params.index('cn_dirs')]
+    if expected != list(defaults):
+        raise RuntimeError(f'{module_name}.Script.run() arguments changed: {", ".join(expected)}')
+    os.makedirs(args['output_dir'], exist_ok=True)
+    start = time.perf_counter()
+    processed = script.run(p, *[args[k] for k in expected], *cn_dirs)
+    return time.perf_counter() - start, processed, script
+
+
+def report(name, seconds, frames, timed):
+    """
+    Print the throughput of a run and the time spent outside the generator, and return the
+    overhead per frame in seconds. The per-stage table is printed by the script itself.
+    """
+
+    overhead = (seconds - timed.seconds) / max(1, frames)
+    print(f'{name}: {frames} frames in {seconds:.2f} s, {frames / seconds:.2f} frames/s, '
+          f'generator {timed.seconds:.2f} s, overhead {overhead * 1000:.1f} ms/frame')
+    return overhead
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--generator', default='', help='module:attr of a generator, default: the CPU stub')
+    parser.add_argument('--latency', type=float, default=0.0, help='stub latency per call in seconds')
+    parser.add_argument('--per-image', type=float, default=0.0, help='stub latency per image in seconds')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    make = commands.add_parser('make', help='make a synthetic dataset')
+    make.add_argument('directory')
+    bench = commands.add_parser('bench', help='benchmark both scripts')
+
+    for sub in (make, bench):
+        sub.add_argument('--frames', type=int, default=48)
+        sub.add_argument('--size', type=parse_size, default=(512, 512))
+        sub.add_argument('--coverage', type=float, default=0.3)
+        sub.add_argument('--cn', type=int, default=1, help='number of ControlNet directories')
+    bench.add_argument('--batch-size', type=int, default=4)
+    bench.add_argument('--max-overhead-ms', type=float, default=None,
+                       help='exit with status 1 if the overhead per frame is larger')
+
+    for name in SCRIPTS:
+        sub = commands.add_parser(name, help=f'run {name} on a directory')
+        sub.add_argument('input_dir')
+        sub.add_argument('output_dir')
+        sub.add_argument('--size', type=parse_size, default=(512, 512), help='generation size')
+        sub.add_argument('--batch-size', type=int, default=1)
+        sub.add_argument('--prompt', default='')
+        sub.add_argument('--seed', type=int, default=1)
+        sub.add_argument('--strength', type=float, default=0.75)
+        sub.add_argument('--cn-dir', action='append', default=[], help='ControlNet directory, repeatable')
+        sub.add_argument('--set', action='append', default=[], metavar='NAME=VALUE',
+                         help='set a run argument, repeatable')
+        if name == 'enhanced':
+            sub.add_argument('--mask-dir', default='')
+    args = parser.parse_args()
+
+    if args.command == 'make':
+        dirs = make_dataset(args.directory, args.frames, args.size, args.coverage, args.cn)
+        print(f'{args.frames} frames of {args.size[0]}x{args.size[1]} written to {args.directory}: '
+              f'{", ".join([dirs["input"], dirs["mask"]] + dirs["cn"])}')
+        return
+
+    timed = Timed(load_generator(args.generator, args.latency, args.per_image))
+    install(timed)
+
+    if args.command in SCRIPTS:
+        overrides = dict(item.split('=', 1) for item in args.set)
+        defaults = SCRIPTS[args.command][1]
+        overrides = {k: parse_value(v, defaults.get(k)) for k, v in overrides.items()}
+        overrides.update(input_dir=args.input_dir, output_dir=args.output_dir)
+        if args.command == 'enhanced' and args.mask_dir:
+            overrides.setdefault('mask_dir', args.mask_dir)
+            overrides.setdefault('use_img_mask', True)
+        if args.cn_dir:
+            overrides.setdefault('use_cn', True)
+        p = StubProcessing(*args.size, args.prompt, args.seed, args.batch_size, args.strength)
+        seconds, _, _ = run_script(args.command, p, args.cn_dir, **overrides)
+        frames = len(frame_source(args.input_dir))
+        close_videos()
+        report(args.command, seconds, frames, timed)
+        return
+
+    overheads = {}
+    with tempfile.TemporaryDirectory() as directory:
+        dirs = make_dataset(directory, args.frames, args.size, args.coverage, args.cn)
+        cases = [
+            ('enhanced', dict(batch_size=args.batch_size), dict(use_cn=bool(args.cn))),
+            ('enhanced crop', dict(batch_size=args.batch_size),
+             dict(mask_dir=dirs['mask'], use_img_mask=True, is_crop=True, use_cn=bool(args.cn))),
+            ('multiframe', dict(batch_size=1), dict(use_cn=bool(args.cn))),
+        ]
+        for case, p_args, overrides in cases:
+            output_dir = os.path.join(directory, 'out', case.replace(' ', '_'))
+            timed.seconds, timed.images = 0.0, 0
+            p = StubProcessing(*args.size, 'bench', 1, **p_args)
+            seconds, _, _ = run_script(
+                case.split()[0], p, dirs['cn'],
+                input_dir=dirs['input'], output_dir=output_dir, **overrides)
+            overheads[case] = report(case, seconds, args.frames, timed)
+            print()
+
+    if args.max_overhead_ms is not None:
+        worst = max(overheads, key=overheads.get)
+        if overheads[worst] * 1000 > args.max_overhead_ms:
+            print(f'FAIL: {worst} overhead {overheads[worst] * 1000:.1f} ms/frame > {args.max_overhead_ms} ms')
+            sys.exit(1)
+        print(f'OK: overhead at most {overheads[worst] * 1000:.1f} ms/frame')
+
+
+if __name__ == '__main__':
+    main()
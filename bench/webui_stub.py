@@ -0,0 +1,251 @@
+# Minimal stand-ins for the WebUI modules used by the scripts, so that their `run()` can be
+# driven from the command line without a model or a GPU. `install()` must be called before
+# importing the scripts; nothing is installed when this module is imported.
+
+import math
+import random
+import sys
+import time
+import types
+
+from PIL import Image, ImageFilter, ImageOps
+
+
+class StubProcessing(object):
+    """
+    The attributes of `StableDiffusionProcessingImg2Img` read or set by the scripts.
+    """
+
+    def __init__(self, width=512, height=512, prompt='', seed=-1, batch_size=1, denoising_strength=0.75):
+        self.prompt = prompt
+        self.negative_prompt = ''
+        self.styles = []
+        self.seed = seed
+        self.subseed = -1
+        self.subseed_strength = 0
+        self.seed_resize_from_h = 0
+        self.seed_resize_from_w = 0
+        self.sampler_name = 'Stub'
+        self.steps = 20
+        self.cfg_scale = 7
+        self.image_cfg_scale = None
+        self.width = width
+        self.height = height
+        self.batch_size = batch_size
+        self.n_iter = 1
+        self.denoising_strength = denoising_strength
+        self.resize_mode = 0
+        self.mask_blur = 4
+        self.inpainting_fill = 1
+        self.inpaint_full_res = False
+        self.inpaint_full_res_padding = 32
+        self.inpainting_mask_invert = 0
+        self.restore_faces = False
+        self.tiling = False
+        self.init_images = []
+        self.image_mask = None
+        self.control_net_input_image = None
+        self.color_corrections = None
+        self.do_not_save_grid = False
+        self.do_not_save_samples = False
+        self.script_args = []
+        self.sd_model = types.SimpleNamespace(sd_model_hash='stub')
+        self.all_prompts = []
+        self.all_seeds = []
+        self.all_subseeds = []
+
+
+class StubGenerator(object):
+    """
+    A CPU generator standing in for the model: returns the init images resized to the target size
+    and transformed, after sleeping for a fake latency.
+
+    Attributes:
+        calls: The number of `process_images` calls.
+        images: The number of images generated.
+        seconds: The total time spent generating, including the fake latency.
+    """
+
+    TRANSFORMS = {
+        'identity': lambda img: img,
+        'invert': ImageOps.invert,
+        'blur': lambda img: img.filter(ImageFilter.BoxBlur(2)),
+    }
+
+    def __init__(self, latency=0.0, per_image=0.0, transform='invert'):
+        """
+        Args:
+            latency: Seconds slept per `process_images` call. (default: 0.0)
+            per_image: Seconds slept per generated image. (default: 0.0)
+            transform: One of 'identity', 'invert' or 'blur'. (default: 'invert')
+        """
+
+        self.latency = latency
+        self.per_image = per_image
+        self.transform = self.TRANSFORMS[transform]
+        self.calls = 0
+        self.images = 0
+        self.seconds = 0.0
+
+    def __call__(self, p):
+        start = time.perf_counter()
+        count = p.batch_size * p.n_iter
+        sources = p.init_images
+        outputs = [
+            self.transform(sources[i % len(sources)].convert('RGB').resize((p.width, p.height), Image.LANCZOS))
+            for i in range(count)]
+        delay = self.latency + self.per_image * count - (time.perf_counter() - start)
+        if delay > 0:
+            time.sleep(delay)
+        self.calls += 1
+        self.images += count
+        self.seconds += time.perf_counter() - start
+        return outputs
+
+
+def _module(name, **attrs):
+    module = types.ModuleType(name)
+    module.__dict__.update(attrs)
+    return module
+
+
+def install(generator):
+    """
+    Install stand-ins for `modules.*` (and `gradio` if it is missing) into `sys.modules`, with
+    `process_images` calling `generator(p)`, which returns the list of output images.
+
+    Returns:
+        The stub `modules.shared` module, whose `opts.data` and `state` can be adjusted.
+    """
+
+    class Options(object):
+        def __init__(self, data):
+            self.__dict__['data'] = data
+
+        def __getattr__(self, name):
+            try:
+                return self.data[name]
+            except KeyError:
+                raise AttributeError(name)
+
+        def __setattr__(self, name, value):
+            self.data[name] = value
+
+    class State(object):
+        interrupted = False
+        skipped = False
+        job = ''
+        job_count = 0
+
+    class Processed(object):
+        def __init__(self, p, images_list, seed=-1, info='', subseed=None, *args, **kwargs):
+            self.images = images_list
+            self.seed = seed
+            self.subseed = subseed
+            self.info = info
+
+    class Script(object):
+        args_from = None
+        args_to = None
+
+    class ImageSaveParams(object):
+        def __init__(self, image, p, filename, pnginfo):
+            self.image = image
+            self.p = p
+            self.filename = filename
+            self.pnginfo = pnginfo
+
+    class ModelHijack(object):
+        comments = []
+
+        def get_prompt_lengths(self, prompt):
+            # Word count as a stand-in for the token count, in chunks of 75 like the WebUI
+            tokens = len(prompt.replace(',', ' ').split())
+            return tokens, max(1, math.ceil(tokens / 75)) * 75
+
+    class DeepBooru(object):
+        def start(self):
+            pass
+
+        def stop(self):
+            pass
+
+        def tag_multi(self, img, force_disable_ranks=False):
+            return 'stub, tags'
+
+        def tag(self, img):
+            return self.tag_multi(img)
+
+    def get_fixed_seed(seed):
+        if seed is None or seed == '' or seed == -1:
+            return int(random.randrange(4294967294))
+        return seed
+
+    def fix_seed(p):
+        p.seed = get_fixed_seed(p.seed)
+        p.subseed = get_fixed_seed(p.subseed)
+
+    def create_infotext(p, all_prompts, all_seeds, all_subseeds, comments=None, iteration=0, position_in_batch=0):
+        index = position_in_batch + iteration * p.batch_size
+        return (f'{all_prompts[index]}\nSteps: {p.steps}, Sampler: {p.sampler_name}, CFG scale: {p.cfg_scale}, '
+                f'Seed: {all_seeds[index]}, Size: {p.width}x{p.height}, Denoising strength: {p.denoising_strength}')
+
+    def process_images(p):
+        count = p.batch_size * p.n_iter
+        prompts = p.prompt if isinstance(p.prompt, list) else [p.prompt] * count
+        seed = p.seed if isinstance(p.seed, list) else [get_fixed_seed(p.seed) + i for i in range(count)]
+        subseed = p.subseed if isinstance(p.subseed, list) else [get_fixed_seed(p.subseed) + i for i in range(count)]
+        p.all_prompts, p.all_seeds, p.all_subseeds = prompts, seed, subseed
+        state.job_count = max(state.job_count, 1)
+        output = generator(p)
+        return Processed(p, output, seed[0], create_infotext(p, prompts, seed, subseed), subseed[0])
+
+    def setup_color_correction(img):
+        return img
+
+    state = State()
+    shared = _module(
+        'modules.shared',
+        opts=Options({
+            'enable_pnginfo': True,
+            'control_net_max_models_num': 1,
+            'img2img_color_correction': False,
+            'interrogate_return_ranks': False,
+            'deepbooru_use_spaces': False,
+        }),
+        cmd_opts=types.SimpleNamespace(deepdanbooru=False),
+        state=state,
+        interrogator=types.SimpleNamespace(interrogate=lambda img: 'stub caption'))
+    processing = _module(
+        'modules.processing',
+        Processed=Processed,
+        process_images=process_images,
+        create_infotext=create_infotext,
+        get_fixed_seed=get_fixed_seed,
+        fix_seed=fix_seed,
+        setup_color_correction=setup_color_correction)
+    stubs = {
+        'modules': _module('modules'),
+        'modules.scripts': _module('modules.scripts', Script=Script),
+        'modules.shared': shared,
+        'modules.processing': processing,
+        'modules.script_callbacks': _module(
+            'modules.script_callbacks',
+            ImageSaveParams=ImageSaveParams,
+            before_image_saved_callback=lambda params: None),
+        'modules.sd_hijack': _module('modules.sd_hijack', model_hijack=ModelHijack()),
+        'modules.deepbooru': _module('modules.deepbooru', model=DeepBooru()),
+        'modules.sd_samplers': _module('modules.sd_samplers', samplers=[]),
+        'modules.images': _module('modules.images'),
+    }
+    for name, module in stubs.items():
+        if name != 'modules':
+            setattr(stubs['modules'], name.split('.', 1)[1], module)
+    sys.modules.update(stubs)
+
+    try:
+        import gradio
+    except ImportError:
+        # `ui()` is never called headless
+        sys.modules['gradio'] = _module('gradio')
+    return shared
@@ -1,10 +1,41 @@
 # Author: OedoSoldier [大江户战士]
 # https://space.bilibili.com/55123
 
+import math
+from collections import namedtuple
+
 from PIL import Image, ImageFilter
 import numpy as np
 
 
+class CropGeometry(namedtuple('CropGeometry', ['x0', 'y0', 'x1', 'y1', 'width', 'height'])):
+    """
+    The geometry of a crop made by `CropUtils.crop_img()`.
+
+    `(x0, y0, x1, y1)` is the bounding box of the mask in the original image and `(width, height)`
+    is its size. The crop is centered in a `side` x `side` square at `offset` when width and height
+    differ. It can be indexed like the `bbox + size` tuple returned by earlier versions.
+    """
+
+    __slots__ = ()
+
+    @property
+    def bbox(self):
+        return (self.x0, self.y0, self.x1, self.y1)
+
+    @property
+    def size(self):
+        return (self.width, self.height)
+
+    @property
+    def side(self):
+        return max(self.width, self.height)
+
+    @property
+    def offset(self):
+        return (round((self.side - self.width) / 2), round((self.side - self.height) / 2))
+
+
 class CropUtils(object):
     """
     This class provides utility functions for cropping and restoring images.
@@ -13,7 +44,7 @@ class CropUtils(object):
     crop the image to the minimum bounding box that includes the non-zero pixels in the mask.
     If the width and height of the resulting image are not equal, the image is scaled up to a
     square image using zero padding. The function returns the cropped image, the cropped mask,
-    and the bounding box and image size as a tuple.
+    and the bounding box and image size as a `CropGeometry`.
 
     The `restore_by_file()` function takes a raw image, a cropped image, a reference image,
     and a blur mask, and uses these images to restore the cropped image to the raw image.
@@ -22,60 +53,89 @@ class CropUtils(object):
     The function returns the restored image.
     """
 
-    def crop_img(self, img, mask, threshold=50):
+    @staticmethod
+    def crop_img(img, mask, threshold=50, bbox=None):
         """
         Crop the given image using the given mask.
 
         Args:
             img: The image to be cropped, as a PIL.Image object.
-            mask: The mask to be used for cropping, as a PIL.Image object.
+            mask: The mask to be used for cropping, as a PIL.Image object. The alpha channel is
+                  used for RGBA masks and the luminance for other modes.
             threshold: The threshold to use for converting the mask to binary. Pixels in the mask
                        with a value greater than the threshold will be considered as part of the
                        mask, and will be included in the cropped image. Pixels with a value less
                        than or equal to the threshold will be ignored. (default: 50)
+            bbox: The bounding box of the mask in `img` if it is already known, e.g. from a
+                  `MaskTable`, so the mask is not scanned again. (default: None)
 
         Returns:
-            A tuple containing the cropped image, the cropped mask, and a tuple with the bounding
-            box and image size. If the mask is empty, the function returns (img, None, None).
+            A tuple containing the cropped image, the cropped mask, and a `CropGeometry` describing
+            the bounding box and its size. If the mask is empty, the function returns
+            (img, None, None).
         """
 
         # Code for cropping the image using the mask
 
         mask = mask.resize(img.size) if img.size[0] != mask.size[0] else mask
 
-        bbox = mask.convert('L').point(
-            lambda x: 255 if x > threshold else 0,
-            mode='1').getbbox()
+        if bbox is None:
+            # The alpha channel of an RGBA mask, as built by the scripts, or its luminance otherwise.
+            # The alpha channel is unpacked straight into the array, without an intermediate image
+            if mask.mode == 'RGBA':
+                values = np.frombuffer(mask.tobytes('raw', 'A'), dtype=np.uint8).reshape(mask.size[1], mask.size[0])
+            else:
+                values = np.asarray(mask if mask.mode == 'L' else mask.convert('L'))
+            bbox = CropUtils.mask_bbox(values, threshold)
 
         if bbox:
-            img, mask = img.crop(bbox), mask.crop(bbox)
-            size = img.size
-            if size[0] != size[1]:
-                bigside = size[0] if size[0] > size[1] else size[1]
-
-                img_np = np.zeros((bigside, bigside, 4), dtype=np.uint8)
-                mask_np = np.zeros((bigside, bigside, 4), dtype=np.uint8)
+            geometry = CropGeometry(*bbox, bbox[2] - bbox[0], bbox[3] - bbox[1])
+            img = CropUtils._crop_square(img, geometry)
+            mask = CropUtils._crop_square(mask, geometry)
 
-                offset = (
-                    round(
-                        (bigside - size[0]) / 2),
-                    round(
-                        (bigside - size[1]) / 2))
+            return img, mask, geometry
 
-                img_np[offset[1]:offset[1] + size[1],
-                       offset[0]:offset[0] + size[0]] = img
-                mask_np[offset[1]:offset[1] + size[1],
-                        offset[0]:offset[0] + size[0]] = mask
+        return img, None, None
 
-                img = Image.fromarray(img_np)
-                mask = Image.fromarray(mask_np)
+    @staticmethod
+    def mask_bbox(values, threshold=0):
+        """
+        Compute the bounding box of the pixels of a single-channel mask above a threshold.
 
-            return img, mask, bbox + size
+        Args:
+            values: The mask, as a 2D numpy array.
+            threshold: Pixels with a value greater than the threshold are part of the mask.
+                       (default: 0)
 
-        return img, None, None
+        Returns:
+            The bounding box as (left, upper, right, lower), or None if the mask is empty.
+        """
 
+        # Row and column maxima avoid materializing a full-frame boolean array
+        rows = np.flatnonzero(values.max(axis=1) > threshold)
+        if rows.size == 0:
+            return None
+        cols = np.flatnonzero(values[rows[0]:rows[-1] + 1].max(axis=0) > threshold)
+        return (int(cols[0]), int(rows[0]), int(cols[-1]) + 1, int(rows[-1]) + 1)
+
+    @staticmethod
+    def _crop_square(img, geometry):
+        # Crop the padded square in one allocation, then blank the strips that came from
+        # outside the bbox so the padding is zero as if pasted onto an empty canvas
+        if geometry.width == geometry.height:
+            return img.crop(geometry.bbox)
+        side, (ox, oy) = geometry.side, geometry.offset
+        square = img.crop((geometry.x0 - ox, geometry.y0 - oy, geometry.x0 - ox + side, geometry.y0 - oy + side))
+        if geometry.width < side:
+            square.paste(0, (0, 0, ox, side))
+            square.paste(0, (ox + geometry.width, 0, side, side))
+        else:
+            square.paste(0, (0, 0, side, oy))
+            square.paste(0, (0, oy + geometry.height, side, side))
+        return square
+
+    @staticmethod
     def restore_by_file(
-            self,
             raw,
             img,
             ref_img,
@@ -85,15 +145,21 @@ class CropUtils(object):
         """
         Restore the given cropped image to the given raw image.
 
+        Only the crop rectangle plus a margin wide enough for the gaussian blur is processed, so
+        the cost depends on the size of the masked area rather than on the size of the frame.
+
         Args:
-            raw: The raw image, as a PIL.Image object.
+            raw: The raw image, as a PIL.Image object. RGB and RGBA raw images are updated in place
+                 and keep their mode, other modes are converted to a new RGBA image first.
             img: The cropped image, as a PIL.Image object.
-            ref_img: The reference image, as a PIL.Image object. This image is used to determine
-                     the bounding box of the cropped image.
+            ref_img: The reference image, as a PIL.Image object. This image is the square input
+                     returned by `crop_img()` and gives the size `img` is scaled back to.
             blur_mask: The blur mask, as a PIL.Image object. This mask is used to apply a gaussian
-                       blur to the alpha channel of the cropped image.
-            info: A tuple containing the bounding box of the cropped image. This tuple should have
-                  the form (upper_left_x, upper_left_y, lower_right_x, lower_right_y).
+                       blur to the alpha channel of the cropped image. The alpha channel is used,
+                       or the mask itself for an L mask.
+            info: The `CropGeometry` returned by `crop_img()`. A plain tuple of the form
+                  (upper_left_x, upper_left_y, ...) is also accepted, in which case the bounding
+                  box inside `ref_img` is recomputed from its alpha channel.
             mask_blur: The sigma value to use for the gaussian blur. Higher values result in a
                        stronger blur. (default: 0.5)
 
@@ -103,39 +169,49 @@ class CropUtils(object):
 
         # Code for restoring the cropped image
 
-        raw_size = raw.size
         ref_size = ref_img.size
 
         upper_left_x = info[0]
         upper_left_y = info[1]
 
-        img = img.resize(ref_size).convert('RGBA')
-        blur_mask = blur_mask.resize(ref_size).convert('RGBA')
-        raw = raw.convert('RGBA')
-
-        bbox = ref_img.split(
-        )[-1].convert('L').point(lambda x: 255 if x > 0 else 0, mode='1').getbbox()
-        bbox = list(bbox)
+        if isinstance(info, CropGeometry):
+            ox, oy = info.offset
+            bbox = (ox, oy, ox + info.width, oy + info.height)
+        else:
+            bbox = CropUtils.mask_bbox(np.asarray(ref_img.split()[-1].convert('L')))
         w, h = bbox[2] - bbox[0], bbox[3] - bbox[1]
 
-        img = img.crop(bbox)
+        img = img.resize(ref_size).crop(bbox).convert('RGBA')
+        if blur_mask.size != ref_size:
+            blur_mask = blur_mask.resize(ref_size)
         blur_mask = blur_mask.crop(bbox)
-
-        blur_img = np.zeros((raw_size[1], raw_size[0], 4), dtype=np.uint8)
-        blur_img[upper_left_y:upper_left_y +
-                 h, upper_left_x:upper_left_x +
-                 w, :] = np.array(blur_mask)
-        blur_img = Image.fromarray(blur_img, 'RGBA')
-        blur_img = blur_img.filter(ImageFilter.GaussianBlur(mask_blur))
-
-        new_img = np.zeros((raw_size[1], raw_size[0], 4), dtype=np.uint8)
-        new_img[upper_left_y:upper_left_y +
-                h, upper_left_x:upper_left_x +
-                w, :] = np.array(img)
-        new_img = Image.fromarray(new_img, 'RGBA')
-
-        new_img = Image.alpha_composite(raw, new_img)
-        new_img.putalpha(blur_img.split()[-1].convert('L'))
-        new_img = Image.alpha_composite(raw, new_img)
-
-        return new_img
+        blur_mask = blur_mask if blur_mask.mode == 'L' else blur_mask.convert('RGBA').getchannel('A')
+
+        # An RGB frame is only converted around the crop, it is opaque so compositing it as RGBA
+        # gives the same pixels
+        if raw.mode not in ('RGB', 'RGBA'):
+            raw = raw.convert('RGBA')
+
+        # The blur spreads at most about 3 sigma (three box blur passes), pixels beyond that
+        # margin are left untouched
+        margin = math.ceil(3 * mask_blur) + 3
+        roi = (
+            max(0, upper_left_x - margin),
+            max(0, upper_left_y - margin),
+            min(raw.size[0], upper_left_x + w + margin),
+            min(raw.size[1], upper_left_y + h + margin))
+        dest = (upper_left_x - roi[0], upper_left_y - roi[1])
+
+        alpha = Image.new('L', (roi[2] - roi[0], roi[3] - roi[1]))
+        alpha.paste(blur_mask, dest)
+        alpha = alpha.filter(ImageFilter.GaussianBlur(mask_blur))
+
+        base = raw.crop(roi).convert('RGBA')
+        new_img = base.copy()
+        new_img.alpha_composite(img, dest)
+        new_img.putalpha(alpha)
+        new_img = Image.alpha_composite(base, new_img)
+
+        raw.paste(new_img if raw.mode == 'RGBA' else new_img.convert(raw.mode), roi[:2])
+
+        return raw
@@ -0,0 +1,91 @@
+# Author: OedoSoldier [大江户战士]
+# https://space.bilibili.com/55123
+
+import threading
+from collections import OrderedDict
+
+from PIL import Image
+
+from scripts.ei_video import open_frame
+
+
+def image_nbytes(img):
+    return img.size[0] * img.size[1] * len(img.getbands())
+
+
+class ImageCache(object):
+    """
+    Bounded LRU cache of decoded and resized images, keyed by (path, size, mode).
+
+    Cached images are shared between callers and must be treated as read-only; paste them into
+    another image or copy them before modifying them.
+
+    Attributes:
+        max_bytes: The maximum total size of the cached pixel data.
+        hits: The number of lookups served from the cache.
+        misses: The number of lookups that decoded the file.
+        evictions: The number of images dropped to stay under `max_bytes`.
+    """
+
+    def __init__(self, max_bytes=512 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.nbytes = 0
+        self._images = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._images)
+
+    def get(self, path, size=None, mode='RGB', resample=Image.LANCZOS):
+        """
+        Return the image at `path`, converted to `mode` and resized to `size`.
+
+        Args:
+            path: The image file, or a frame of a video opened by `frame_source()`.
+            size: The (width, height) to resize to, or None to keep the original size.
+            mode: The mode to convert to, or None to keep the original mode. (default: 'RGB')
+            resample: The resampling filter. (default: Image.LANCZOS)
+        """
+
+        key = (path, tuple(size) if size is not None else None, mode, resample)
+        with self._lock:
+            img = self._images.get(key)
+            if img is not None:
+                self._images.move_to_end(key)
+                self.hits += 1
+                return img
+            self.misses += 1
+
+        img = open_frame(path)
+        img.load()
+        # Frames already in the right mode and size are cached as they are,
+        # without a copy (frames of a `FrameStore` stay mapped)
+        if mode is not None and img.mode != mode:
+            img = img.convert(mode)
+        if size is not None and img.size != tuple(size):
+            img = img.resize(tuple(size), resample)
+
+        nbytes = image_nbytes(img)
+        with self._lock:
+            if key not in self._images and nbytes <= self.max_bytes:
+                self._images[key] = img
+                self.nbytes += nbytes
+                while self.nbytes > self.max_bytes:
+                    _, evicted = self._images.popitem(last=False)
+                    self.nbytes -= image_nbytes(evicted)
+                    self.evictions += 1
+        return img
+
+    def clear(self):
+        with self._lock:
+            self._images.clear()
+            self.nbytes = 0
+
+    def summary(self):
+        total = self.hits + self.misses
+        rate = self.hits / total * 100 if total else 0
+        return (f'{self.hits} hits, {self.misses} misses ({rate:.0f}% hit rate), {self.evictions} evictions, '
+                f'{len(self._images)} images / {self.nbytes / 1024 / 1024:.1f} MB cached')
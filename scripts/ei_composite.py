@@ -0,0 +1,163 @@
+# Author: OedoSoldier [大江户战士]
+# https://space.bilibili.com/55123
+
+from collections import OrderedDict
+
+import numpy as np
+from PIL import Image
+
+
+class CompositeBuilder(object):
+    """
+    Builds the side-by-side composites of Multi-frame rendering.
+
+    A composite is a row of `columns` frames of `width` x `height`. Each named composite has one
+    canvas per layout that is reused from frame to frame, so a composite must not be kept after
+    the next call to `build()` with the same name and layout. Latent masks are created once per
+    layout.
+    """
+
+    def __init__(self, width, height, mode='RGB'):
+        self.width = width
+        self.height = height
+        self.mode = mode
+        self._canvases = {}
+        self._masks = {}
+
+    def build(self, name, images):
+        """
+        Return the composite `name` with `images` pasted from left to right.
+
+        Args:
+            name: The name of the composite, e.g. 'init' or one per ControlNet unit.
+            images: The column images, as PIL.Image objects, normally `width` x `height`.
+        """
+
+        columns = len(images)
+        canvas = self._canvases.get((name, columns))
+        if canvas is None:
+            canvas = self._canvases[(name, columns)] = Image.new(
+                self.mode, (self.width * columns, self.height))
+        for j, img in enumerate(images):
+            box = (self.width * j, 0)
+            if img.size != (self.width, self.height):
+                # Clear what the previous frame left in the column, as on a new canvas
+                canvas.paste(0, box + (self.width * (j + 1), self.height))
+            canvas.paste(img, box)
+        return canvas
+
+    def latent_mask(self, columns, target=None):
+        """
+        Return the mask of a layout: white over the column to generate and black over the
+        others. A single column is entirely generated.
+
+        Args:
+            columns: The number of columns.
+            target: The column to generate. (default: the second column, or the only one)
+        """
+
+        if target is None:
+            target = 0 if columns == 1 else 1
+        key = (columns, target)
+        mask = self._masks.get(key)
+        if mask is None:
+            mask = self._masks[key] = Image.new("RGB", (self.width * columns, self.height), "black")
+            # Same area as the `ImageDraw.rectangle` used before, right edge included
+            right = min(self.width * (target + 1) + 1, self.width * columns)
+            mask.paste((255, 255, 255), (self.width * target, 0, right, self.height))
+        return mask
+
+
+class ColumnColorStatistics(object):
+    """
+    Color correction references of composites, computed column by column.
+
+    `processing.setup_color_correction()` converts the whole composite to LAB, and the WebUI only
+    uses the result to match the histograms of each LAB channel. A histogram is the sum of the
+    histograms of the columns, so the histogram of every column image is computed once, cached by
+    the identity of the image, and the histograms of a composite are added up. Only the columns
+    that are new since the previous frame, usually the previous output, are converted. The cached
+    images must not be modified.
+
+    Attributes:
+        hits: The number of columns whose histograms were cached.
+        misses: The number of columns that were converted.
+    """
+
+    def __init__(self, width, height, max_entries=8):
+        """
+        Args:
+            width: The width of a column.
+            height: The height of a column.
+            max_entries: The number of column images whose histograms are kept. (default: 8)
+        """
+
+        try:
+            import cv2
+        except ImportError:
+            raise ImportError('OpenCV (opencv-python) is needed for the color correction of composites')
+        self.cv2 = cv2
+        self.width = width
+        self.height = height
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._histograms = OrderedDict()
+        self._levels = np.arange(256, dtype=np.uint8)
+        self._lab = None
+
+    def histogram(self, column):
+        """
+        Return the histograms of the LAB channels of an RGB array as a 3 x 256 array of counts.
+        """
+
+        # Converted into the same buffer every time, a new one costs more
+        # page faults than the conversion itself
+        if self._lab is None or self._lab.shape != column.shape:
+            self._lab = np.empty(column.shape, dtype=np.uint8)
+        lab = self.cv2.cvtColor(column, self.cv2.COLOR_RGB2LAB, self._lab)
+        return np.stack([
+            self.cv2.calcHist([lab], [channel], None, [256], [0, 256]).ravel()
+            for channel in range(3)]).astype(np.int64)
+
+    def histograms(self, composite, images):
+        """
+        Return the histograms of the LAB channels of `composite`, a composite built from `images`
+        by `CompositeBuilder.build()`, as a 3 x 256 array of counts.
+        """
+
+        total = np.zeros((3, 256), dtype=np.int64)
+        for j, img in enumerate(images):
+            # The image is kept with its histogram, so that its id is not reused
+            key = (id(img), img.size, img.mode)
+            entry = self._histograms.get(key)
+            if entry is not None and entry[0] is img:
+                self._histograms.move_to_end(key)
+                self.hits += 1
+            else:
+                if img.size == (self.width, self.height) and img.mode == 'RGB':
+                    column = np.asarray(img)
+                else:
+                    # As pasted in the composite, padded or cropped to the column
+                    column = np.asarray(composite.crop((self.width * j, 0, self.width * (j + 1), self.height)))
+                entry = (img, self.histogram(column))
+                self._histograms[key] = entry
+                if len(self._histograms) > self.max_entries:
+                    self._histograms.popitem(last=False)
+                self.misses += 1
+            total += entry[1]
+        return total
+
+    def correction(self, composite, images):
+        """
+        Return a color correction reference of `composite` for `p.color_corrections`: a 1 x N
+        LAB array whose channels have the same values as those of the composite, so that the
+        WebUI matches the same histograms as with `processing.setup_color_correction(composite)`.
+
+        Args:
+            composite: The composite built from `images`.
+            images: The column images, from left to right.
+        """
+
+        counts = self.histograms(composite, images)
+        return np.stack([np.repeat(self._levels, counts[channel]) for channel in range(3)], axis=-1)[None]
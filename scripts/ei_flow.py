@@ -0,0 +1,131 @@
+# Author: OedoSoldier [大江户战士]
+# https://space.bilibili.com/55123
+
+import numpy as np
+from PIL import Image
+
+# Warp error (in levels of 255) at which a warped keyframe pixel counts half as
+# much in the blend of an in-between frame
+ERROR_SCALE = 8.0
+
+
+class FlowWarper(object):
+    """
+    Synthesizes in-between frames by warping keyframes along the optical flow of their reference
+    frames, on the CPU with the DIS optical flow of OpenCV.
+
+    The flow is estimated between the reference frame of the in-between frame and the reference
+    frame of each keyframe, and applied to the rendered keyframes. Where a keyframe warps badly
+    (occlusions, new content), its pixels get less weight in the blend. The same warp applied to
+    the reference frames gives the error of the synthesized frame, measured against its own
+    reference frame, before anything is rendered.
+    """
+
+    def __init__(self):
+        try:
+            import cv2
+        except ImportError:
+            raise ImportError('OpenCV (opencv-python) is needed to synthesize in-between frames')
+        self.cv2 = cv2
+        self._dis = cv2.DISOpticalFlow_create(cv2.DISOPTICAL_FLOW_PRESET_MEDIUM)
+        self._grid = None
+
+    def flow(self, source, target):
+        """
+        Return the flow between two L images as an H x W x 2 array, so that `source` at x looks
+        like `target` at x + flow(x).
+        """
+
+        return self._dis.calc(np.asarray(source), np.asarray(target), None)
+
+    def warp(self, values, flow):
+        """
+        Return the H x W x C array `values` sampled at x + flow(x).
+        """
+
+        h, w = flow.shape[:2]
+        if self._grid is None or self._grid.shape[:2] != (h, w):
+            x, y = np.meshgrid(np.arange(w, dtype=np.float32), np.arange(h, dtype=np.float32))
+            self._grid = np.stack([x, y], axis=-1)
+        coords = self._grid + flow
+        return self.cv2.remap(
+            values, coords[..., 0], coords[..., 1], self.cv2.INTER_LINEAR, borderMode=self.cv2.BORDER_REPLICATE)
+
+    def inbetween(self, reference, keys):
+        """
+        Synthesize a frame from the keyframes `keys` and return it with its error.
+
+        Args:
+            reference: The reference frame of the frame to synthesize, a PIL image.
+            keys: A list of `(reference, output, weight)`, with the reference frame of a keyframe,
+                  its rendered output of the same size or None, and its weight in the blend, e.g.
+                  the distance to the other keyframe.
+
+        Returns:
+            `(image, error)`: the synthesized RGB frame, or None if no output was given, and the
+            mean difference between the reference frame and the reference frames of the keys
+            warped and blended the same way, from 0 to 1.
+        """
+
+        target = np.asarray(reference.convert('RGB'), dtype=np.float32)
+        gray = reference.convert('L')
+        total, references, outputs = 0.0, 0.0, 0.0
+        for key_reference, key_output, weight in keys:
+            flow = self.flow(gray, key_reference.convert('L'))
+            warped = self.warp(np.asarray(key_reference.convert('RGB')), flow).astype(np.float32)
+            error = np.abs(warped - target).mean(axis=2, keepdims=True)
+            pixel_weight = weight / (1 + error / ERROR_SCALE)
+            total = total + pixel_weight
+            references = references + warped * pixel_weight
+            if key_output is not None:
+                outputs = outputs + self.warp(np.asarray(key_output.convert('RGB')), flow) * pixel_weight
+        error = float(np.abs(references / total - target).mean()) / 255
+        if keys[0][1] is None:
+            return None, error
+        output = np.clip(outputs / total + 0.5, 0, 255).astype(np.uint8)
+        return Image.fromarray(output, 'RGB'), error
+
+
+def plan_keyframes(warper, reference, first, end, interval, threshold, adaptive=False):
+    """
+    Choose the frames to render among the frames `first` to `end` (excluded); the others are
+    synthesized from the keyframes around them. The first and the last frame are keyframes.
+
+    Args:
+        warper: A `FlowWarper`.
+        reference: A function returning the reference frame of a frame index, as a PIL image.
+        first: The first frame, already rendered or rendered first.
+        end: The end of the frames.
+        interval: The distance between two keyframes, or the largest one in adaptive mode.
+        threshold: The largest error of a synthesized frame, see `FlowWarper.inbetween()`. A
+                   frame that cannot be synthesized within it is rendered (a fallback keyframe).
+        adaptive: Place each keyframe as far as its previous keyframe warps within `threshold`,
+                  instead of every `interval` frames. (default: False)
+
+    Returns:
+        `(keyframes, fallbacks)`: the sorted keyframe indexes and the number of fallback keyframes.
+    """
+
+    interval = max(1, int(interval))
+    last = end - 1
+    if adaptive:
+        keys, a = [first], first
+        while a < last:
+            b = a + 1
+            for j in range(a + 1, min(a + interval, last) + 1):
+                _, error = warper.inbetween(reference(j), [(reference(a), None, 1)])
+                if error > threshold:
+                    break
+                b = j
+            keys.append(b)
+            a = b
+    else:
+        keys = list(range(first, last, interval)) + [last]
+
+    fallbacks = []
+    for a, b in zip(keys, keys[1:]):
+        for j in range(a + 1, b):
+            _, error = warper.inbetween(reference(j), [(reference(a), None, b - j), (reference(b), None, j - a)])
+            if error > threshold:
+                fallbacks.append(j)
+    return sorted(keys + fallbacks), len(fallbacks)
@@ -0,0 +1,153 @@
+# Author: OedoSoldier [大江户战士]
+# https://space.bilibili.com/55123
+
+import os
+import re
+
+IMAGE_EXTENSIONS = ('.jpg', '.png')
+
+re_frame_number = re.compile(r'(\d+)\.[^.]*$')
+re_frame_range = re.compile(r'(^\d*)-(\d*$)')
+
+
+def frame_key(filename):
+    """
+    Return the frame key of a file: the number right before its extension, or its name without
+    extension if there is none (e.g. `image_233.png` -> 233, `image_a.png` -> 'image_a').
+    """
+
+    filename = os.path.basename(filename)
+    match = re_frame_number.search(filename)
+    if match:
+        return int(match.group(1))
+    return os.path.splitext(filename)[0]
+
+
+def key_order(key):
+    # Numbered frames first, in numeric order, then named ones
+    return (isinstance(key, str), key)
+
+
+class FrameIndex(object):
+    """
+    Index of the frame files of a directory by frame key.
+
+    The directory is listed once with `os.scandir` and every filename is parsed once. Files are
+    kept sorted by key, and paths can be looked up by key in constant time, so the input, mask,
+    ControlNet and text directories of a job can be matched frame by frame without listing them
+    again.
+
+    Attributes:
+        directory: The indexed directory.
+        keys: The frame keys, sorted.
+        paths: The paths of the frames, in the same order as `keys`.
+        duplicates: A dict mapping every key shared by several files to all of their paths. The
+                    first path in filename order is the one that is indexed.
+    """
+
+    def __init__(self, directory, extensions=IMAGE_EXTENSIONS):
+        self.directory = directory
+
+        entries = []
+        with os.scandir(directory) as it:
+            for entry in it:
+                if entry.name.endswith(extensions) and entry.is_file():
+                    entries.append((frame_key(entry.name), entry.name, entry.path))
+        self._index(entries)
+
+    def _index(self, entries):
+        # `entries` are (key, filename, path) tuples, in any order
+        entries.sort(key=lambda x: (key_order(x[0]), x[1]))
+
+        self.keys, self.paths = [], []
+        self.duplicates = {}
+        self._path_by_key = {}
+        for key, _, path in entries:
+            if key in self._path_by_key:
+                self.duplicates.setdefault(key, [self._path_by_key[key]]).append(path)
+                continue
+            self._path_by_key[key] = path
+            self.keys.append(key)
+            self.paths.append(path)
+        self._key_by_path = dict(zip(self.paths, self.keys))
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __iter__(self):
+        return iter(self.paths)
+
+    def __contains__(self, key):
+        return key in self._path_by_key
+
+    def __getitem__(self, key):
+        return self._path_by_key[key]
+
+    def get(self, key, default=None):
+        return self._path_by_key.get(key, default)
+
+    def key_of(self, path):
+        """
+        Return the frame key of `path`, without parsing it again if it belongs to this index.
+        """
+
+        key = self._key_by_path.get(path)
+        return key if key is not None else frame_key(path)
+
+    def missing(self, keys):
+        """
+        Return the keys among `keys` that have no file in this index.
+        """
+
+        return [key for key in keys if key not in self._path_by_key]
+
+    def select(self, specified):
+        """
+        Select frames with the "Files to process" syntax: a comma (or space) separated list of
+        filenames, frame numbers and ranges such as `233-235`, `-235` or `233-`.
+
+        Args:
+            specified: The selection. An empty string selects every frame.
+
+        Returns:
+            The selected paths, in the given order. Numbers without a file are skipped.
+        """
+
+        if specified == '':
+            return list(self.paths)
+
+        numbers = [key for key in self.keys if not isinstance(key, str)]
+        by_name = {os.path.basename(path): path for path in self.paths}
+        paths = []
+        sep = ',' if ',' in specified else ' '
+        for i in specified.split(sep):
+            i = i.strip()
+            if i == '':
+                continue
+            if i in by_name or i in self._key_by_path:
+                paths.append(by_name.get(i, i))
+                continue
+            match = re_frame_range.search(i)
+            if match:
+                start, end = match.groups()
+                start = int(start) if start != '' else (numbers[0] if numbers else 0)
+                end = int(end) if end != '' else (numbers[-1] if numbers else -1)
+                paths += [self._path_by_key[j] for j in range(start, end + 1) if j in self._path_by_key]
+            else:
+                paths.append(self._path_by_key[int(i) if i.isdigit() else i])
+        return paths
+
+    def report(self, name, keys=None):
+        """
+        Print the duplicate keys of this index and, if `keys` is given, the keys it lacks.
+        """
+
+        for key, paths in self.duplicates.items():
+            print(f'{name}: frame {key} matches several files, using {os.path.basename(paths[0])}: '
+                  f'{", ".join(os.path.basename(path) for path in paths)}')
+        if keys is not None:
+            missing = self.missing(keys)
+            if missing:
+                shown = ', '.join(str(key) for key in missing[:10])
+                more = f' and {len(missing) - 10} more' if len(missing) > 10 else ''
+                print(f'{name}: no file for {len(missing)} frame(s): {shown}{more}')
@@ -0,0 +1,214 @@
+# Author: OedoSoldier [大江户战士]
+# https://space.bilibili.com/55123
+
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+
+LEASE_DIR_NAME = '.ei_leases'
+
+
+def worker_name():
+    """
+    Return a name for this process that is unique across the machines sharing a directory.
+    """
+
+    return f'{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}'
+
+
+class LeaseManager(object):
+    """
+    Claim chunks of a job through lease files in a directory shared by several workers.
+
+    Chunk `i` is claimed by creating `{i}.{generation}.lease` with `O_CREAT | O_EXCL`, which
+    succeeds for exactly one worker even on a shared filesystem. A background thread refreshes
+    the modification time of the held leases every `ttl / 4` seconds. A lease that has not been
+    refreshed for `ttl` seconds belongs to a dead worker, and the chunk is reclaimed by creating
+    the next generation, which again only one worker can do. A finished chunk gets a
+    `{i}.done` marker and is never claimed again.
+
+    The clocks of the machines must agree to well within `ttl`.
+
+    Attributes:
+        directory: The lease directory.
+        worker: The name of this worker, stored in its leases.
+        ttl: The number of seconds after which a lease that was not refreshed expires.
+    """
+
+    def __init__(self, directory, ttl=120, worker=None):
+        self.directory = directory
+        self.worker = worker or worker_name()
+        self.ttl = ttl
+        self._held = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._heartbeat = None
+
+        os.makedirs(directory, exist_ok=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    def _lease_path(self, chunk, generation):
+        return os.path.join(self.directory, f'{chunk:06d}.{generation}.lease')
+
+    def _done_path(self, chunk):
+        return os.path.join(self.directory, f'{chunk:06d}.done')
+
+    def _latest(self, chunk):
+        # Generations are created in order, so probing them one by one costs a
+        # single stat for the chunks that were never reclaimed
+        generation, stat = -1, None
+        while True:
+            try:
+                next_stat = os.stat(self._lease_path(chunk, generation + 1))
+            except FileNotFoundError:
+                return generation, stat
+            generation, stat = generation + 1, next_stat
+
+    def is_done(self, chunk):
+        return os.path.exists(self._done_path(chunk))
+
+    def claim(self, chunk):
+        """
+        Try to claim `chunk`. Return True if this worker now holds it, False if it is done or held
+        by a live worker, or if another worker claimed it first.
+        """
+
+        if self.is_done(chunk):
+            return False
+        generation, stat = self._latest(chunk)
+        if stat is not None and time.time() - stat.st_mtime < self.ttl:
+            return False
+        path = self._lease_path(chunk, generation + 1)
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump({'worker': self.worker, 'chunk': chunk, 'generation': generation + 1,
+                       'reclaimed': generation >= 0, 'time': time.time()}, f)
+        with self._lock:
+            self._held[chunk] = generation + 1
+        self._start_heartbeat()
+        return True
+
+    def holds(self, chunk):
+        """
+        Return whether this worker still holds `chunk`, i.e. it was not reclaimed by another
+        worker after the lease expired.
+        """
+
+        with self._lock:
+            generation = self._held.get(chunk)
+        return generation is not None and not os.path.exists(self._lease_path(chunk, generation + 1))
+
+    def mark_done(self, chunk):
+        """
+        Mark `chunk` as finished and drop its lease.
+        """
+
+        with self._lock:
+            generation = self._held.get(chunk)
+        with open(self._done_path(chunk), 'w', encoding='utf-8') as f:
+            json.dump({'worker': self.worker, 'generation': generation, 'time': time.time()}, f)
+        self.release(chunk)
+
+    def reopen(self, chunk):
+        """
+        Drop the `.done` marker of `chunk`, e.g. when its outputs were deleted, so that it is
+        claimed again.
+        """
+
+        try:
+            os.remove(self._done_path(chunk))
+        except FileNotFoundError:
+            pass
+
+    def release(self, chunk):
+        """
+        Drop the lease of `chunk` so another worker can claim it right away. A lease that was
+        reclaimed by another worker is left in place.
+        """
+
+        with self._lock:
+            generation = self._held.pop(chunk, None)
+        # Removing an older generation would hide the newer ones from
+        # `_latest()`, and the chunk could be claimed while it is still held
+        if generation is not None and self._latest(chunk)[0] == generation:
+            try:
+                os.remove(self._lease_path(chunk, generation))
+            except FileNotFoundError:
+                pass
+
+    def claims(self, chunks, interrupted=None, poll=None):
+        """
+        Claim chunks in order and yield each claimed chunk. The caller renders it, then calls
+        `mark_done()` or `release()`.
+
+        Once nothing is left to claim, the chunks held by other workers are polled until they are
+        done, so that a chunk abandoned by a dead worker is picked up when its lease expires.
+
+        Args:
+            chunks: The chunk numbers.
+            interrupted: A function returning True to stop. (default: None)
+            poll: The number of seconds between two polls. (default: `ttl / 4`)
+        """
+
+        chunks = list(chunks)
+        poll = poll if poll is not None else self.ttl / 4
+        while chunks:
+            remaining = []
+            claimed = False
+            for chunk in chunks:
+                if interrupted is not None and interrupted():
+                    return
+                if self.is_done(chunk):
+                    continue
+                if self.claim(chunk):
+                    claimed = True
+                    yield chunk
+                    if not self.is_done(chunk):
+                        remaining.append(chunk)
+                else:
+                    remaining.append(chunk)
+            chunks = remaining
+            if chunks and not claimed:
+                if interrupted is not None and interrupted():
+                    return
+                time.sleep(poll)
+
+    def _start_heartbeat(self):
+        if self._heartbeat is None:
+            self._heartbeat = threading.Thread(target=self._beat, name='ei_leases', daemon=True)
+            self._heartbeat.start()
+
+    def _beat(self):
+        while not self._stop.wait(self.ttl / 4):
+            with self._lock:
+                held = list(self._held.items())
+            for chunk, generation in held:
+                try:
+                    os.utime(self._lease_path(chunk, generation))
+                except FileNotFoundError:
+                    pass
+
+    def close(self):
+        """
+        Stop the heartbeat and release every chunk still held.
+        """
+
+        self._stop.set()
+        if self._heartbeat is not None:
+            self._heartbeat.join()
+            self._heartbeat = None
+        with self._lock:
+            held = list(self._held)
+        for chunk in held:
+            self.release(chunk)
@@ -0,0 +1,153 @@
+# Author: OedoSoldier [大江户战士]
+# https://space.bilibili.com/55123
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+from scripts.ei_video import frame_array, open_frame
+
+# Quarter turns of `np.rot90` matching the PIL transpositions used to rotate frames
+ROTATION_TURNS = {
+    Image.Transpose.ROTATE_90: 1,
+    Image.Transpose.ROTATE_180: 2,
+    Image.Transpose.ROTATE_270: 3,
+}
+
+
+def mask_values(mask):
+    """
+    Return the last channel of a mask image (the alpha channel of RGBA or LA masks) as a 2D
+    uint8 array.
+    """
+
+    band = mask.getchannel(len(mask.getbands()) - 1)
+    if band.mode != 'L':
+        band = band.convert('L')
+    return np.asarray(band)
+
+
+def binary_mask(mask, threshold, mode='RGBA'):
+    """
+    Threshold the last channel of `mask` and return it as an RGBA mask whose four channels are
+    255 where the value is greater than `threshold` and 0 elsewhere, or as a single L channel,
+    a quarter of the size, with `mode='L'`.
+    """
+
+    band = mask.getchannel(len(mask.getbands()) - 1)
+    if band.mode != 'L':
+        band = band.convert('L')
+    # A lookup table thresholds the channel without intermediate arrays
+    threshold = min(255, max(-1, int(threshold)))
+    a = band.point([0] * (threshold + 1) + [255] * (255 - threshold))
+    return a if mode == 'L' else Image.merge('RGBA', (a, a, a, a))
+
+
+def mask_stats(values, threshold):
+    """
+    Return (x0, y0, x1, y1, area) of the pixels of `values` greater than `threshold`, or zeros
+    if there are none.
+    """
+
+    binary = values > threshold
+    area = int(np.count_nonzero(binary))
+    if area == 0:
+        return (0, 0, 0, 0, 0)
+    rows = np.flatnonzero(binary.any(axis=1))
+    cols = np.flatnonzero(binary.any(axis=0))
+    return (int(cols[0]), int(rows[0]), int(cols[-1]) + 1, int(rows[-1]) + 1, area)
+
+
+class MaskTable(object):
+    """
+    The bounding box and area of the mask of every frame, as an N x 5 int32 array.
+
+    Each row is (x0, y0, x1, y1, area) in the coordinates of the (rotated) mask. Blank masks have
+    an area of 0 and missing or unreadable masks a row of -1, so frames can be skipped, cropped or
+    scheduled without decoding their masks again.
+
+    Attributes:
+        keys: The frame keys, in the order of the rows.
+        rows: The N x 5 array.
+    """
+
+    COLUMNS = ('x0', 'y0', 'x1', 'y1', 'area')
+    MISSING = (-1, -1, -1, -1, -1)
+
+    def __init__(self, keys, rows):
+        self.keys = list(keys)
+        self.rows = np.asarray(rows, dtype=np.int32).reshape(-1, len(self.COLUMNS))
+        self._index = {key: i for i, key in enumerate(self.keys)}
+
+    @classmethod
+    def build(cls, keys, paths, threshold, transpose=None, workers=4):
+        """
+        Decode the masks on a thread pool and build their table.
+
+        Args:
+            keys: The frame keys.
+            paths: The mask file (or video frame) of each key, or None if it has none.
+            threshold: Values greater than the threshold are part of the mask.
+            transpose: The PIL transposition applied to the frames, or None. (default: None)
+            workers: The number of decoding threads. (default: 4)
+        """
+
+        turns = ROTATION_TURNS.get(transpose, 0)
+
+        def stats(path):
+            if path is None:
+                return cls.MISSING
+            values = frame_array(path)
+            if values is not None:
+                # The last channel of a stored mask, a view of the store
+                values = values[..., -1]
+            else:
+                try:
+                    with open_frame(path) as mask:
+                        values = mask_values(mask)
+                except (OSError, ValueError):
+                    return cls.MISSING
+            # A rotated view, the reductions do not copy it
+            return mask_stats(np.rot90(values, turns) if turns else values, threshold)
+
+        with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix='ei_masks') as executor:
+            rows = list(executor.map(stats, paths))
+        return cls(keys, rows)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def row(self, key):
+        """
+        Return the row of `key` as a tuple, or None if it is not in the table.
+        """
+
+        i = self._index.get(key)
+        return tuple(int(v) for v in self.rows[i]) if i is not None else None
+
+    def bbox(self, key):
+        """
+        Return the bounding box of the mask of `key`, or None if it is blank, missing or unknown.
+        """
+
+        row = self.row(key)
+        return row[:4] if row is not None and row[4] > 0 else None
+
+    def area(self, key):
+        row = self.row(key)
+        return row[4] if row is not None else -1
+
+    def is_missing(self, key):
+        return self.area(key) < 0
+
+    def is_blank(self, key):
+        return self.area(key) == 0
+
+    def summary(self):
+        area = self.rows[:, 4]
+        return (f'{len(self)} mask(s), {int(np.count_nonzero(area == 0))} blank, '
+                f'{int(np.count_nonzero(area < 0))} missing')
@@ -0,0 +1,103 @@
+# Author: OedoSoldier [大江户战士]
+# https://space.bilibili.com/55123
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+from scripts.ei_video import open_frame
+
+# Width of the thumbnails frames are compared on
+SIGNATURE_WIDTH = 64
+
+# Bins per channel of the color histograms scene cuts are detected on
+HISTOGRAM_BINS = 16
+
+# Scenes shorter than this are merged into the previous one, e.g. a flash or a
+# few frames of a transition
+MIN_SCENE_LENGTH = 8
+
+
+def frame_signature(img, width=SIGNATURE_WIDTH):
+    """
+    Return a small grayscale thumbnail of `img` as a 2D float32 array, to compare frames cheaply.
+    """
+
+    w, h = img.size
+    size = (width, max(1, round(h * width / w)))
+    # `reducing_gap` shrinks by an integer factor first, which is much cheaper than
+    # filtering the full frame
+    thumb = img.resize(size, Image.BOX, reducing_gap=2.0)
+    if thumb.mode != 'L':
+        thumb = thumb.convert('L')
+    return np.asarray(thumb, dtype=np.float32)
+
+
+def frame_difference(a, b):
+    """
+    Return the mean absolute difference of two signatures from `frame_signature()`, from 0 for
+    identical frames to 1.
+    """
+
+    return float(np.abs(a - b).mean()) / 255
+
+
+def sequence_thumbnails(paths, width=SIGNATURE_WIDTH, workers=4):
+    """
+    Decode the frames `paths` on a thread pool and return their RGB thumbnails as an
+    N x H x W x 3 uint8 array. Every thumbnail has the aspect ratio of the first frame.
+    """
+
+    with open_frame(paths[0]) as img:
+        w, h = img.size
+    size = (width, max(1, round(h * width / w)))
+
+    def thumbnail(path):
+        with open_frame(path) as img:
+            # Lets JPEG frames decode at a fraction of their size
+            img.draft('RGB', size)
+            thumb = img.resize(size, Image.BOX, reducing_gap=2.0)
+        return np.asarray(thumb.convert('RGB') if thumb.mode != 'RGB' else thumb)
+
+    with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix='ei_scenes') as executor:
+        return np.stack(list(executor.map(thumbnail, paths)))
+
+
+def histogram_distances(thumbs, bins=HISTOGRAM_BINS):
+    """
+    Return the distance between the color histograms of every two consecutive thumbnails of
+    `thumbs` (see `sequence_thumbnails()`), from 0 for the same colors to 1 for no color in
+    common. Unlike a pixel difference, it barely changes with motion inside a scene.
+    """
+
+    n, h, w, _ = thumbs.shape
+    # One bincount over the whole sequence: every frame and channel gets
+    # its own range of bins
+    index = thumbs.astype(np.intp) * bins // 256
+    index += np.arange(3) * bins
+    index += (np.arange(n) * 3 * bins)[:, None, None, None]
+    hist = np.bincount(index.ravel(), minlength=n * 3 * bins).reshape(n, 3 * bins)
+    return np.abs(np.diff(hist, axis=0)).sum(axis=1) / (2 * 3 * h * w)
+
+
+def scene_cuts(distances, threshold, min_length=MIN_SCENE_LENGTH, start=0):
+    """
+    Return the indexes of the frames that start a new scene, given the `histogram_distances()`
+    of a sequence.
+
+    Args:
+        distances: The distances between consecutive frames, the entry `i` between the frames
+                   `i` and `i + 1`.
+        threshold: The distance from the previous frame at which a frame starts a new scene.
+        min_length: The minimum number of frames of a scene, a cut closer to the previous one
+                    is dropped. (default: `MIN_SCENE_LENGTH`)
+        start: The first frame of the first scene, the frames before it are ignored. (default: 0)
+    """
+
+    cuts, last = [], start
+    for i in np.flatnonzero(np.asarray(distances) >= threshold) + 1:
+        if i > start and i - last >= min_length:
+            cuts.append(int(i))
+            last = i
+    return cuts
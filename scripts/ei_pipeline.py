@@ -0,0 +1,281 @@
+# Author: OedoSoldier [大江户战士]
+# https://space.bilibili.com/55123
+
+import bisect
+import collections
+import hashlib
+import re
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+
+class Frame(object):
+    """
+    A prepared unit of work for the Enhanced img2img loop.
+
+    Attributes:
+        path: Path of the input file, also used to name the output.
+        img: The image handed to `process_images`, cropped if "Zoom in masked area" is used.
+        raw: The full, uncropped frame used to restore a cropped output, or None.
+        mask: The (cropped) L mask, or None when no mask is used.
+        crop_info: The crop geometry returned by `CropUtils.crop_img`, or None.
+        cn_images: The ControlNet inputs of the frame, or None.
+        prompt: The final prompt of the frame.
+        tags: The DeepDanbooru tags of the frame when they are carried over to the next frame, or None.
+        key: The batch key; consecutive frames with equal keys may share one `process_images` call.
+        bucket: The side of the resolution bucket a zoomed-in crop is generated at, or None to use
+                the img2img size.
+        fingerprint: The fingerprint of the frame's inputs and settings when resuming, or None.
+        digest: The digests of the pixels the frame is generated from once computed, or None.
+    """
+
+    __slots__ = ('path', 'img', 'raw', 'mask', 'crop_info', 'cn_images', 'prompt', 'tags', 'key', 'bucket', 'fingerprint', 'digest')
+
+    def __init__(self, path, img, raw=None, mask=None, crop_info=None, cn_images=None):
+        self.path = path
+        self.img = img
+        self.raw = raw
+        self.mask = mask
+        self.crop_info = crop_info
+        self.cn_images = cn_images
+        self.prompt = None
+        self.tags = None
+        self.key = None
+        self.bucket = None
+        self.fingerprint = None
+        self.digest = None
+
+
+def image_digest(img):
+    """
+    Return a digest of the pixels of a PIL image, or None if `img` is None.
+    """
+
+    if img is None:
+        return None
+    h = hashlib.sha1()
+    h.update(f'{img.mode}:{img.size[0]}x{img.size[1]}'.encode())
+    h.update(img.tobytes())
+    return h.hexdigest()
+
+
+def parse_buckets(text):
+    """
+    Parse a comma (or space) separated list of bucket sizes, e.g. '512, 768, 1024'. Sizes are
+    rounded down to multiples of 8 and returned sorted, without duplicates.
+    """
+
+    sizes = set()
+    for size in re.split(r'[,\s]+', text.strip()):
+        if size == '':
+            continue
+        size = int(float(size)) // 8 * 8
+        if size <= 0:
+            raise ValueError(f'Invalid bucket size: {size}')
+        sizes.add(size)
+    return sorted(sizes)
+
+
+def bucket_of(side, buckets):
+    """
+    Return the smallest bucket of `buckets` (sorted) that is at least `side`, or the largest one.
+    """
+
+    i = bisect.bisect_left(buckets, side)
+    return buckets[min(i, len(buckets) - 1)]
+
+
+def iter_batches(items, batch_size, key=None):
+    """
+    Group consecutive items into lists of at most `batch_size` elements.
+
+    Args:
+        items: An iterable of items.
+        batch_size: The maximum number of items per batch.
+        key: Optional function; a new batch is started whenever its value changes
+             between two consecutive items.
+
+    Yields:
+        Lists of items, in the original order.
+    """
+
+    batch_size = max(1, int(batch_size))
+    batch, batch_key = [], None
+    for item in items:
+        item_key = key(item) if key is not None else None
+        if batch and item_key != batch_key:
+            yield batch
+            batch = []
+        if not batch:
+            batch_key = item_key
+        batch.append(item)
+        # A full batch is yielded right away, without pulling the next item
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class MemoryBudget(object):
+    """
+    Bounds the estimated memory of the items held by a pipeline, e.g. the decoded frames being
+    prepared ahead, waiting in a batch or queued to be written.
+
+    Items are admitted with `try_acquire()` or `acquire()` and given back with `release()` once
+    they are processed. An item handed over to another thread (e.g. an image writer) that
+    releases it later is `retire()`d, so `acquire()` knows it can wait for it. An item that does
+    not fit is only admitted by `acquire()` when nothing retired is left to wait for, so a single
+    item larger than the budget still goes through, alone.
+
+    Attributes:
+        max_bytes: The budget, or 0 for no limit.
+        cost: A function returning the estimated number of bytes of an item.
+        used: The bytes currently held.
+        peak: The most bytes held at once.
+    """
+
+    def __init__(self, max_bytes, cost):
+        self.max_bytes = max_bytes
+        self.cost = cost
+        self.used = 0
+        self.peak = 0
+        self._held = {}
+        self._retired = set()
+        self._changed = threading.Condition()
+
+    def _hold(self, item, nbytes):
+        self._held[item] = self._held.get(item, 0) + nbytes
+        self.used += nbytes
+        self.peak = max(self.peak, self.used)
+
+    def _fits(self, nbytes):
+        return not self.used or self.used + nbytes <= self.max_bytes
+
+    def try_acquire(self, item):
+        """
+        Hold `item` and return True if its cost fits in the budget, else return False.
+        """
+
+        nbytes = self.cost(item) if self.max_bytes else 0
+        with self._changed:
+            if not self._fits(nbytes):
+                return False
+            self._hold(item, nbytes)
+            return True
+
+    def acquire(self, item):
+        """
+        Hold `item`, waiting for the retired items to be released while it does not fit.
+        """
+
+        nbytes = self.cost(item) if self.max_bytes else 0
+        with self._changed:
+            while not self._fits(nbytes) and self._retired:
+                self._changed.wait()
+            self._hold(item, nbytes)
+
+    def retire(self, item):
+        """
+        Mark `item` as handed over to a thread that releases it later.
+        """
+
+        with self._changed:
+            if item in self._held:
+                self._retired.add(item)
+
+    def release(self, item):
+        with self._changed:
+            self.used -= self._held.pop(item, 0)
+            self._retired.discard(item)
+            self._changed.notify_all()
+
+    def clear(self):
+        with self._changed:
+            self._held.clear()
+            self._retired.clear()
+            self.used = 0
+            self._changed.notify_all()
+
+    def limit(self, nbytes):
+        """
+        Return how many items of `nbytes` fit in the budget, at least 1, or None without limit.
+        """
+
+        if not self.max_bytes:
+            return None
+        return max(1, self.max_bytes // max(1, nbytes))
+
+
+def prefetch(fn, items, depth=2, budget=None):
+    """
+    Apply `fn` to every item on a thread pool, running up to `depth` items ahead of the consumer.
+
+    Results are yielded in the original order as `(item, future)` pairs; call `future.result()`
+    to get the return value of `fn(item)` or to re-raise its exception. With `depth <= 0`,
+    `fn` is called on the calling thread right before its pair is yielded.
+
+    With a `MemoryBudget`, an item is only started ahead once it fits in the budget, so the depth
+    shrinks while earlier items are held. When the consumer asks for an item that was not
+    started, it is acquired with `MemoryBudget.acquire()`. The consumer releases the items from
+    the budget.
+
+    Closing the generator, e.g. by breaking out of the loop that consumes it, cancels every
+    item that has not been started yet. Items already running are left to finish in the
+    background.
+
+    Args:
+        fn: A callable taking one item. It must be safe to call from worker threads.
+        items: An iterable of items.
+        depth: The number of items prepared ahead of the one being consumed. (default: 2)
+        budget: A `MemoryBudget` the items are acquired from, or None. (default: None)
+    """
+
+    depth = int(depth)
+    if depth <= 0:
+        for item in items:
+            if budget is not None:
+                budget.acquire(item)
+            future = Future()
+            try:
+                future.set_result(fn(item))
+            except BaseException as e:
+                future.set_exception(e)
+            yield item, future
+        return
+
+    items = iter(items)
+    pending = collections.deque()
+    executor = ThreadPoolExecutor(max_workers=depth, thread_name_prefix='ei_prefetch')
+    # The next item, when it did not fit in the budget yet
+    waiting = []
+
+    def submit(wait=False):
+        item = waiting.pop() if waiting else next(items, waiting)
+        if item is waiting:
+            return False
+        if budget is not None:
+            if wait:
+                budget.acquire(item)
+            elif not budget.try_acquire(item):
+                waiting.append(item)
+                return False
+        pending.append((item, executor.submit(fn, item)))
+        return True
+
+    def fill():
+        while len(pending) <= depth and submit():
+            pass
+
+    try:
+        fill()
+        # The consumer asks for the next item, it is started once it fits
+        while pending or submit(wait=True):
+            item, future = pending.popleft()
+            fill()
+            yield item, future
+    finally:
+        for _, future in pending:
+            future.cancel()
+        pending.clear()
+        executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,175 @@
+# Author: OedoSoldier [大江户战士]
+# https://space.bilibili.com/55123
+
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+from PIL import Image
+
+RESULT_INDEX_NAME = 'index.sqlite3'
+
+
+def default_cache_dir(name):
+    """
+    Return the directory of the image cache `name` inside the extension folder.
+    """
+
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    return os.path.join(root, 'cache', name)
+
+
+class ResultCache(object):
+    """
+    On-disk cache of generated images, keyed by a fingerprint of everything they were generated
+    from (see `fingerprint`).
+
+    Images are stored as PNG files next to an SQLite index of their size, the time they were
+    last used and an optional dict of metadata. When the files exceed `max_bytes`, the least
+    recently used entries are removed. Several processes can share a cache.
+
+    Attributes:
+        directory: The cache directory.
+        max_bytes: The maximum total size of the stored files.
+        hits: The number of lookups served from the cache.
+        misses: The number of lookups that were not cached.
+        evictions: The number of entries removed to stay under `max_bytes`.
+    """
+
+    def __init__(self, directory, max_bytes=2 * 1024 * 1024 * 1024, compress_level=1):
+        """
+        Args:
+            directory: The cache directory, created if needed.
+            max_bytes: The maximum total size of the stored files. (default: 2 GB)
+            compress_level: The zlib level of the PNG files, low levels are much faster to
+                            write and a little larger. (default: 1)
+        """
+
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.compress_level = compress_level
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+        os.makedirs(directory, exist_ok=True)
+        self._db = sqlite3.connect(os.path.join(directory, RESULT_INDEX_NAME), check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS results ('
+            'key TEXT PRIMARY KEY, size INTEGER NOT NULL, used REAL NOT NULL, info TEXT)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS results_used ON results (used)')
+        self._db.commit()
+        self.nbytes = self._db.execute('SELECT COALESCE(SUM(size), 0) FROM results').fetchone()[0]
+        if self.nbytes > self.max_bytes:
+            # The size was lowered since the cache was filled
+            self._evict()
+            self._db.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM results').fetchone()[0]
+
+    def _path(self, key):
+        return os.path.join(self.directory, f'{key}.png')
+
+    def __contains__(self, key):
+        with self._lock:
+            return self._db.execute('SELECT 1 FROM results WHERE key = ?', (key,)).fetchone() is not None
+
+    def get(self, key):
+        """
+        Return the image stored under `key` and its metadata as `(image, info)`, or None.
+        """
+
+        if key is None:
+            return None
+        with self._lock:
+            row = self._db.execute('SELECT info FROM results WHERE key = ?', (key,)).fetchone()
+            if row is not None:
+                self._db.execute('UPDATE results SET used = ? WHERE key = ?', (time.time(), key))
+                self._db.commit()
+        img = None
+        if row is not None:
+            try:
+                with Image.open(self._path(key)) as f:
+                    img = f.copy()
+            except OSError:
+                # Evicted by another process in the meantime
+                img = None
+        with self._lock:
+            if img is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return img, json.loads(row[0]) if row[0] is not None else None
+
+    def put(self, key, img, info=None):
+        """
+        Store `img` and the JSON-serializable `info` under `key`, then evict the least recently
+        used entries if the cache is full. Safe to call from several threads.
+        """
+
+        if key is None:
+            return
+        path = self._path(key)
+        # Written under a name of its own, readers never see a partial file
+        # and writers of the same key in other processes do not collide
+        tmp = f'{path}.{os.getpid()}.{uuid.uuid4().hex}.tmp'
+        img.save(tmp, format='PNG', compress_level=self.compress_level)
+        os.replace(tmp, path)
+        size = os.path.getsize(path)
+        with self._lock:
+            # The total is read again in the write transaction, the other
+            # processes sharing the cache add to it too
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                self._db.execute(
+                    'INSERT OR REPLACE INTO results (key, size, used, info) VALUES (?, ?, ?, ?)',
+                    (key, size, time.time(), json.dumps(info, ensure_ascii=False) if info is not None else None))
+                self.nbytes = self._db.execute('SELECT COALESCE(SUM(size), 0) FROM results').fetchone()[0]
+                if self.nbytes > self.max_bytes:
+                    self._evict()
+            except BaseException:
+                self._db.rollback()
+                raise
+            self._db.commit()
+
+    def _evict(self):
+        # Drop the oldest entries down to 90% of the budget, so that a full
+        # cache does not evict on every insertion
+        target = self.max_bytes * 0.9
+        rows = self._db.execute('SELECT key, size FROM results ORDER BY used').fetchall()
+        evicted = []
+        for key, size in rows:
+            if self.nbytes <= target:
+                break
+            evicted.append((key,))
+            self.nbytes -= size
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+        self._db.executemany('DELETE FROM results WHERE key = ?', evicted)
+        self.evictions += len(evicted)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def summary(self):
+        total = self.hits + self.misses
+        rate = self.hits / total * 100 if total else 0
+        return (f'{self.hits} hits, {self.misses} misses ({rate:.0f}% hit rate), {self.evictions} evictions, '
+                f'{self.nbytes / 1024 / 1024:.0f} MB cached')
@@ -0,0 +1,156 @@
+# Author: OedoSoldier [大江户战士]
+# https://space.bilibili.com/55123
+
+import hashlib
+import json
+import os
+import threading
+
+MANIFEST_NAME = '.ei_manifest.jsonl'
+
+# Attributes of `p` that change what is generated
+P_FIELDS = (
+    'prompt',
+    'negative_prompt',
+    'styles',
+    'seed',
+    'subseed',
+    'subseed_strength',
+    'seed_resize_from_h',
+    'seed_resize_from_w',
+    'sampler_name',
+    'steps',
+    'cfg_scale',
+    'image_cfg_scale',
+    'width',
+    'height',
+    'denoising_strength',
+    'resize_mode',
+    'mask_blur',
+    'inpainting_fill',
+    'inpaint_full_res',
+    'inpaint_full_res_padding',
+    'inpainting_mask_invert',
+    'restore_faces',
+    'tiling',
+)
+
+
+def stable_repr(value):
+    """
+    Return a JSON-serializable version of `value` that only keeps plain data, so it can be hashed
+    consistently across runs. Other objects are replaced by their type name.
+    """
+
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    if isinstance(value, (list, tuple)):
+        return [stable_repr(v) for v in value]
+    if isinstance(value, dict):
+        return {str(k): stable_repr(v) for k, v in value.items()}
+    if hasattr(value, 'values') and hasattr(value.values, 'tolist'):
+        # pandas DataFrame, e.g. the tabular prompts
+        return stable_repr(value.values.tolist())
+    return type(value).__name__
+
+
+def fingerprint(*parts):
+    """
+    Return a hex digest of `parts`, which are passed through `stable_repr`.
+    """
+
+    data = json.dumps(stable_repr(parts), sort_keys=True, ensure_ascii=False)
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+
+def file_fingerprint(path):
+    """
+    Return the size and modification time of `path`, or None if it does not exist. A frame of a
+    video (see `VideoFrames`) gets those of the video and its frame name.
+    """
+
+    if path is None:
+        return None
+    try:
+        st = os.stat(path)
+    except OSError:
+        video = os.path.dirname(path)
+        if not os.path.isfile(video):
+            return None
+        st = os.stat(video)
+        return (st.st_size, st.st_mtime_ns, os.path.basename(path))
+    return (st.st_size, st.st_mtime_ns)
+
+
+def generation_params(p, script, *args):
+    """
+    Return the parameters of `p` that affect generation, the checkpoint hash, the arguments of the
+    other scripts (e.g. ControlNet units) and the given arguments of `script`, to be hashed by
+    `fingerprint`. Call this before the script modifies `p`.
+    """
+
+    params = {field: getattr(p, field, None) for field in P_FIELDS}
+    params['sd_model_hash'] = getattr(getattr(p, 'sd_model', None), 'sd_model_hash', None)
+    script_args = list(getattr(p, 'script_args', None) or [])
+    args_from, args_to = getattr(script, 'args_from', None), getattr(script, 'args_to', None)
+    if args_from is not None and args_to is not None:
+        del script_args[args_from:args_to]
+    params['script_args'] = script_args
+    params['args'] = args
+    return stable_repr(params)
+
+
+class RunManifest(object):
+    """
+    Append-only record of the outputs written to a directory and the fingerprint of the inputs and
+    settings they were generated from.
+
+    An output counts as done when the manifest has an entry with the same fingerprint, and the
+    output file still has the size and modification time recorded when it was written. Checking
+    this costs a dictionary lookup and one `os.stat`, and never decodes an image.
+    """
+
+    def __init__(self, output_dir, name=MANIFEST_NAME):
+        self.output_dir = output_dir
+        self.path = os.path.join(output_dir, name)
+        self.entries = {}
+        self._lock = threading.Lock()
+
+        if os.path.isfile(self.path):
+            with open(self.path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                        self.entries[entry['filename']] = entry
+                    except (ValueError, KeyError):
+                        # A line cut short by an interrupted run
+                        continue
+
+    def get(self, filename, fingerprint):
+        """
+        Return the entry of `filename` if it is done with `fingerprint`, or None.
+        """
+
+        entry = self.entries.get(filename)
+        if entry is None or entry['fingerprint'] != fingerprint:
+            return None
+        output = file_fingerprint(os.path.join(self.output_dir, filename))
+        if output is None or list(output) != entry['output']:
+            return None
+        return entry
+
+    def record(self, filename, fingerprint, **extra):
+        """
+        Record that `filename` was written from inputs with `fingerprint`. Extra keyword arguments
+        are stored in the entry. Safe to call from the writer threads.
+        """
+
+        output = file_fingerprint(os.path.join(self.output_dir, filename))
+        if output is None:
+            return
+        entry = dict(extra, filename=filename, fingerprint=fingerprint, output=list(output))
+        line = json.dumps(entry, ensure_ascii=False) + '\n'
+        with self._lock:
+            self.entries[filename] = entry
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(line)
@@ -0,0 +1,257 @@
+# Author: OedoSoldier [大江户战士]
+# https://space.bilibili.com/55123
+
+import hashlib
+import json
+import os
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+from scripts.ei_resume import file_fingerprint
+from scripts.ei_video import decode_frame, frame_header, use_store
+
+STORE_INDEX_NAME = 'index.json'
+STORE_VERSION = 1
+
+# Modes stored as they are, with one uint8 per band. Frames in other modes are not stored.
+STORE_MODES = ('L', 'LA', 'RGB', 'RGBA')
+
+
+def default_store_dir(source):
+    """
+    Return the store directory of the frame source `source` inside the extension folder.
+    """
+
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    digest = hashlib.sha1(os.path.abspath(source).encode('utf-8')).hexdigest()[:16]
+    return os.path.join(root, 'cache', 'frames', digest)
+
+
+class FrameStore(object):
+    """
+    The decoded frames of a directory or video file, in memory-mapped uint8 arrays.
+
+    Frames of the same size and mode share a chunk, an N x H x W x C `.npy` file, so a sequence
+    of one resolution is a single array. `index.json` maps the filename of every frame to its
+    chunk and row, with the size and modification time of its file when it was stored. Frames are
+    read as views of the mapped chunks, without decoding or copying them. A frame whose file
+    changed since it was stored counts as not stored and is decoded from the file until the
+    store is updated by `ingest()`.
+
+    Attributes:
+        directory: The store directory.
+        source: The absolute path of the stored directory or video file.
+        frames: A dict mapping the filename of every stored frame to its index entry.
+        chunks: A dict mapping the name of every chunk to its size, mode and number of frames.
+        ingested: The number of frames decoded by the last `ingest()`.
+        reused: The number of frames kept from the previous store by the last `ingest()`.
+        skipped: The number of frames left out by the last `ingest()`, in another mode or unreadable.
+    """
+
+    def __init__(self, directory, source):
+        self.directory = directory
+        self.source = os.path.abspath(source)
+        self.frames = {}
+        self.chunks = {}
+        self.ingested = 0
+        self.reused = 0
+        self.skipped = 0
+        self._arrays = {}
+        self._lock = threading.Lock()
+
+        path = os.path.join(directory, STORE_INDEX_NAME)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            return
+        if index.get('version') == STORE_VERSION and index.get('source') == self.source:
+            self.frames = index['frames']
+            self.chunks = index['chunks']
+
+    def __len__(self):
+        return len(self.frames)
+
+    def _chunk(self, name):
+        with self._lock:
+            chunk = self._arrays.get(name)
+            if chunk is None:
+                try:
+                    chunk = np.load(os.path.join(self.directory, name), mmap_mode='r')
+                except (OSError, ValueError):
+                    # Removed by another worker updating the store
+                    chunk = False
+                self._arrays[name] = chunk
+            return chunk if chunk is not False else None
+
+    def _entry(self, path):
+        # The entry of `path` if it is stored and its file did not change
+        entry = self.frames.get(os.path.basename(path))
+        if entry is None:
+            return None
+        current = file_fingerprint(path)
+        if current is None or list(current) != entry['file']:
+            return None
+        return entry
+
+    def array(self, path):
+        """
+        Return the frame `path` as a read-only H x W x C view of its chunk, or None if it is not
+        stored or its file changed.
+        """
+
+        entry = self._entry(path)
+        if entry is None:
+            return None
+        chunk = self._chunk(entry['chunk'])
+        return chunk[entry['row']] if chunk is not None else None
+
+    def image(self, path):
+        """
+        Return the frame `path` as a PIL.Image object, or None if it is not stored or its file
+        changed. L and RGBA frames share the memory of the store and are read-only: Pillow copies
+        them before the first modification. Other modes are copied.
+        """
+
+        values = self.array(path)
+        if values is None:
+            return None
+        mode = self.chunks[self.frames[os.path.basename(path)]['chunk']]['mode']
+        # Pillow maps L and RGBA pixels, and unpacks the others straight from the map in one copy
+        return Image.frombuffer(mode, (values.shape[1], values.shape[0]), values, 'raw', mode, 0, 1)
+
+    def close(self):
+        with self._lock:
+            self._arrays.clear()
+
+    def summary(self):
+        nbytes = sum(
+            chunk['count'] * chunk['size'][0] * chunk['size'][1] * len(chunk['mode'])
+            for chunk in self.chunks.values())
+        return (f'{self.ingested} frame(s) ingested, {self.reused} reused, {self.skipped} not stored, '
+                f'{len(self.frames)} frames in {len(self.chunks)} chunk(s) / {nbytes / 1024 / 1024:.0f} MB')
+
+    @classmethod
+    def ingest(cls, index, directory=None, workers=4):
+        """
+        Bring the store of the frame source `index` up to date and return it.
+
+        The frames whose files did not change are copied from the previous chunks, the others
+        are decoded on a thread pool. Nothing is written when every frame is up to date. The new
+        chunks and index are written under new names and replace the previous ones at once, so a
+        store can be read while it is updated.
+
+        Args:
+            index: The `FrameIndex` or `VideoFrames` of the source, see `frame_source()`.
+            directory: The store directory. (default: `default_store_dir()` of the source)
+            workers: The number of decoding threads. (default: 4)
+        """
+
+        directory = directory or default_store_dir(index.directory)
+        store = cls(directory, index.directory)
+
+        frames, skipped = [], 0
+        for path in index:
+            fingerprint = file_fingerprint(path)
+            if store._entry(path) is not None:
+                entry = store.frames[os.path.basename(path)]
+                chunk = store.chunks[entry['chunk']]
+                frames.append((path, fingerprint, tuple(chunk['size']), chunk['mode'], entry))
+                continue
+            try:
+                size, mode = frame_header(path)
+            except (OSError, ValueError):
+                size, mode = None, None
+            if mode not in STORE_MODES:
+                skipped += 1
+                continue
+            frames.append((path, fingerprint, size, mode, None))
+
+        reused = sum(1 for frame in frames if frame[4] is not None)
+        if reused == len(frames) == len(store.frames):
+            store.reused, store.skipped = reused, skipped
+            return store
+
+        os.makedirs(directory, exist_ok=True)
+        generation = uuid.uuid4().hex[:8]
+        chunks, rows, layout = {}, {}, {}
+        for path, fingerprint, size, mode, _ in frames:
+            name = f'{generation}_{size[0]}x{size[1]}_{mode}.npy'
+            chunk = chunks.setdefault(name, {'size': list(size), 'mode': mode, 'count': 0})
+            rows[path] = (name, chunk['count'])
+            chunk['count'] += 1
+        for name, chunk in chunks.items():
+            (w, h), bands = chunk['size'], len(chunk['mode'])
+            layout[name] = np.lib.format.open_memmap(
+                os.path.join(directory, name + '.tmp'), mode='w+', dtype=np.uint8,
+                shape=(chunk['count'], h, w, bands))
+
+        def write(frame):
+            path, fingerprint, size, mode, entry = frame
+            name, row = rows[path]
+            target = layout[name][row]
+            if entry is not None:
+                source = store._chunk(entry['chunk'])
+                if source is not None:
+                    target[...] = source[entry['row']]
+                    return True
+            with decode_frame(path) as img:
+                if img.size != size or img.mode != mode:
+                    return False
+                target[...] = np.asarray(img).reshape(target.shape)
+            return True
+
+        with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix='ei_store') as executor:
+            written = list(executor.map(write, frames))
+
+        entries = {}
+        for frame, ok in zip(frames, written):
+            path, fingerprint = frame[:2]
+            if not ok or fingerprint is None:
+                skipped += 1
+                continue
+            name, row = rows[path]
+            entries[os.path.basename(path)] = {'chunk': name, 'row': row, 'file': list(fingerprint)}
+        for name, values in layout.items():
+            values.flush()
+        layout.clear()
+        for name in chunks:
+            os.replace(os.path.join(directory, name + '.tmp'), os.path.join(directory, name))
+
+        index_path = os.path.join(directory, STORE_INDEX_NAME)
+        with open(f'{index_path}.{generation}.tmp', 'w', encoding='utf-8') as f:
+            json.dump({'version': STORE_VERSION, 'source': store.source, 'chunks': chunks, 'frames': entries}, f)
+        os.replace(f'{index_path}.{generation}.tmp', index_path)
+
+        previous = set(store.chunks)
+        store.close()
+        for name in previous - set(chunks):
+            try:
+                os.remove(os.path.join(directory, name))
+            except OSError:
+                # Still mapped by a reader on Windows, left for the next update
+                pass
+
+        updated = cls(directory, index.directory)
+        updated.ingested = len(entries) - reused
+        updated.reused, updated.skipped = reused, skipped
+        return updated
+
+
+def use_stores(indexes, workers=4):
+    """
+    Update the store of every distinct frame source of `indexes` with `FrameStore.ingest()` and
+    read their frames from it until `close_videos()`.
+    """
+
+    sources = {}
+    for index in indexes:
+        sources.setdefault(index.directory, index)
+    for source, index in sources.items():
+        store = FrameStore.ingest(index, workers=workers)
+        print(f'Frame store of {source}: {store.summary()}')
+        use_store(source, store)
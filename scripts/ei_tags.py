@@ -0,0 +1,194 @@
+# Author: OedoSoldier [大江户战士]
+# https://space.bilibili.com/55123
+
+import os
+import sqlite3
+import threading
+import time
+
+from scripts.ei_pipeline import image_digest
+from scripts.ei_resume import fingerprint
+
+TAG_CACHE_NAME = 'tag_cache.sqlite3'
+
+# Options of the WebUI settings that change what the taggers return
+TAGGER_OPTION_PREFIXES = ('interrogate_', 'deepbooru_')
+
+
+def default_cache_path():
+    """
+    Return the tag cache path inside the extension folder.
+    """
+
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    return os.path.join(root, 'cache', TAG_CACHE_NAME)
+
+
+def tagger_options(data, prefixes=TAGGER_OPTION_PREFIXES):
+    """
+    Return the entries of a settings dict (usually `opts.data`) that affect tagging.
+    """
+
+    return {k: v for k, v in sorted(data.items()) if k.startswith(prefixes)}
+
+
+class TagCache(object):
+    """
+    On-disk cache of image tags, keyed by a hash of the image content, the tagger and its settings.
+
+    Entries are stored in an SQLite database. When the stored tags exceed `max_bytes`, the least
+    recently used entries are removed.
+
+    Attributes:
+        path: The database file.
+        max_bytes: The maximum total size of the stored keys and tags.
+        hits: The number of lookups served from the cache.
+        misses: The number of lookups that were not cached.
+        evictions: The number of entries removed to stay under `max_bytes`.
+    """
+
+    def __init__(self, path=None, max_bytes=64 * 1024 * 1024):
+        self.path = path or default_cache_path()
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        # Cheap commits, and readers in other processes are not blocked by a run
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS tags ('
+            'key TEXT PRIMARY KEY, tags TEXT NOT NULL, size INTEGER NOT NULL, used REAL NOT NULL)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS tags_used ON tags (used)')
+        self._db.commit()
+        self.nbytes = self._db.execute('SELECT COALESCE(SUM(size), 0) FROM tags').fetchone()[0]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM tags').fetchone()[0]
+
+    def get(self, key):
+        """
+        Return the tags stored under `key`, or None.
+        """
+
+        with self._lock:
+            row = self._db.execute('SELECT tags FROM tags WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._db.execute('UPDATE tags SET used = ? WHERE key = ?', (time.time(), key))
+            self._db.commit()
+            return row[0]
+
+    def put(self, key, tags):
+        """
+        Store `tags` under `key`, then evict the least recently used entries if the cache is full.
+        """
+
+        size = len(key) + len(tags.encode('utf-8'))
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            row = self._db.execute('SELECT size FROM tags WHERE key = ?', (key,)).fetchone()
+            if row is not None:
+                self.nbytes -= row[0]
+            self._db.execute(
+                'INSERT OR REPLACE INTO tags (key, tags, size, used) VALUES (?, ?, ?, ?)',
+                (key, tags, size, time.time()))
+            self.nbytes += size
+            if self.nbytes > self.max_bytes:
+                self._evict()
+            self._db.commit()
+
+    def _evict(self):
+        # Drop the oldest entries down to 90% of the budget, so that a full
+        # cache does not evict on every insertion
+        target = self.max_bytes * 0.9
+        rows = self._db.execute('SELECT key, size FROM tags ORDER BY used').fetchall()
+        evicted = []
+        for key, size in rows:
+            if self.nbytes <= target:
+                break
+            evicted.append((key,))
+            self.nbytes -= size
+        self._db.executemany('DELETE FROM tags WHERE key = ?', evicted)
+        self.evictions += len(evicted)
+
+    def clear(self):
+        with self._lock:
+            self._db.execute('DELETE FROM tags')
+            self._db.commit()
+            self.nbytes = 0
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def summary(self):
+        total = self.hits + self.misses
+        rate = self.hits / total * 100 if total else 0
+        return (f'{self.hits} hits, {self.misses} misses ({rate:.0f}% hit rate), {self.evictions} evictions, '
+                f'{self.nbytes / 1024:.0f} KB cached')
+
+
+class CachedTagger(object):
+    """
+    Wraps a tagging function with a `TagCache`.
+
+    The model is only started, with `start`, on the first image that is not cached, so a run whose
+    tags are all cached never loads it. `close()` stops it again. It can be called from several
+    threads, the model is only called from one at a time.
+    """
+
+    def __init__(self, name, tag, cache, options=None, start=None, stop=None):
+        """
+        Args:
+            name: The identity of the tagger, e.g. 'DeepBooru' or 'CLIP'.
+            tag: The function returning the tags of a PIL.Image as a string.
+            cache: The `TagCache`.
+            options: The settings that change the tags, see `tagger_options`. (default: None)
+            start: A function loading the model, called before the first uncached image. (default: None)
+            stop: A function unloading the model, called by `close()` if it was loaded. (default: None)
+        """
+
+        self.name = name
+        self.cache = cache
+        self._tag = tag
+        self._start = start
+        self._stop = stop
+        self._started = False
+        self._lock = threading.Lock()
+        self._prefix = fingerprint(name, options)
+
+    def key(self, img):
+        return fingerprint(self._prefix, image_digest(img))
+
+    def __call__(self, img):
+        key = self.key(img)
+        tags = self.cache.get(key)
+        if tags is None:
+            with self._lock:
+                if self._start is not None and not self._started:
+                    self._start()
+                    self._started = True
+                tags = self._tag(img)
+            self.cache.put(key, tags)
+        return tags
+
+    def close(self):
+        with self._lock:
+            if self._started and self._stop is not None:
+                self._stop()
+            self._started = False
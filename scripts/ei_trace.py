@@ -0,0 +1,170 @@
+# Author: OedoSoldier [大江户战士]
+# https://space.bilibili.com/55123
+
+import contextlib
+import json
+import os
+import threading
+import time
+import tracemalloc
+import uuid
+
+import numpy as np
+
+TRACE_NAME = '.ei_trace.jsonl'
+
+_NULL_STAGE = contextlib.nullcontext()
+
+# psutil's handle on this process, False when psutil is not installed
+_process = None
+
+
+def current_rss():
+    """
+    Return the resident set size of this process in bytes, or None if it cannot be read.
+    """
+
+    global _process
+    if _process is None:
+        try:
+            import psutil
+            _process = psutil.Process()
+        except ImportError:
+            _process = False
+    if _process:
+        return _process.memory_info().rss
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+class _Stage(object):
+    __slots__ = ('tracer', 'name', 'frame', 'start', 'rss', 'allocated')
+
+    def __init__(self, tracer, name, frame):
+        self.tracer = tracer
+        self.name = name
+        self.frame = frame
+
+    def __enter__(self):
+        if self.tracer.memory:
+            self.rss = current_rss()
+            self.allocated = tracemalloc.get_traced_memory()[0]
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        seconds = time.perf_counter() - self.start
+        extra = {}
+        if self.tracer.memory:
+            rss = current_rss()
+            if rss is not None and self.rss is not None:
+                extra['rss_delta'] = rss - self.rss
+            extra['alloc_delta'] = tracemalloc.get_traced_memory()[0] - self.allocated
+        if exc_type is not None:
+            extra['error'] = exc_type.__name__
+        self.tracer.record(self.name, seconds, self.frame, **extra)
+
+
+class Tracer(object):
+    """
+    Records the wall time of the stages of a run, per frame, to a JSONL file.
+
+    Wrap a stage with `with tracer.stage('decode', filename):`. A disabled tracer returns a shared
+    no-op context manager, so the instrumentation can stay in place at the cost of a method call.
+
+    With `memory`, the RSS and the Python allocations (through `tracemalloc`, which slows down
+    allocation-heavy code) before and after each stage are recorded too. Both are process-wide,
+    so stages running at the same time on other threads are included in the deltas.
+
+    Attributes:
+        path: The trace file, or None to only keep the summary.
+        enabled: Whether stages are recorded.
+        memory: Whether memory deltas are recorded.
+        run: A random identifier of the run, stored in every record.
+    """
+
+    def __init__(self, path=None, enabled=True, memory=False):
+        self.path = path
+        self.enabled = enabled
+        self.memory = enabled and memory
+        self.run = uuid.uuid4().hex[:8]
+        self._durations = {}
+        self._memory = {}
+        self._lock = threading.Lock()
+        self._file = None
+        self._started_tracemalloc = False
+
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracemalloc = True
+        if enabled and path is not None:
+            self._file = open(path, 'a', encoding='utf-8')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    def stage(self, name, frame=None):
+        """
+        Return a context manager recording the duration of the stage `name` of `frame`.
+        """
+
+        if not self.enabled:
+            return _NULL_STAGE
+        return _Stage(self, name, frame)
+
+    def record(self, name, seconds, frame=None, **extra):
+        """
+        Record that the stage `name` of `frame` took `seconds`. Extra keyword arguments are
+        stored in the record.
+        """
+
+        if not self.enabled:
+            return
+        entry = dict(run=self.run, frame=frame, stage=name, ms=round(seconds * 1000, 3), **extra)
+        line = json.dumps(entry, ensure_ascii=False) + '\n'
+        with self._lock:
+            self._durations.setdefault(name, []).append(seconds)
+            if 'rss_delta' in extra or 'alloc_delta' in extra:
+                self._memory.setdefault(name, []).append(extra.get('rss_delta', extra.get('alloc_delta')))
+            if self._file is not None:
+                self._file.write(line)
+
+    def summary(self):
+        """
+        Return a table of the count, total, p50, p95 and maximum duration of every stage, in the
+        order the stages were first recorded.
+        """
+
+        with self._lock:
+            durations = {name: np.array(values) * 1000 for name, values in self._durations.items()}
+            memory = {name: max(values) for name, values in self._memory.items()}
+        if not durations:
+            return 'No stage recorded'
+        width = max(len(name) for name in durations)
+        header = f'{"stage":<{width}} {"count":>6} {"total s":>9} {"p50 ms":>9} {"p95 ms":>9} {"max ms":>9}'
+        if memory:
+            header += f' {"max mem MB":>11}'
+        lines = [header]
+        for name, values in durations.items():
+            p50, p95 = np.percentile(values, [50, 95])
+            line = (f'{name:<{width}} {len(values):>6} {values.sum() / 1000:>9.2f} '
+                    f'{p50:>9.1f} {p95:>9.1f} {values.max():>9.1f}')
+            if memory:
+                line += f' {memory[name] / 1024 / 1024:>11.1f}' if name in memory else f' {"":>11}'
+            lines.append(line)
+        return '\n'.join(lines)
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+        if self._started_tracemalloc:
+            tracemalloc.stop()
+            self._started_tracemalloc = False
@@ -1,5 +1,4 @@
-import re
-import pandas as pd
+from scripts.ei_frames import frame_key, key_order
 
 
 def gr_show(visible=True):
@@ -12,6 +11,8 @@ def gr_show_value_none(visible=True):
 
 def gr_show_and_load(value=None, visible=True):
     if value:
+        # Only needed to load tables in the UI
+        import pandas as pd
         if value.orig_name.endswith('.csv'):
             value = pd.read_csv(value.name)
         else:
@@ -22,5 +23,4 @@ def gr_show_and_load(value=None, visible=True):
 
 
 def sort_images(lst):
-    pattern = re.compile(r"\d+(?=\.)(?!.*\d)")
-    return sorted(lst, key=lambda x: int(re.search(pattern, x).group()))
+    return sorted(lst, key=lambda x: key_order(frame_key(x)))
@@ -0,0 +1,256 @@
+# Author: OedoSoldier [大江户战士]
+# https://space.bilibili.com/55123
+
+import os
+import threading
+from collections import OrderedDict
+
+from PIL import Image
+
+from scripts.ei_frames import IMAGE_EXTENSIONS, FrameIndex
+
+VIDEO_EXTENSIONS = ('.mp4', '.m4v', '.mov', '.mkv', '.avi', '.webm', '.gif')
+
+# Animated formats Pillow decodes itself, the others need OpenCV
+PIL_VIDEO_EXTENSIONS = ('.gif',)
+
+# The open videos by path, so that frames can be opened from their path alone
+_videos = {}
+_videos_lock = threading.Lock()
+
+# The frame stores (see `scripts.ei_store`) by source, the frames they hold are read from them
+_stores = {}
+
+
+def is_video(path):
+    return path.lower().endswith(VIDEO_EXTENSIONS) and os.path.isfile(path)
+
+
+def sidecar_dir(path):
+    """
+    Return the directory of the files that go along with a frame source (e.g. the prompt text
+    files): the directory itself, or the one containing the video.
+    """
+
+    return os.path.dirname(path) if is_video(path) else path
+
+
+class _PILReader(object):
+    def __init__(self, path):
+        self.img = Image.open(path)
+        self.count = getattr(self.img, 'n_frames', 1)
+        self.size = self.img.size
+        self.position = 0
+
+    def seek(self, index):
+        self.position = index
+
+    def read(self):
+        self.img.seek(self.position)
+        self.position += 1
+        return self.img.convert('RGB')
+
+    def close(self):
+        self.img.close()
+
+
+class _OpenCVReader(object):
+    def __init__(self, path):
+        try:
+            import cv2
+        except ImportError:
+            raise ImportError(f'OpenCV (opencv-python) is needed to read {path}')
+        self.cv2 = cv2
+        self.capture = cv2.VideoCapture(path)
+        if not self.capture.isOpened():
+            raise OSError(f'Cannot open video {path}')
+        # Read from the container, it may be off by a few frames for some codecs
+        self.count = int(self.capture.get(cv2.CAP_PROP_FRAME_COUNT))
+        self.size = (int(self.capture.get(cv2.CAP_PROP_FRAME_WIDTH)), int(self.capture.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+
+    def seek(self, index):
+        self.capture.set(self.cv2.CAP_PROP_POS_FRAMES, index)
+
+    def read(self):
+        ok, frame = self.capture.read()
+        if not ok:
+            return None
+        return Image.fromarray(self.cv2.cvtColor(frame, self.cv2.COLOR_BGR2RGB))
+
+    def close(self):
+        self.capture.release()
+
+
+class VideoFrames(FrameIndex):
+    """
+    The frames of a video file, decoded on demand, with the interface of `FrameIndex`.
+
+    Frame `n` (from 1, as numbered by `ffmpeg -i video.mp4 %05d.png`) has the key `n` and the
+    virtual path `{video}/{n:05d}.png`, so it matches the masks, ControlNet inputs and prompt
+    files of that frame and is written to the output directory under the same name as an
+    extracted frame. Open frames with `open_frame()`.
+
+    Frames are decoded in order and the last `window` decoded frames are kept, so frames read
+    a little out of order by the prefetch threads are not decoded twice, and at most `window`
+    frames are held in memory. Reading a frame before the window or far after it seeks.
+
+    Attributes:
+        path: The video file.
+        size: The (width, height) of the frames.
+        window: The number of decoded frames kept.
+    """
+
+    def __init__(self, path, window=16):
+        self.path = path
+        self.window = max(1, window)
+        self._reader = (_PILReader if path.lower().endswith(PIL_VIDEO_EXTENSIONS) else _OpenCVReader)(path)
+        self._frames = OrderedDict()
+        self._position = 0
+        self._lock = threading.Lock()
+
+        self.size = self._reader.size
+        self.directory = path
+        names = [f'{n:05d}.png' for n in range(1, self._reader.count + 1)]
+        self._index([(n, name, os.path.join(path, name)) for n, name in enumerate(names, 1)])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    def _decode(self, index):
+        # Called with the lock held
+        if not self._position <= index < self._position + self.window:
+            self._reader.seek(index)
+            self._position = index
+        while self._position <= index:
+            frame = self._reader.read()
+            if frame is None:
+                raise EOFError(f'{self.path} has no frame {index + 1}')
+            self._frames[self._position] = frame
+            self._position += 1
+            while len(self._frames) > self.window:
+                self._frames.popitem(last=False)
+        return self._frames[index]
+
+    def frame(self, key):
+        """
+        Return a copy of frame `key`.
+        """
+
+        with self._lock:
+            frame = self._frames.get(key - 1)
+            if frame is None:
+                frame = self._decode(key - 1)
+            return frame.copy()
+
+    def open(self, path):
+        return self.frame(self.key_of(path))
+
+    def close(self):
+        with self._lock:
+            self._frames.clear()
+            self._reader.close()
+
+
+def _source_key(path):
+    # Sources are registered as given by the user and looked up from the
+    # directory of a frame path, normalized so that e.g. a trailing slash
+    # or a relative path finds the same source
+    return os.path.normpath(os.path.abspath(path))
+
+
+def frame_source(path, extensions=IMAGE_EXTENSIONS, window=16):
+    """
+    Return the frames of `path`: a `FrameIndex` of the directory, or the `VideoFrames` of the video
+    file, which stay open until `close_videos()`.
+    """
+
+    if not is_video(path):
+        return FrameIndex(path, extensions)
+    with _videos_lock:
+        video = _videos.get(_source_key(path))
+        if video is None:
+            video = _videos[_source_key(path)] = VideoFrames(path, window)
+        return video
+
+
+def use_store(source, store):
+    """
+    Read the frames of `source` (a directory or a video file) held by `store`, a `FrameStore`,
+    from it until `close_videos()`.
+    """
+
+    _stores[_source_key(source)] = store
+
+
+def frame_array(path):
+    """
+    Return a frame as a read-only H x W x C uint8 view of its frame store, or None if it is not
+    in a store or its file changed since it was stored.
+    """
+
+    store = _stores.get(_source_key(os.path.dirname(path)))
+    return store.array(path) if store is not None else None
+
+
+def decode_frame(path):
+    """
+    Open a frame from its path, a file or a frame of a video opened by `frame_source()`, without
+    looking into the frame stores.
+    """
+
+    video = _videos.get(_source_key(os.path.dirname(path)))
+    if video is None:
+        return Image.open(path)
+    return video.open(path)
+
+
+def open_frame(path):
+    """
+    Open a frame from its path: from its frame store if it is stored, else from its file or video.
+    """
+
+    store = _stores.get(_source_key(os.path.dirname(path)))
+    if store is not None:
+        img = store.image(path)
+        if img is not None:
+            return img
+    return decode_frame(path)
+
+
+def frame_header(path):
+    """
+    Return the (width, height) and mode of a frame from its path, without decoding it. Video
+    frames are RGB.
+    """
+
+    video = _videos.get(_source_key(os.path.dirname(path)))
+    if video is not None:
+        return video.size, 'RGB'
+    with Image.open(path) as img:
+        return img.size, img.mode
+
+
+def frame_size(path):
+    """
+    Return the (width, height, bands) of a frame from its path, without decoding it. Video frames
+    are RGB.
+    """
+
+    size, mode = frame_header(path)
+    return size + (Image.getmodebands(mode),)
+
+
+def close_videos():
+    """
+    Close the videos opened by `frame_source()` and stop reading from the frame stores.
+    """
+
+    _stores.clear()
+    with _videos_lock:
+        videos = list(_videos.values())
+        _videos.clear()
+    for video in videos:
+        video.close()
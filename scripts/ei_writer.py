@@ -0,0 +1,219 @@
+# Author: OedoSoldier [大江户战士]
+# https://space.bilibili.com/55123
+
+import os
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import piexif
+import piexif.helper
+from PIL import Image, PngImagePlugin
+
+# The output encoders of the scripts: the extension of the output files, or None to keep the
+# extension of the input file, and the arguments of `Image.save()`. Lower PNG levels and zlib
+# strategies encode several times faster, lossless WebP at its fastest method is faster still
+# (`exact` keeps the colors under transparent pixels), and uncompressed TIFF is for pipelines
+# that transcode the frames anyway.
+ENCODERS = {
+    'Same as input': (None, {}),
+    'PNG': ('.png', {'compress_level': 6}),
+    'PNG, fast (level 1, RLE)': ('.png', {'compress_level': 1, 'compress_type': zlib.Z_RLE}),
+    'PNG, Huffman only': ('.png', {'compress_level': 1, 'compress_type': zlib.Z_HUFFMAN_ONLY}),
+    'PNG, uncompressed': ('.png', {'compress_level': 0}),
+    'WebP, lossless': ('.webp', {'lossless': True, 'quality': 0, 'method': 0, 'exact': True}),
+    'TIFF, uncompressed': ('.tif', {}),
+}
+
+
+def output_filename(filename, encoder='Same as input'):
+    """
+    Return the name of the output of the input file `filename` written with `encoder`.
+    """
+
+    extension = ENCODERS[encoder][0]
+    if extension is None:
+        return filename
+    return os.path.splitext(filename)[0] + extension
+
+
+def save_image(image, path, pnginfo=None, encoder='Same as input', save_exif=True):
+    """
+    Save `image` to `path` with `encoder` (see `ENCODERS`), in the format given by the file
+    extension, with the metadata `pnginfo`: PNG files get every entry as a text chunk, JPEG/WebP
+    files the `parameters` entry as an EXIF user comment and TIFF files as their description.
+
+    Args:
+        image: The image to save, as a PIL.Image object.
+        path: The output path, see `output_filename()`.
+        pnginfo: A dict of metadata, usually `ImageSaveParams.pnginfo`. (default: None)
+        encoder: The name of the encoder. (default: 'Same as input')
+        save_exif: Whether to embed the parameters into JPEG/WebP/TIFF files, usually
+                   `opts.enable_pnginfo`. (default: True)
+    """
+
+    pnginfo = pnginfo or {}
+    options = ENCODERS[encoder][1]
+    extension = os.path.splitext(path)[1].lower()
+    info = pnginfo.get('parameters', None)
+
+    if extension == '.png':
+        pnginfo_data = PngImagePlugin.PngInfo()
+        for k, v in pnginfo.items():
+            pnginfo_data.add_text(k, str(v))
+        image.save(path, pnginfo=pnginfo_data, **options)
+
+    elif extension in ('.jpg', '.jpeg', '.webp'):
+        if save_exif and info is not None:
+            exif_bytes = piexif.dump({
+                'Exif': {
+                    piexif.ExifIFD.UserComment: piexif.helper.UserComment.dump(info or '', encoding='unicode')
+                },
+            })
+            image.save(path, exif=exif_bytes, **options)
+        else:
+            image.save(path, **options)
+
+    elif extension in ('.tif', '.tiff') and save_exif and info is not None:
+        image.save(path, description=info, **options)
+
+    else:
+        image.save(path, **options)
+
+
+def read_pnginfo(path):
+    """
+    Return the metadata written by `ImageWriter` into the file `path` as a dict: every text
+    chunk of a PNG file, or the `parameters` entry of a JPEG/WebP/TIFF file. Missing or
+    unreadable metadata gives an empty dict.
+    """
+
+    try:
+        with Image.open(path) as img:
+            if img.format == 'TIFF':
+                description = img.tag_v2.get(270)
+                return {'parameters': description} if isinstance(description, str) else {}
+            if 'exif' not in img.info:
+                return {k: v for k, v in getattr(img, 'text', {}).items() if isinstance(v, str)}
+            comment = piexif.load(img.info['exif'])['Exif'].get(piexif.ExifIFD.UserComment)
+    except (OSError, ValueError):
+        return {}
+    if comment is None:
+        return {}
+    try:
+        return {'parameters': piexif.helper.UserComment.load(comment)}
+    except ValueError:
+        return {}
+
+
+class ImageWriter(object):
+    """
+    Encode and save output images on a background thread pool.
+
+    Metadata is embedded while the image is encoded, see `save_image()`, so each file is written
+    exactly once.
+
+    `save()` blocks while `max_pending` images are waiting to be written, which bounds the memory
+    held by the queue. `flush()` waits for the queued images and `close()` for all writes to
+    finish. An error raised while writing is re-raised by the next call to `save()`, `flush()` or
+    `close()`.
+    """
+
+    def __init__(self, workers=2, max_pending=None, save_exif=True, tracer=None, encoder='Same as input'):
+        """
+        Args:
+            workers: The number of encoding threads. (default: 2)
+            max_pending: The maximum number of images queued or being written. (default: twice
+                         the number of threads, at least 4)
+            save_exif: Whether to embed the parameters into JPEG/WebP/TIFF files, usually
+                       `opts.enable_pnginfo`. (default: True)
+            tracer: A `Tracer` recording the time each file takes to encode and write as the
+                    'save' stage. (default: None)
+            encoder: The name of the encoder, see `ENCODERS`. The paths given to `save()` should
+                     come from `output_filename()`. (default: 'Same as input')
+        """
+
+        workers = max(1, int(workers))
+        if max_pending is None:
+            max_pending = max(4, 2 * workers)
+        self.save_exif = save_exif
+        self.encoder = encoder
+        self.tracer = tracer
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='ei_writer')
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._lock = threading.Lock()
+        self._error = None
+        self._pending = set()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    def save(self, image, path, pnginfo=None, callback=None):
+        """
+        Queue `image` to be written to `path`, with the format given by the file extension.
+
+        Args:
+            image: The image to save, as a PIL.Image object. It must not be modified or saved
+                   by the caller afterwards.
+            path: The output path.
+            pnginfo: A dict of metadata, usually `ImageSaveParams.pnginfo`. (default: None)
+            callback: A function called without arguments on the writer thread once the file is
+                      written. (default: None)
+        """
+
+        self._raise_error()
+        self._slots.acquire()
+        try:
+            future = self._executor.submit(self._write, image, path, dict(pnginfo or {}), callback)
+        except BaseException:
+            self._slots.release()
+            raise
+        with self._lock:
+            self._pending.add(future)
+        future.add_done_callback(self._done)
+
+    def flush(self):
+        """
+        Wait until every image queued so far is written.
+        """
+
+        with self._lock:
+            pending = list(self._pending)
+        wait(pending)
+        self._raise_error()
+
+    def close(self):
+        """
+        Wait until every queued image is written and stop the worker threads.
+        """
+
+        self._executor.shutdown(wait=True)
+        self._raise_error()
+
+    def _done(self, future):
+        with self._lock:
+            self._pending.discard(future)
+        self._slots.release()
+        if self._error is None and future.exception() is not None:
+            self._error = future.exception()
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def _write(self, image, path, pnginfo, callback):
+        if self.tracer is not None:
+            with self.tracer.stage('save', os.path.basename(path)):
+                self._encode(image, path, pnginfo)
+        else:
+            self._encode(image, path, pnginfo)
+
+        if callback is not None:
+            callback()
+
+    def _encode(self, image, path, pnginfo):
+        save_image(image, path, pnginfo, self.encoder, self.save_exif)
@@ -5,17 +5,29 @@ import math
 import os
 import sys
 import traceback
+import collections
 import copy
-import pandas as pd
+import functools
 
 import modules.scripts as scripts
 import gradio as gr
 
 from scripts.crop_utils import CropUtils
+from scripts.ei_frames import FrameIndex, key_order
+from scripts.ei_leases import LEASE_DIR_NAME, LeaseManager
+from scripts.ei_masks import MaskTable, binary_mask
+from scripts.ei_pipeline import Frame, MemoryBudget, bucket_of, image_digest, iter_batches, parse_buckets, prefetch
+from scripts.ei_results import ResultCache, default_cache_dir
+from scripts.ei_resume import RunManifest, file_fingerprint, fingerprint, generation_params
+from scripts.ei_store import use_stores
+from scripts.ei_tags import CachedTagger, TagCache, tagger_options
+from scripts.ei_trace import TRACE_NAME, Tracer
 from scripts.ei_utils import *
+from scripts.ei_video import VideoFrames, close_videos, frame_size, frame_source, open_frame, sidecar_dir
+from scripts.ei_writer import ENCODERS, ImageWriter, output_filename, save_image
 
-from modules.processing import Processed, process_images, create_infotext
-from PIL import Image, ImageFilter, PngImagePlugin
+from modules.processing import Processed, process_images, create_infotext, get_fixed_seed
+from PIL import Image, ImageFilter
 from modules.shared import opts, cmd_opts, state
 from modules.script_callbacks import ImageSaveParams, before_image_saved_callback
 from modules.sd_hijack import model_hijack
@@ -25,10 +37,6 @@ if cmd_opts.deepdanbooru:
 # import importlib.util
 import re
 
-re_findidx = re.compile(
-    r'(?=\S)(\d+)\.(?:[P|p][N|n][G|g]?|[J|j][P|p][G|g]?|[J|j][P|p][E|e][G|g]?|[W|w][E|e][B|b][P|p]?)\b')
-re_findname = re.compile(r'[\w-]+?(?=\.)')
-
 
 # def module_from_file(module_name, file_path):
 #     spec = importlib.util.spec_from_file_location(module_name, file_path)
@@ -68,6 +76,11 @@ class Script(scripts.Script):
             is_crop = gr.Checkbox(label='Zoom in masked area')
             use_cn = gr.Checkbox(label='Use another image as ControlNet input')
 
+        with gr.Row(visible=False) as crop_options:
+            crop_buckets = gr.Textbox(
+                label='Crop resolution buckets (e.g. 512, 768, 1024, leave empty to use the img2img size)',
+                lines=1)
+
         with gr.Row(visible=False) as cn_options:
             max_models = opts.data.get("control_net_max_models_num", 1)
             cn_dirs = []
@@ -103,6 +116,9 @@ class Script(scripts.Script):
             deepbooru_prev = gr.Checkbox(
                 label='Using contextual information',
                 visible=False)
+            pretag = gr.Checkbox(
+                label='Tag images ahead while generating',
+                visible=False)
 
         with gr.Row():
             is_rerun = gr.Checkbox(label='Loopback')
@@ -127,6 +143,77 @@ class Script(scripts.Script):
                 label='Denoising strength',
                 value=0.2)
 
+        with gr.Row(visible=False) as pass_options:
+            pass_major = gr.Checkbox(
+                label='Run the first pass of every image before the second passes, reusing cached first passes')
+            pass_chunk = gr.Slider(
+                minimum=0,
+                maximum=256,
+                step=1,
+                label='Images per first-pass chunk (0 for all images)',
+                value=16)
+            pass_cache_size = gr.Number(
+                label='First pass cache size in MB (0 to keep the first passes in memory only)',
+                value=2048,
+                precision=0)
+
+        with gr.Row():
+            result_cache = gr.Checkbox(
+                label='Generation cache: render identical images once and reuse the outputs of earlier runs')
+            result_cache_size = gr.Number(
+                label='Generation cache size in MB',
+                value=4096,
+                precision=0)
+
+        with gr.Row():
+            prefetch_depth = gr.Slider(
+                minimum=0,
+                maximum=16,
+                step=1,
+                label='Prefetch depth (images prepared in the background while generating, 0 to disable)',
+                value=2)
+            memory_budget = gr.Number(
+                label='Memory budget of the prepared images in MB (0 for no limit)',
+                value=0,
+                precision=0)
+
+        with gr.Row():
+            encoder = gr.Dropdown(
+                label='Output encoder',
+                choices=list(ENCODERS),
+                value='Same as input')
+            encoder_threads = gr.Slider(
+                minimum=1,
+                maximum=16,
+                step=1,
+                label='Encoding threads',
+                value=2)
+
+        with gr.Row():
+            frame_store = gr.Checkbox(
+                label='Frame store: keep the decoded input, mask and ControlNet frames in memory-mapped files for later runs')
+
+        with gr.Row():
+            resume = gr.Checkbox(
+                label='Resume: skip images already rendered to the output directory with the same settings')
+
+        with gr.Row():
+            trace = gr.Checkbox(
+                label='Write a timing trace of every stage to the output directory')
+            trace_memory = gr.Checkbox(
+                label='Include memory usage (slower)')
+
+        with gr.Row():
+            shard = gr.Checkbox(
+                label='Distributed: share the images with the other workers rendering to the same output directory')
+            chunk_size = gr.Slider(
+                minimum=1,
+                maximum=256,
+                step=1,
+                label='Images per chunk',
+                value=16,
+                visible=False)
+
         with gr.Row():
             use_txt = gr.Checkbox(label='Read tags from text files')
 
@@ -151,6 +238,11 @@ class Script(scripts.Script):
             inputs=[use_img_mask],
             outputs=[mask_options],
         )
+        is_crop.change(
+            fn=lambda x: gr_show(x),
+            inputs=[is_crop],
+            outputs=[crop_options],
+        )
         use_cn.change(
             fn=lambda x: gr_show(x),
             inputs=[use_cn],
@@ -162,9 +254,9 @@ class Script(scripts.Script):
             outputs=[specified_filename],
         )
         process_deepbooru.change(
-            fn=lambda x: gr_show(x),
+            fn=lambda x: [gr_show(x), gr_show(x)],
             inputs=[process_deepbooru],
-            outputs=[deepbooru_prev],
+            outputs=[deepbooru_prev, pretag],
         )
         use_csv.change(
             fn=lambda x: [gr_show_value_none(x), gr_show_value_none(False)],
@@ -176,10 +268,15 @@ class Script(scripts.Script):
             inputs=[csv_path],
             outputs=[table_content],
         )
-        is_rerun.change(
+        shard.change(
             fn=lambda x: gr_show(x),
+            inputs=[shard],
+            outputs=[chunk_size],
+        )
+        is_rerun.change(
+            fn=lambda x: [gr_show(x), gr_show(x)],
             inputs=[is_rerun],
-            outputs=[rerun_options],
+            outputs=[rerun_options, pass_options],
         )
 
         return [
@@ -190,6 +287,7 @@ class Script(scripts.Script):
             use_img_mask,
             as_output_alpha,
             is_crop,
+            crop_buckets,
             use_cn,
             alpha_threshold,
             rotate_img,
@@ -197,6 +295,7 @@ class Script(scripts.Script):
             specified_filename,
             process_deepbooru,
             deepbooru_prev,
+            pretag,
             use_txt,
             txt_path,
             use_csv,
@@ -205,6 +304,21 @@ class Script(scripts.Script):
             rerun_width,
             rerun_height,
             rerun_strength,
+            pass_major,
+            pass_chunk,
+            pass_cache_size,
+            result_cache,
+            result_cache_size,
+            prefetch_depth,
+            memory_budget,
+            encoder,
+            encoder_threads,
+            frame_store,
+            resume,
+            shard,
+            chunk_size,
+            trace,
+            trace_memory,
             *cn_dirs,]
 
     def run(
@@ -217,6 +331,7 @@ class Script(scripts.Script):
             use_img_mask,
             as_output_alpha,
             is_crop,
+            crop_buckets,
             use_cn,
             alpha_threshold,
             rotate_img,
@@ -224,6 +339,7 @@ class Script(scripts.Script):
             specified_filename,
             process_deepbooru,
             deepbooru_prev,
+            pretag,
             use_txt,
             txt_path,
             use_csv,
@@ -232,6 +348,21 @@ class Script(scripts.Script):
             rerun_width,
             rerun_height,
             rerun_strength,
+            pass_major,
+            pass_chunk,
+            pass_cache_size,
+            result_cache,
+            result_cache_size,
+            prefetch_depth,
+            memory_budget,
+            encoder,
+            encoder_threads,
+            frame_store,
+            resume,
+            shard,
+            chunk_size,
+            trace,
+            trace_memory,
             *cn_dirs):
 
         # crop_util = module_from_file(
@@ -242,17 +373,65 @@ class Script(scripts.Script):
             '180': Image.Transpose.ROTATE_180,
             '90': Image.Transpose.ROTATE_270}
 
+        if resume or shard:
+            run_params = generation_params(
+                p, self, use_mask, use_img_mask, as_output_alpha, is_crop, crop_buckets, use_cn, alpha_threshold,
+                rotate_img, process_deepbooru, deepbooru_prev, use_txt, use_csv, is_rerun,
+                rerun_width, rerun_height, rerun_strength)
+
+        pass_major = is_rerun and pass_major
+        first_pass_params = None
+        if pass_major:
+            # Everything the first pass depends on but the images and the
+            # per-image prompt and seeds, which are added to each key
+            first_pass_params = generation_params(p, self, rerun_width, rerun_height, rerun_strength)
+            for field in ('prompt', 'seed', 'subseed', 'width', 'height', 'denoising_strength'):
+                del first_pass_params[field]
+        result_params = None
+        if result_cache:
+            # Same for the outputs, which also depend on the second pass
+            result_params = generation_params(
+                p, self, use_mask, use_img_mask, is_rerun, rerun_width, rerun_height, rerun_strength)
+            for field in ('prompt', 'seed', 'subseed', 'width', 'height'):
+                del result_params[field]
+
         if use_mask:
             mask_dir = input_dir
             use_img_mask = True
             as_output_alpha = False
 
+        original_size = (copy.deepcopy(p.width), copy.deepcopy(p.height))
         if is_rerun:
             original_strength = copy.deepcopy(p.denoising_strength)
-            original_size = (copy.deepcopy(p.width), copy.deepcopy(p.height))
 
+        # Per-stage timings, a no-op unless enabled
+        tracer = Tracer(os.path.join(output_dir, TRACE_NAME), enabled=trace, memory=trace_memory)
+
+        tag_cache, tagger = None, None
         if process_deepbooru:
-            deepbooru.model.start()
+            # Tags are cached on disk by image content, the model is only
+            # loaded for images that were never tagged with these settings
+            tag_cache = TagCache()
+            tagger = CachedTagger(
+                'DeepBooru',
+                deepbooru.model.tag_multi,
+                tag_cache,
+                tagger_options(opts.data),
+                deepbooru.model.start,
+                deepbooru.model.stop)
+        tag_ahead = tagger is not None and pretag
+
+        first_passes = None
+        if pass_major and int(pass_cache_size or 0) > 0:
+            # First passes are kept on disk by a key of their inputs and
+            # settings, a rerun that only changes the second pass reuses them
+            first_passes = ResultCache(default_cache_dir('firstpass'), int(pass_cache_size) * 1024 * 1024)
+
+        results = None
+        if result_cache:
+            # Outputs are kept on disk by a key of their pixels and settings,
+            # identical frames of a run and of later runs are not generated again
+            results = ResultCache(default_cache_dir('results'), max(0, int(result_cache_size or 0)) * 1024 * 1024)
 
         if use_csv:
             prompt_list = [i[0] for i in table_content.values.tolist()]
@@ -263,331 +442,685 @@ class Script(scripts.Script):
                 ', ') + ', ' if not init_prompt.rstrip().endswith(',') else init_prompt.rstrip() + ' '
 
         initial_info = None
+        # A directory of frames or a video file
+        input_index = frame_source(input_dir)
         if given_file:
-            if specified_filename == '':
-                images = [os.path.join(
-                    input_dir,
-                    f) for f in os.listdir(input_dir) if re.match(
-                    r'.+\.(jpg|png)$',
-                    f)]
-            else:
-                images = []
-                images_in_folder = [os.path.join(
-                    input_dir,
-                    f) for f in os.listdir(input_dir) if re.match(
-                    r'.+\.(jpg|png)$',
-                    f)]
-                try:
-                    images_idx = [int(re.findall(re_findidx, j)[0])
-                                  for j in images_in_folder]
-                except BaseException:
-                    images_idx = [re.findall(re_findname, j)[0]
-                                  for j in images_in_folder]
-                images_in_folder_dict = dict(zip(images_idx, images_in_folder))
-                sep = ',' if ',' in specified_filename else ' '
-                for i in specified_filename.split(sep):
-                    if i in images_in_folder:
-                        images.append(i)
-                        start = end = i
-                    else:
-                        try:
-                            match = re.search(r'(^\d*)-(\d*$)', i)
-                            if match:
-                                start, end = match.groups()
-                                if start == '':
-                                    start = images_idx[0]
-                                if end == '':
-                                    end = images_idx[-1]
-                                images += [images_in_folder_dict[j]
-                                           for j in list(range(int(start), int(end) + 1))]
-                        except BaseException:
-                            images.append(images_in_folder_dict[int(i)])
-                if len(images) == 0:
-                    raise FileNotFoundError
-
+            images = input_index.select(specified_filename)
+            if len(images) == 0:
+                raise FileNotFoundError
+            images = sorted(images, key=lambda x: key_order(input_index.key_of(x)))
         else:
-            images = [
-                file for file in [
-                    os.path.join(
-                        input_dir,
-                        x) for x in os.listdir(input_dir)] if os.path.isfile(file)]
-        images = [f for f in images if re.match(r'.+\.(jpg|png)$', f)]
-        images = sorted(images)
+            images = list(input_index)
+        image_keys = [input_index.key_of(path) for path in images]
+        input_index.report('Input directory')
         print(f'Will process following files: {", ".join(images)}')
 
         if use_txt:
-            if txt_path == "":
-                files = [
-                    re.sub(
-                        r'\.(jpg|png|jpeg|webp)$',
-                        '.txt',
-                        path) for path in images]
-            else:
-                files = [
+            txt_index = FrameIndex(txt_path if txt_path != "" else sidecar_dir(input_dir), extensions=('.txt',))
+            files = [
+                txt_index.get(
+                    key,
                     os.path.join(
-                        txt_path,
+                        txt_index.directory,
                         os.path.basename(
                             re.sub(
                                 r'\.(jpg|png|jpeg|webp)$',
                                 '.txt',
-                                path))) for path in images]
+                                path)))) for key, path in zip(image_keys, images)]
             prompt_list = [open(file, 'r').read().rstrip('\n')
                            for file in files]
 
         if use_img_mask:
-            masks_in_folder = [
-                file for file in [
-                    os.path.join(
-                        mask_dir,
-                        x) for x in os.listdir(mask_dir)] if os.path.isfile(file)]
-            masks_in_folder = [f for f in masks_in_folder if re.match(r'.+\.(jpg|png)$', f)]
-            try:
-                masks = [
-                    re.findall(
-                        re_findidx,
-                        file)[0] for file in masks_in_folder if os.path.isfile(file)]
-            except BaseException:
-                masks = [
-                    re.findall(
-                        re_findname,
-                        file)[0] for file in masks_in_folder if os.path.isfile(file)]
-
-            masks_in_folder_dict = dict(zip(masks, masks_in_folder))
-
-        else:
-            masks = images
+            mask_index = input_index if mask_dir == input_dir else frame_source(mask_dir)
+            mask_index.report('Mask directory', image_keys)
 
         if use_cn:
-            cn_in_folder_dicts = []
+            cn_indexes = []
             for cn_dir in cn_dirs:
                 if cn_dir == '':
                     cn_dir = input_dir
-
-                cn_in_folder = [
-                    file for file in [
-                        os.path.join(
-                            cn_dir,
-                            x) for x in os.listdir(cn_dir)] if os.path.isfile(file)]
-                cn_in_folder = [f for f in cn_in_folder if re.match(r'.+\.(jpg|png)$', f)]
-
+                cn_index = input_index if cn_dir == input_dir else frame_source(cn_dir)
+                cn_index.report(f'ControlNet directory {cn_dir}', image_keys)
+                cn_indexes.append(cn_index)
+
+        if frame_store:
+            # Decoded once into memory-mapped files, which later runs read
+            # instead of decoding the frames again
+            use_stores(
+                [input_index] + ([mask_index] if use_img_mask else []) + (cn_indexes if use_cn else []),
+                workers=max(1, int(prefetch_depth)))
+
+        def mask_cost(key):
+            # Peak bytes of decoding the mask of a frame, taking its last
+            # channel and thresholding it
+            mask_path = mask_index.get(key)
+            if mask_path is None:
+                return 0
+            w, h, bands = frame_size(mask_path)
+            return w * h * (bands + 2)
+
+        def frame_cost(path):
+            # Estimated bytes of the decoded input, mask and ControlNet frames
+            # of an image, from the file headers
+            key = input_index.key_of(path)
+            try:
+                w, h, bands = frame_size(path)
+                nbytes = w * h * bands
+                if use_img_mask:
+                    nbytes += mask_cost(key)
+                if use_cn:
+                    nbytes += sum(math.prod(frame_size(cn_index[key])) for cn_index in cn_indexes if key in cn_index)
+            except OSError:
+                return 0
+            return nbytes
+
+        # Frames being prepared ahead or waiting in a batch stay within the
+        # budget, which also caps the batch size and the mask prepass
+        budget = MemoryBudget(max(0, int(memory_budget or 0)) * 1024 * 1024, frame_cost)
+
+        # Row of each image in the prompt list, one per input image like the
+        # text files, whether or not its mask is missing or blank
+        prompt_frames = {path: frame for frame, path in enumerate(images)}
+
+        manifest, fingerprints, done = None, {}, {}
+        if resume or shard:
+            # Fingerprints only need a stat per file, so finished frames are
+            # skipped without being decoded
+            for key, path in zip(image_keys, images):
+                frame = prompt_frames[path]
+                fingerprints[path] = fingerprint(
+                    run_params,
+                    file_fingerprint(path),
+                    file_fingerprint(mask_index.get(key)) if use_img_mask else None,
+                    [file_fingerprint(cn_index.get(key)) for cn_index in cn_indexes] if use_cn else None,
+                    prompt_list[frame] if (use_csv or use_txt) and frame < len(prompt_list) else None)
+        if resume:
+            manifest = RunManifest(output_dir)
+            for path in images:
+                entry = manifest.get(output_filename(os.path.basename(path), encoder), fingerprints[path])
+                if entry is not None:
+                    done[path] = entry
+            print(f'Resuming: {len(done)} of {len(images)} image(s) already rendered')
+
+        mask_table, skipped = None, 0
+        if use_img_mask and is_crop:
+            # Bounding boxes of every mask in one parallel prepass, frames
+            # with a blank or missing mask are known before generation
+            pending = [key for key, path in zip(image_keys, images) if path not in done]
+            workers = max(1, int(prefetch_depth))
+            if budget.max_bytes and pending:
                 try:
-                    cn_images_ = [
-                        re.findall(
-                            re_findidx,
-                            file)[0] for file in cn_in_folder if os.path.isfile(file)]
-                except BaseException:
-                    cn_images_ = [
-                        re.findall(
-                            re_findname,
-                            file)[0] for file in cn_in_folder if os.path.isfile(file)]
-
-                cn_in_folder_dict = dict(zip(cn_images_, cn_in_folder))
-                cn_in_folder_dicts.append(cn_in_folder_dict)
+                    workers = min(workers, budget.limit(mask_cost(pending[0])))
+                except OSError:
+                    pass
+            mask_table = MaskTable.build(
+                pending,
+                [mask_index.get(key) for key in pending],
+                alpha_threshold,
+                rotation_dict.get(rotate_img),
+                workers=workers)
+            skipped = int((mask_table.rows[:, 4] <= 0).sum())
+            print(f'Masks: {mask_table.summary()}')
+
+        buckets = parse_buckets(crop_buckets) if mask_table is not None else []
+        frame_buckets = {}
+        if buckets:
+            # Zoomed-in crops are generated at the smallest bucket that holds
+            # them, and frames of the same bucket are rendered back to back
+            for key, path in zip(image_keys, images):
+                bbox = mask_table.bbox(key)
+                if bbox is not None:
+                    frame_buckets[path] = bucket_of(max(bbox[2] - bbox[0], bbox[3] - bbox[1]), buckets)
+            if process_deepbooru and deepbooru_prev:
+                print('Crop buckets: keeping the frame order for contextual deepbooru prompts')
+            elif isinstance(input_index, VideoFrames):
+                print('Crop buckets: keeping the frame order to decode the video sequentially')
+            elif not shard:
+                # In distributed mode every worker must split the same list,
+                # chunks are reordered on their own instead
+                order = sorted(range(len(images)), key=lambda i: frame_buckets.get(images[i], 0))
+                images = [images[i] for i in order]
+                image_keys = [image_keys[i] for i in order]
+            print('Crop buckets: ' + ', '.join(
+                f'{b}: {n} image(s)' for b, n in sorted(collections.Counter(frame_buckets.values()).items())))
 
         p.img_len = 1
         p.do_not_save_grid = True
         p.do_not_save_samples = True
 
+        # Consecutive frames are grouped into batches of `p.batch_size` and
+        # rendered by a single `process_images` call.
+        batch_size = max(1, int(p.batch_size))
+
+        first_pending = next((path for path in images if path not in done), None)
+        limit = None
+        if budget.max_bytes and first_pending is not None:
+            limit = budget.limit(frame_cost(first_pending))
+            if limit < batch_size:
+                print(f'Memory budget: batches of at most {limit} image(s)')
+                batch_size = limit
+        if pass_major:
+            # The frames of a chunk are held until their second pass
+            pass_images = int(pass_chunk) if int(pass_chunk) > 0 else len(images)
+            if limit is not None and limit < pass_images:
+                print(f'Memory budget: first-pass chunks of at most {limit} image(s)')
+                pass_images = limit
+            batches_per_pass = max(1, math.ceil(pass_images / batch_size))
+        original_batch_size = p.batch_size
+        original_prompt = p.prompt
+        original_seed, original_subseed = p.seed, p.subseed
+        p.n_iter = 1
+        # Random seeds give new outputs on every run, they are not cached
+        fixed_seeds = original_seed != -1 and (original_subseed != -1 or not p.subseed_strength)
+        cached_seeds = first_passes is not None and fixed_seeds
+
         state.job_count = 1
 
         if process_deepbooru and deepbooru_prev:
             prev_prompt = ['']
 
-        frame = 0
-
         img_len = len(images)
         if is_rerun:
-            state.job_count *= 2 * len(images)
+            state.job_count *= 2 * math.ceil((len(images) - len(done) - skipped) / batch_size)
         else:
-            state.job_count *= len(images)
-
-        for idx, path in enumerate(images):
-            if state.interrupted:
-                break
-            batch_images = []
-            batched_raw = []
+            state.job_count *= math.ceil((len(images) - len(done) - skipped) / batch_size)
+
+        def record(path):
+            if manifest is not None:
+                manifest.record(output_filename(os.path.basename(path), encoder), fingerprints[path])
+
+        def prepare_frame(path):
+            # Runs on the prefetch threads: decode, rotate, mask and crop, and
+            # tag ahead with "Tag images ahead". Anything touching the model
+            # or `p` stays on the main thread.
+            if path in done:
+                return None
             cropped, mask, crop_info, cropped_cns, cn_images = None, None, None, None, None
-            print(f'Processing: {path}')
-            try:
-                img = Image.open(path)
-                try:
-                    to_process = re.findall(re_findidx, path)[0]
-                except BaseException:
-                    to_process = re.findall(re_findname, path)[0]
+            raw = None
+            filename = os.path.basename(path)
+            with tracer.stage('decode', filename):
+                img = open_frame(path)
+                img.load()
+                to_process = input_index.key_of(path)
                 if use_cn:
-                    cn_images = [Image.open(cn_in_folder_dict[to_process]) for cn_in_folder_dict in cn_in_folder_dicts]
-                if rotate_img != '0':
+                    cn_images = [open_frame(cn_index[to_process]) for cn_index in cn_indexes]
+                    for cn_image in cn_images:
+                        cn_image.load()
+            if rotate_img != '0':
+                with tracer.stage('rotate', filename):
                     img = img.transpose(rotation_dict[rotate_img])
                     if use_cn:
                         cn_images = [cn_image.transpose(rotation_dict[rotate_img]) for cn_image in cn_images]
-                if use_img_mask:
+            if use_img_mask:
+                if mask_table is not None and mask_table.area(to_process) <= 0:
+                    # Known from the prepass, the mask is not decoded again
+                    mask, status = None, 'not found' if mask_table.is_missing(to_process) else 'blank'
+                else:
                     try:
-                        mask = Image.open(masks_in_folder_dict[to_process])
-                        a = mask.split()[-1].convert('L').point(
-                            lambda x: 255 if x > alpha_threshold else 0)
-                        mask = Image.merge('RGBA', (a, a, a, a.convert('L')))
+                        with tracer.stage('mask', filename):
+                            mask_path = mask_index[to_process]
+                            if mask_path == path:
+                                # The input's own alpha channel, already decoded and rotated
+                                mask = binary_mask(img, alpha_threshold, 'L')
+                            else:
+                                with open_frame(mask_path) as mask_file:
+                                    mask = binary_mask(mask_file, alpha_threshold, 'L')
+                                if rotate_img != '0':
+                                    mask = mask.transpose(
+                                        rotation_dict[rotate_img])
                     except BaseException:
-                        print(
-                            f'Mask of {os.path.basename(path)} is not found, output original image!')
-                        img.save(
+                        mask, status = None, 'not found'
+                if mask is not None and is_crop:
+                    with tracer.stage('crop', filename):
+                        bbox = mask_table.bbox(to_process) if mask.size == img.size else None
+                        # `crop_img` returns new images and leaves its inputs untouched
+                        cropped, cropped_mask, crop_info = CropUtils.crop_img(
+                            img, mask, alpha_threshold, bbox)
+                        if cropped_mask is None:
+                            mask, status = None, 'blank'
+                        else:
+                            if use_cn:
+                                cropped_cns = [
+                                    CropUtils.crop_img(
+                                        cn_image, mask, alpha_threshold, bbox if cn_image.size == mask.size else None)[0]
+                                    for cn_image in cn_images]
+                            mask = cropped_mask
+                            # Only `restore_by_file` modifies the full frame, in place
+                            raw = img
+                if mask is None:
+                    print(
+                        f'Mask of {filename} is {status}, output original image!')
+                    with tracer.stage('save', filename):
+                        save_image(
+                            img,
                             os.path.join(
                                 output_dir,
-                                os.path.basename(path)))
-                        continue
-                    if rotate_img != '0':
-                        mask = mask.transpose(
-                            rotation_dict[rotate_img])
-                    if is_crop:
-                        original_mask = mask.copy()
-                        cropped, mask, crop_info = CropUtils.crop_img(
-                            img.copy(), mask, alpha_threshold)
-                        if use_cn:
-                            cropped_cns = [i[0] for i in [CropUtils.crop_img(cn_image.copy(), original_mask, alpha_threshold) for cn_image in cn_images]]
-                        if not mask:
-                            print(
-                                f'Mask of {os.path.basename(path)} is blank, output original image!')
-                            img.save(
-                                os.path.join(
-                                    output_dir,
-                                    os.path.basename(path)))
-                            continue
-                        batched_raw.append(img.copy())
-                img = cropped if cropped is not None else img
-                if use_cn:
-                    cn_images = cropped_cns if cropped_cns is not None else cn_images
-                batch_images.append((img, path))
-
-            except BaseException:
-                print(f'Error processing {path}:', file=sys.stderr)
-                print(traceback.format_exc(), file=sys.stderr)
-
-            if len(batch_images) == 0:
-                print('No images will be processed.')
-                break
-
+                                output_filename(filename, encoder)),
+                            encoder=encoder)
+                    record(path)
+                    return None
+            img = cropped if cropped is not None else img
+            if use_cn:
+                cn_images = cropped_cns if cropped_cns is not None else cn_images
+            if tag_ahead:
+                # Fills the tag cache while earlier frames are generated, the
+                # main thread then finds the tags cached
+                with tracer.stage('tag', filename):
+                    tagger(img)
+            return Frame(path, img, raw, mask, crop_info, cn_images)
+
+        def frame_prompt(item):
+            nonlocal prev_prompt
+            item.prompt = original_prompt
             if process_deepbooru:
-                deepbooru_prompt = deepbooru.model.tag_multi(
-                    batch_images[0][0])
+                with tracer.stage('tag', os.path.basename(item.path)):
+                    deepbooru_prompt = tagger(item.img)
                 if deepbooru_prev:
                     deepbooru_prompt = deepbooru_prompt.split(', ')
                     common_prompt = list(
                         set(prev_prompt) & set(deepbooru_prompt))
-                    p.prompt = init_prompt + ', '.join(common_prompt) + ', '.join(
+                    item.prompt = init_prompt + ', '.join(common_prompt) + ', '.join(
                         [i for i in deepbooru_prompt if i not in common_prompt])
-                    prev_prompt = deepbooru_prompt
+                    prev_prompt = item.tags = deepbooru_prompt
                 else:
-                    if len(init_prompt) > 0:
-                        init_prompt += ', '
-                    p.prompt = init_prompt + deepbooru_prompt
+                    item.prompt = init_prompt + deepbooru_prompt
 
             if use_csv or use_txt:
-                p.prompt = init_prompt + prompt_list[frame]
-
-            state.job = f'{idx} out of {img_len}: {batch_images[0][1]}'
-            p.init_images = [x[0] for x in batch_images]
-
-            if mask is not None and (use_mask or use_img_mask):
-                p.image_mask = mask
-
-            if cn_images is not None and use_cn:
-                p.control_net_input_image = cn_images
-
-            def process_images_with_size(p, size, strength):
-                p.width, p.height, = size
-                p.strength = strength
-                return process_images(p)
-
-            if is_rerun:
-                proc = process_images_with_size(
-                    p, (rerun_width, rerun_height), rerun_strength)
-                p_2 = p
-                p_2.init_images = proc.images
-                proc = process_images_with_size(
-                    p_2, original_size, original_strength)
+                item.prompt = init_prompt + prompt_list[prompt_frames[item.path]]
+
+        def frame_key(item):
+            # `process_images` takes one mask and one set of ControlNet inputs
+            # per call, and pads the prompts of a batch to the same number of
+            # token chunks, so only frames that agree on these can share a batch.
+            return (
+                item.bucket,
+                image_digest(item.mask),
+                tuple(image_digest(i) for i in item.cn_images) if item.cn_images is not None else None,
+                model_hijack.get_prompt_lengths(item.prompt)[1])
+
+        failed = False
+        # Keys of the outputs generated by this run
+        rendered_keys = set()
+
+        def prepared_frames(paths):
+            nonlocal prev_prompt, failed
+            queue = prefetch(prepare_frame, paths, prefetch_depth, budget)
+            try:
+                for idx, (path, future) in enumerate(queue):
+                    if state.interrupted:
+                        break
+                    if path in done:
+                        budget.release(path)
+                        print(f'Skipping: {path}, already rendered')
+                        if deepbooru_prev and done[path].get('tags') is not None:
+                            prev_prompt = done[path]['tags']
+                        continue
+                    print(f'Processing: {path}')
+                    try:
+                        # Time the main thread waits for the prefetch threads
+                        with tracer.stage('wait', os.path.basename(path)):
+                            item = future.result()
+                    except BaseException:
+                        print(f'Error processing {path}:', file=sys.stderr)
+                        print(traceback.format_exc(), file=sys.stderr)
+                        print('No images will be processed.')
+                        failed = True
+                        break
+                    if item is None:
+                        budget.release(path)
+                        continue
+                    state.job = f'{idx} out of {img_len}: {path}'
+                    frame_prompt(item)
+                    item.fingerprint = fingerprints.get(path)
+                    item.bucket = frame_buckets.get(path)
+                    if batch_size > 1:
+                        item.key = frame_key(item)
+                    yield item
+            finally:
+                queue.close()
+
+        def process_images_with_size(p, size, strength):
+            p.width, p.height, = size
+            p.denoising_strength = strength
+            return process_images(p)
+
+        def written(item):
+            # Called by the writer once the output of `item` is on disk, the
+            # frame counts against the memory budget until then
+            if manifest is not None:
+                manifest.record(output_filename(os.path.basename(item.path), encoder), item.fingerprint, tags=item.tags)
+            budget.release(item.path)
+
+        def setup_batch(batch, seeds=None):
+            # Points `p` at the frames of `batch` and returns the generation
+            # size and the seeds, which a later pass of the batch reuses
+            p.batch_size = len(batch)
+            p.init_images = [item.img for item in batch]
+            size = (batch[0].bucket, batch[0].bucket) if batch[0].bucket is not None else original_size
+            p.width, p.height = size
+            if len(batch) > 1:
+                p.prompt = [item.prompt for item in batch]
+                p.seed, p.subseed = seeds or (
+                    [get_fixed_seed(original_seed) for _ in batch],
+                    [get_fixed_seed(original_subseed) for _ in batch])
             else:
-                proc = process_images(p)
-
-            if initial_info is None:
-                initial_info = proc.info
-            for output, (input_img, path) in zip(proc.images, batch_images):
-                filename = os.path.basename(path)
-                if use_img_mask:
-                    if as_output_alpha:
-                        output.putalpha(
-                            p.image_mask.resize(
-                                output.size).convert('L'))
-
-                if rotate_img != '0':
-                    output = output.transpose(
-                        rotation_dict[str(-int(rotate_img))])
-
-                if is_crop:
-                    output = CropUtils.restore_by_file(
-                        batched_raw[0],
-                        output,
-                        batch_images[0][0],
-                        mask,
-                        crop_info,
-                        p.mask_blur + 1)
-
-                comments = {}
-                if len(model_hijack.comments) > 0:
-                    for comment in model_hijack.comments:
-                        comments[comment] = 1
-
-                info = create_infotext(
-                    p,
-                    p.all_prompts,
-                    p.all_seeds,
-                    p.all_subseeds,
-                    comments,
-                    0,
-                    0)
-                pnginfo = {}
-                if info is not None:
-                    pnginfo['parameters'] = info
-
-                params = ImageSaveParams(output, p, filename, pnginfo)
-                before_image_saved_callback(params)
-                fullfn_without_extension, extension = os.path.splitext(
-                    filename)
-
-                if is_rerun:
-                    params.pnginfo['loopback_params'] = f'Firstpass size: {rerun_width}x{rerun_height}, Firstpass strength: {original_strength}'
-
-                info = params.pnginfo.get('parameters', None)
-
-                def exif_bytes():
-                    return piexif.dump({
-                        'Exif': {
-                            piexif.ExifIFD.UserComment: piexif.helper.UserComment.dump(info or '', encoding='unicode')
-                        },
-                    })
-
-                if extension.lower() == '.png':
-                    pnginfo_data = PngImagePlugin.PngInfo()
-                    for k, v in params.pnginfo.items():
-                        pnginfo_data.add_text(k, str(v))
-
-                    output.save(
-                        os.path.join(
-                            output_dir,
-                            filename),
-                        pnginfo=pnginfo_data)
-
-                elif extension.lower() in ('.jpg', '.jpeg', '.webp'):
-                    output.save(os.path.join(output_dir, filename))
-
-                    if opts.enable_pnginfo and info is not None:
-                        piexif.insert(
-                            exif_bytes(), os.path.join(
-                                output_dir, filename))
+                p.prompt = batch[0].prompt
+                p.seed, p.subseed = original_seed, original_subseed
+
+            if batch[0].mask is not None and (use_mask or use_img_mask):
+                p.image_mask = batch[0].mask
+
+            if batch[0].cn_images is not None and use_cn:
+                p.control_net_input_image = batch[0].cn_images
+            return size, (p.seed, p.subseed)
+
+        def frame_digest(item):
+            # The pixels of the image, mask and ControlNet inputs of a frame,
+            # hashed once for the cache keys
+            if item.digest is None:
+                item.digest = (
+                    image_digest(item.img),
+                    image_digest(item.mask) if use_mask or use_img_mask else None,
+                    [image_digest(i) for i in item.cn_images] if use_cn and item.cn_images is not None else None)
+            return item.digest
+
+        def first_pass_key(item, seed, subseed):
+            if not cached_seeds:
+                return None
+            return fingerprint(
+                first_pass_params,
+                item.prompt,
+                seed,
+                subseed if p.subseed_strength else None,
+                *frame_digest(item))
+
+        def result_key(item, size, seed, subseed):
+            if results is None or not fixed_seeds:
+                return None
+            return fingerprint(
+                result_params,
+                item.prompt,
+                size,
+                seed,
+                subseed if p.subseed_strength else None,
+                *frame_digest(item))
+
+        def per_frame(seeds, count):
+            # The seeds and subseeds of each frame of a batch
+            return [s if isinstance(s, list) else [s] * count for s in seeds]
+
+        def cached_results(batch, size, seeds):
+            # Looks the frames of `batch` up in the generation cache. Returns
+            # their keys, the cached `(output, info)` of each frame or None,
+            # and the frames to generate, the first of each key
+            keys = [result_key(item, size, seed, subseed) for item, seed, subseed in zip(batch, *per_frame(seeds, len(batch)))]
+            hits, missing, seen = [None] * len(batch), [], set()
+            for position, key in enumerate(keys):
+                if key is not None and key in seen:
+                    # Copied from an earlier frame of the batch
+                    continue
+                hit = results.get(key) if key is not None else None
+                if hit is not None:
+                    hits[position] = hit
                 else:
-                    output.save(os.path.join(output_dir, filename))
-
-            frame += 1
-
-        if process_deepbooru:
-            deepbooru.model.stop()
+                    missing.append(position)
+                    seen.add(key)
+            return keys, hits, missing
+
+        def first_pass(batch, seeds):
+            # The first pass of every frame of `batch`, only the frames that
+            # are not in the cache are generated
+            all_seeds, all_subseeds = per_frame(seeds, len(batch))
+            keys = [first_pass_key(item, seed, subseed)
+                    for item, seed, subseed in zip(batch, all_seeds, all_subseeds)]
+            outputs = [None] * len(batch)
+            if first_passes is not None:
+                for position, key in enumerate(keys):
+                    hit = first_passes.get(key)
+                    if hit is not None:
+                        outputs[position] = hit[0]
+            missing = [position for position, output in enumerate(outputs) if output is None]
+            if not missing:
+                state.job_count -= 1
+                return outputs
+            if len(missing) < len(batch):
+                setup_batch(
+                    [batch[i] for i in missing],
+                    ([all_seeds[i] for i in missing], [all_subseeds[i] for i in missing]))
+            with tracer.stage('first pass', ', '.join(os.path.basename(batch[i].path) for i in missing)):
+                proc = process_images_with_size(p, (rerun_width, rerun_height), rerun_strength)
+            for position, output in zip(missing, proc.images):
+                outputs[position] = output
+                if first_passes is not None:
+                    first_passes.put(keys[position], output)
+            return outputs
+
+        def stopped(holds_lease):
+            if state.interrupted:
+                return True
+            if holds_lease is not None and not holds_lease():
+                print('Another worker took over this chunk, moving on')
+                return True
+            return False
+
+        def select(batch, seeds, positions):
+            # The frames of `batch` at `positions` and their seeds
+            if len(positions) == len(batch):
+                return batch, seeds
+            return [batch[i] for i in positions], tuple([s[i] for i in positions] for s in per_frame(seeds, len(batch)))
+
+        def render(paths, writer, holds_lease=None):
+            # Returns whether every image of `paths` was handled
+            nonlocal initial_info
+            frames = prepared_frames(paths)
+            batches = iter_batches(frames, batch_size, key=lambda item: item.key)
+            try:
+                # In pass-major mode, the first passes of a group of batches
+                # all run before their second passes
+                for group in iter_batches(batches, batches_per_pass if pass_major else 1):
+                    lookups = []
+                    for batch in group:
+                        if stopped(holds_lease):
+                            return False
+                        size, seeds = setup_batch(batch)
+                        # Cached frames skip both passes
+                        keys, hits, missing = cached_results(batch, size, seeds)
+                        first_outputs = None
+                        if pass_major:
+                            if missing:
+                                pending, pending_seeds = select(batch, seeds, missing)
+                                setup_batch(pending, pending_seeds)
+                                first_outputs = first_pass(pending, pending_seeds)
+                            else:
+                                state.job_count -= 1
+                        lookups.append((size, seeds, keys, hits, missing, first_outputs))
+
+                    for batch, (size, seeds, keys, hits, missing, first_outputs) in zip(group, lookups):
+                        if stopped(holds_lease):
+                            return False
+
+                        if pass_major and missing:
+                            # Frames rendered by an earlier batch of the group
+                            # since the lookup are read from the cache instead
+                            for position in missing:
+                                if keys[position] in rendered_keys:
+                                    hits[position] = results.get(keys[position])
+                            kept = [k for k, position in enumerate(missing) if hits[position] is None]
+                            first_outputs = [first_outputs[k] for k in kept]
+                            missing = [missing[k] for k in kept]
+
+                        proc = None
+                        if missing:
+                            pending, pending_seeds = select(batch, seeds, missing)
+                            setup_batch(pending, pending_seeds)
+                            names = ', '.join(os.path.basename(item.path) for item in pending)
+                            if pass_major:
+                                p.init_images = first_outputs
+                                with tracer.stage('generate', names):
+                                    proc = process_images_with_size(p, size, original_strength)
+                            else:
+                                with tracer.stage('generate', names):
+                                    if is_rerun:
+                                        proc = process_images_with_size(
+                                            p, (rerun_width, rerun_height), rerun_strength)
+                                        p_2 = p
+                                        p_2.init_images = proc.images[:len(pending)]
+                                        proc = process_images_with_size(
+                                            p_2, size, original_strength)
+                                    else:
+                                        proc = process_images(p)
+                        else:
+                            state.job_count -= 2 if is_rerun and not pass_major else 1
+
+                        if initial_info is None and proc is not None:
+                            initial_info = proc.info
+                        generated = {position: index for index, position in enumerate(missing)}
+                        copies = {}
+                        for position, item in enumerate(batch):
+                            filename = os.path.basename(item.path)
+                            key, source = keys[position], None
+                            if position in generated:
+                                index = generated[position]
+                                output = proc.images[index]
+                                comments = {}
+                                if len(model_hijack.comments) > 0:
+                                    for comment in model_hijack.comments:
+                                        comments[comment] = 1
+
+                                info = create_infotext(
+                                    p,
+                                    p.all_prompts,
+                                    p.all_seeds,
+                                    p.all_subseeds,
+                                    comments,
+                                    0,
+                                    index)
+                                if key is not None:
+                                    # Stored as generated, before the alpha channel and the restore
+                                    with tracer.stage('cache', filename):
+                                        results.put(key, output, {'parameters': info, 'filename': filename})
+                                    rendered_keys.add(key)
+                                    if keys.count(key) > 1:
+                                        copies[key] = (output.copy(), info, filename)
+                            elif hits[position] is not None:
+                                output, cached = hits[position]
+                                info, source = cached['parameters'], cached['filename']
+                            else:
+                                # Same inputs as an earlier frame of the batch
+                                output, info, source = copies[key]
+                                output = output.copy()
+                            if source is not None:
+                                print(f'{filename}: same generation as {source}, reusing its output')
+                                if initial_info is None:
+                                    initial_info = info
+
+                            if use_img_mask:
+                                if as_output_alpha:
+                                    output.putalpha(
+                                        item.mask.resize(
+                                            output.size))
+
+                            if rotate_img != '0':
+                                with tracer.stage('rotate', filename):
+                                    output = output.transpose(
+                                        rotation_dict[str(-int(rotate_img))])
+
+                            if is_crop:
+                                with tracer.stage('restore', filename):
+                                    output = CropUtils.restore_by_file(
+                                        item.raw,
+                                        output,
+                                        item.img,
+                                        item.mask,
+                                        item.crop_info,
+                                        p.mask_blur + 1)
+
+                            with tracer.stage('infotext', filename):
+                                pnginfo = {}
+                                if info is not None:
+                                    pnginfo['parameters'] = info
+                                if source is not None:
+                                    pnginfo['generated_for'] = source
+
+                                params = ImageSaveParams(output, p, filename, pnginfo)
+                                before_image_saved_callback(params)
+
+                            if is_rerun:
+                                params.pnginfo['loopback_params'] = f'Firstpass size: {rerun_width}x{rerun_height}, Firstpass strength: {rerun_strength}'
+
+                            writer.save(
+                                output,
+                                os.path.join(
+                                    output_dir,
+                                    output_filename(filename, encoder)),
+                                params.pnginfo,
+                                functools.partial(written, item))
+                            budget.retire(item.path)
+            finally:
+                frames.close()
+                budget.clear()
+            return not failed and not state.interrupted
+
+        writer = ImageWriter(int(encoder_threads), save_exif=opts.enable_pnginfo, tracer=tracer, encoder=encoder)
+        try:
+            if shard:
+                # Workers sharing the output directory claim chunks of
+                # frames through lease files, see `LeaseManager`
+                chunks = [images[i:i + int(chunk_size)] for i in range(0, len(images), int(chunk_size))]
+                # A run with other inputs or settings is another job
+                job = fingerprint(
+                    [(os.path.basename(path), fingerprints[path]) for path in images], encoder, int(chunk_size))
+                leases = LeaseManager(os.path.join(output_dir, LEASE_DIR_NAME, job[:16]))
+                if resume:
+                    # Chunks finished by an earlier run whose outputs were
+                    # deleted or changed since are rendered again. The markers
+                    # are read first, the outputs of a chunk are recorded
+                    # before it is marked done.
+                    finished = [i for i in range(len(chunks)) if leases.is_done(i)]
+                    current = RunManifest(output_dir)
+                    for i in finished:
+                        if any(current.get(output_filename(os.path.basename(path), encoder), fingerprints[path]) is None
+                               for path in chunks[i]):
+                            leases.reopen(i)
+                print(f'Distributed: {len(chunks)} chunk(s) of {int(chunk_size)} image(s), worker {leases.worker}')
+                try:
+                    for i in leases.claims(range(len(chunks)), interrupted=lambda: state.interrupted or failed):
+                        print(f'Distributed: rendering chunk {i + 1} of {len(chunks)}')
+                        paths = chunks[i]
+                        if frame_buckets and not (process_deepbooru and deepbooru_prev):
+                            paths = sorted(paths, key=lambda path: frame_buckets.get(path, 0))
+                        if render(paths, writer, functools.partial(leases.holds, i)):
+                            # The chunk is only done once its outputs are on disk
+                            writer.flush()
+                            leases.mark_done(i)
+                        else:
+                            leases.release(i)
+                finally:
+                    leases.close()
+            else:
+                render(images, writer)
+        finally:
+            writer.close()
+            close_videos()
+            if tagger is not None:
+                tagger.close()
+                tag_cache.close()
+                print(f'Tag cache: {tag_cache.summary()}')
+            if first_passes is not None:
+                first_passes.close()
+                print(f'First pass cache: {first_passes.summary()}')
+            if results is not None:
+                results.close()
+                print(f'Generation cache: {results.summary()}')
+            if trace:
+                tracer.close()
+                print(f'Timing trace written to {tracer.path}')
+                print(tracer.summary())
+
+        p.batch_size = original_batch_size
+        p.width, p.height = original_size
+        p.seed, p.subseed = original_seed, original_subseed
+        if is_rerun:
+            p.denoising_strength = original_strength
 
         return Processed(p, [], p.seed, initial_info)
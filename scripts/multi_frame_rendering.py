@@ -2,13 +2,24 @@
 # Modified OedoSoldier [大江户战士] (https://space.bilibili.com/55123)
 
 import numpy as np
-from tqdm import trange
-from PIL import Image, ImageSequence, ImageDraw, ImageFilter, PngImagePlugin
+from PIL import Image, ImageSequence, ImageDraw, ImageFilter
 
 import modules.scripts as scripts
 import gradio as gr
 
+from scripts.ei_cache import ImageCache
+from scripts.ei_composite import ColumnColorStatistics, CompositeBuilder
+from scripts.ei_flow import FlowWarper, plan_keyframes
+from scripts.ei_frames import FrameIndex, key_order
+from scripts.ei_leases import LEASE_DIR_NAME, LeaseManager
+from scripts.ei_motion import frame_difference, frame_signature, histogram_distances, scene_cuts, sequence_thumbnails
+from scripts.ei_resume import RunManifest, file_fingerprint, fingerprint, generation_params
+from scripts.ei_store import use_stores
+from scripts.ei_tags import CachedTagger, TagCache, tagger_options
+from scripts.ei_trace import TRACE_NAME, Tracer
 from scripts.ei_utils import *
+from scripts.ei_video import close_videos, frame_source, open_frame, sidecar_dir
+from scripts.ei_writer import ENCODERS, ImageWriter, output_filename, read_pnginfo
 
 from modules import processing, shared, sd_samplers, images
 from modules.processing import Processed
@@ -19,17 +30,11 @@ from modules.script_callbacks import ImageSaveParams, before_image_saved_callbac
 from modules.shared import opts, cmd_opts, state
 from modules.sd_hijack import model_hijack
 
-import pandas as pd
-
-import piexif
-import piexif.helper
-
+import bisect
+import functools
 import os
 import re
 
-re_findidx = re.compile(
-    r'(?=\S)(\d+)\.(?:[P|p][N|n][G|g]?|[J|j][P|p][G|g]?|[J|j][P|p][E|e][G|g]?|[W|w][E|e][B|b][P|p]?)\b')
-re_findname = re.compile(r'[\w-]+?(?=\.)')
 
 class Script(scripts.Script):
     def title(self):
@@ -77,12 +82,80 @@ class Script(scripts.Script):
                 "First"],
             value="Current")
 
+        with gr.Row():
+            skip_static = gr.Checkbox(
+                label='Reuse the previous output for static frames')
+            static_threshold = gr.Slider(
+                minimum=0,
+                maximum=10,
+                step=0.1,
+                label='Static frame threshold (mean difference from the last rendered frame, %)',
+                value=1.0)
+
+        with gr.Row():
+            split_scenes = gr.Checkbox(
+                label='Split at scene cuts: every scene starts over like the first frame')
+            scene_threshold = gr.Slider(
+                minimum=0,
+                maximum=100,
+                step=1,
+                label='Scene cut threshold (color histogram difference from the previous frame, %)',
+                value=40)
+
+        with gr.Row():
+            keyframes = gr.Dropdown(
+                label='Diffused frames (the others are warped from the keyframes around them)',
+                choices=[
+                    'Every frame',
+                    'Every Nth frame',
+                    'Adaptive'],
+                value='Every frame')
+            keyframe_interval = gr.Slider(
+                minimum=2,
+                maximum=32,
+                step=1,
+                label='Keyframe interval (the largest one in adaptive mode)',
+                value=4)
+            warp_threshold = gr.Slider(
+                minimum=0,
+                maximum=20,
+                step=0.1,
+                label='Warp error threshold (mean difference of the warped reference frames, %)',
+                value=3.0)
+
         with gr.Row():
             given_file = gr.Checkbox(
                 label='Process given file(s) under the input folder, seperate by comma')
             specified_filename = gr.Textbox(
                 label='Files to process', lines=1, visible=False)
 
+        with gr.Row():
+            encoder = gr.Dropdown(
+                label='Output encoder',
+                choices=list(ENCODERS),
+                value='Same as input')
+            encoder_threads = gr.Slider(
+                minimum=1,
+                maximum=16,
+                step=1,
+                label='Encoding threads',
+                value=2)
+
+        frame_store = gr.Checkbox(
+            label='Frame store: keep the decoded input and ControlNet frames in memory-mapped files for later runs')
+
+        resume = gr.Checkbox(
+            label='Resume: skip the frames already rendered to the output directory with the same settings')
+
+        shard = gr.Checkbox(
+            label='Distributed: share the scenes with the other workers rendering to the same output directory')
+
+        with gr.Row():
+            trace = gr.Checkbox(
+                label='Write a timing trace of every stage to the output directory')
+            trace_memory = gr.Checkbox(
+                label='Include memory usage (slower)')
+
         use_cn = gr.Checkbox(label='Use another image as ControlNet input')
         with gr.Row(visible=False) as cn_options:
             max_models = opts.data.get("control_net_max_models_num", 1)
@@ -142,6 +215,13 @@ class Script(scripts.Script):
             color_correction_enabled,
             unfreeze_seed,
             loopback_source,
+            skip_static,
+            static_threshold,
+            split_scenes,
+            scene_threshold,
+            keyframes,
+            keyframe_interval,
+            warp_threshold,
             use_csv,
             table_content,
             given_file,
@@ -149,6 +229,13 @@ class Script(scripts.Script):
             use_txt,
             txt_path,
             use_cn,
+            encoder,
+            encoder_threads,
+            frame_store,
+            resume,
+            shard,
+            trace,
+            trace_memory,
             *cn_dirs,]
 
     def run(
@@ -162,6 +249,13 @@ class Script(scripts.Script):
             color_correction_enabled,
             unfreeze_seed,
             loopback_source,
+            skip_static,
+            static_threshold,
+            split_scenes,
+            scene_threshold,
+            keyframes,
+            keyframe_interval,
+            warp_threshold,
             use_csv,
             table_content,
             given_file,
@@ -169,94 +263,183 @@ class Script(scripts.Script):
             use_txt,
             txt_path,
             use_cn,
+            encoder,
+            encoder_threads,
+            frame_store,
+            resume,
+            shard,
+            trace,
+            trace_memory,
             *cn_dirs,):
         freeze_seed = not unfreeze_seed
 
+        sparse = keyframes != 'Every frame'
+        if sparse and skip_static:
+            print('Keyframes: static frames are synthesized like the other frames, they are not reused')
+            skip_static = False
+
+        if resume or shard:
+            run_params = generation_params(
+                p, self, append_interrogation, first_denoise, third_frame_image,
+                color_correction_enabled, unfreeze_seed, loopback_source, use_cn,
+                static_threshold if skip_static else None,
+                (keyframes, keyframe_interval, warp_threshold) if sparse else None)
+
         if use_csv:
             prompt_list = [i[0] for i in table_content.values.tolist()]
             prompt_list.insert(0, prompt_list.pop())
 
         history_imgs = None
+        # A directory of frames or a video file
+        input_index = frame_source(input_dir)
+        input_index.report('Input directory')
         if given_file:
-            if specified_filename == '':
-                images = [os.path.join(
-                    input_dir,
-                    f) for f in os.listdir(input_dir) if re.match(
-                    r'.+\.(jpg|png)$',
-                    f)]
-            else:
-                images = []
-                images_in_folder = [os.path.join(
-                    input_dir,
-                    f) for f in os.listdir(input_dir) if re.match(
-                    r'.+\.(jpg|png)$',
-                    f)]
-                try:
-                    images_idx = [int(re.findall(re_findidx, j)[0])
-                                  for j in images_in_folder]
-                except BaseException:
-                    images_idx = [re.findall(re_findname, j)[0]
-                                  for j in images_in_folder]
-                images_in_folder_dict = dict(zip(images_idx, images_in_folder))
-                sep = ',' if ',' in specified_filename else ' '
-                for i in specified_filename.split(sep):
-                    if i in images_in_folder:
-                        images.append(i)
-                        start = end = i
-                    else:
-                        try:
-                            match = re.search(r'(^\d*)-(\d*$)', i)
-                            if match:
-                                start, end = match.groups()
-                                if start == '':
-                                    start = images_idx[0]
-                                if end == '':
-                                    end = images_idx[-1]
-                                images += [images_in_folder_dict[j]
-                                           for j in list(range(int(start), int(end) + 1))]
-                        except BaseException:
-                            images.append(images_in_folder_dict[int(i)])
-                if len(images) == 0:
-                    raise FileNotFoundError
-            reference_imgs = [images_in_folder_dict[images_idx[0]], images_in_folder_dict[max(0, int(start) - 1)]] + images
-            history_imgs = [images_in_folder_dict[images_idx[0]], images_in_folder_dict[max(images_idx[0], int(start) - 2)], images_in_folder_dict[max(0, int(start) - 1)]]
-            history_imgs = [images_in_folder_dict[images_idx[0]]] + [os.path.join(output_dir, os.path.basename(f)) for f in history_imgs]
+            images = input_index.select(specified_filename)
+            if len(images) == 0:
+                raise FileNotFoundError
+            first_key, start = input_index.keys[0], input_index.key_of(images[0])
+            reference_imgs = [input_index[first_key], input_index[max(0, int(start) - 1)]] + images
+            history_imgs = [input_index[first_key], input_index[max(first_key, int(start) - 2)], input_index[max(0, int(start) - 1)]]
+            history_imgs = [input_index[first_key]] + [
+                os.path.join(output_dir, output_filename(os.path.basename(f), encoder)) for f in history_imgs]
+            reference_imgs = sorted(reference_imgs, key=lambda x: key_order(input_index.key_of(x)))
         else:
-            reference_imgs = [
-                os.path.join(
-                    input_dir,
-                    f) for f in os.listdir(input_dir) if re.match(
-                    r'.+\.(jpg|png)$',
-                    f)]
-        reference_imgs = sort_images(reference_imgs)
+            reference_imgs = list(input_index)
+        reference_keys = [input_index.key_of(path) for path in reference_imgs]
+
+        def output_name(j):
+            return output_filename(os.path.basename(reference_imgs[j]), encoder)
+
+        def output_path(j):
+            return os.path.join(output_dir, output_name(j))
         print(f'Will process following files: {", ".join(reference_imgs)}')
 
         if use_txt:
-            if txt_path == "":
-                files = [re.sub(r'\.(jpg|png)$', '.txt', path)
-                         for path in reference_imgs]
-            else:
-                files = [
+            txt_index = FrameIndex(txt_path if txt_path != "" else sidecar_dir(input_dir), extensions=('.txt',))
+            files = [
+                txt_index.get(
+                    key,
                     os.path.join(
-                        txt_path,
+                        txt_index.directory,
                         os.path.basename(
                             re.sub(
                                 r'\.(jpg|png)$',
                                 '.txt',
-                                path))) for path in reference_imgs]
+                                path)))) for key, path in zip(reference_keys, reference_imgs)]
             prompt_list = [open(file, 'r').read().rstrip('\n')
                            for file in files]
 
+        cn_indexes = []
         if use_cn:
             cn_dirs = [input_dir if cn_dir=="" else cn_dir for cn_dir in cn_dirs]
-            cn_images = [[os.path.join(
-                            cn_dir,
-                            os.path.basename(path)) for path in reference_imgs] for cn_dir in cn_dirs]
+            cn_images = []
+            for cn_dir in cn_dirs:
+                cn_index = input_index if cn_dir == input_dir else frame_source(cn_dir)
+                cn_index.report(f'ControlNet directory {cn_dir}', reference_keys)
+                cn_indexes.append(cn_index)
+                cn_images.append([cn_index.get(key, os.path.join(cn_dir, os.path.basename(path)))
+                                  for key, path in zip(reference_keys, reference_imgs)])
+
+        if frame_store:
+            # Decoded once into memory-mapped files, which later runs read
+            # instead of decoding the frames again
+            use_stores([input_index] + cn_indexes)
+
+        # Per-stage timings, a no-op unless enabled
+        tracer = Tracer(os.path.join(output_dir, TRACE_NAME), enabled=trace, memory=trace_memory)
+
+        initial_width = p.width
+        # Reference and ControlNet frames are used by up to three consecutive
+        # iterations, keep them decoded and resized
+        frame_cache = ImageCache()
+
+        def reference(j):
+            return frame_cache.get(reference_imgs[j], (initial_width, p.height))
 
         loops = len(reference_imgs)
+        # In given file mode, the first two frames only provide the history
+        first_frame = 2 if given_file else 0
+
+        # Independent chains of frames, a chain starts over at every scene cut
+        cuts = []
+        if split_scenes:
+            with tracer.stage('scenes', input_dir):
+                distances = histogram_distances(sequence_thumbnails(reference_imgs))
+            cuts = scene_cuts(distances, scene_threshold / 100, start=first_frame)
+        segments = list(zip([0] + cuts, cuts + [loops]))
+        if split_scenes:
+            print(f'Scenes: {len(segments)} scene(s), starting at ' + ', '.join(
+                os.path.basename(reference_imgs[start]) for start, _ in segments))
+
+        # The frames of every scene that are diffused, the others are warped
+        # from the keyframes around them once both are rendered
+        keyframes_of, key_set = {}, set()
+        if sparse:
+            warper = FlowWarper()
+            fallbacks = 0
+            with tracer.stage('keyframes', input_dir):
+                for start, end in segments:
+                    # In given file mode, the first scene goes on from the
+                    # output of the frame before the given files
+                    anchor = 1 if given_file and start == 0 else start
+                    keys, n = plan_keyframes(
+                        warper, reference, anchor, end, keyframe_interval, warp_threshold / 100,
+                        adaptive=keyframes == 'Adaptive')
+                    keyframes_of[start] = keys
+                    key_set.update(keys)
+                    fallbacks += n
+            diffused = sum(1 for k in key_set if k >= first_frame)
+            print(f'Keyframes: {diffused} of {loops - first_frame} frame(s) to diffuse, '
+                  f'{fallbacks} of them because their warp error is above the threshold')
+
+        # Every frame depends on the previous output of its scene, so only the
+        # frames before the first one that changed can be skipped. Each
+        # fingerprint chains the previous one to invalidate everything after a
+        # change.
+        manifest, fingerprints, resumed, rendered = None, [None] * loops, {}, 0
+        if resume or shard:
+            chain = [file_fingerprint(f) for f in history_imgs] if given_file else None
+            starts = set(cuts)
+            for i in range(first_frame, loops):
+                if i in starts:
+                    chain = None
+                chain = fingerprints[i] = fingerprint(
+                    chain,
+                    run_params,
+                    file_fingerprint(reference_imgs[i]),
+                    [file_fingerprint(cn_image[i]) for cn_image in cn_images] if use_cn else None,
+                    prompt_list[i] if (use_csv or use_txt) and i < len(prompt_list) else None)
+        if resume:
+            manifest = RunManifest(output_dir)
+            for start, end in segments:
+                # The first frame to render, the last manifest entry before it
+                # and the last frame that was not static
+                resume_from, resume_entry = max(start, first_frame), None
+                resume_rendered = 1 if given_file and start == 0 else None
+                for i in range(resume_from, end):
+                    entry = manifest.get(output_name(i), fingerprints[i])
+                    if entry is None:
+                        break
+                    resume_from, resume_entry = i + 1, entry
+                    if not entry.get('static'):
+                        resume_rendered = i
+                if sparse and resume_from < end:
+                    # The frames since the last keyframe are synthesized
+                    # again once the next keyframe is rendered
+                    key = max((k for k in keyframes_of[start] if first_frame <= k < resume_from), default=None)
+                    resume_from = key + 1 if key is not None else max(start, first_frame)
+                    resume_entry = manifest.get(output_name(key), fingerprints[key]) if key is not None else None
+                resumed[start] = (resume_from, resume_entry, resume_rendered)
+                rendered += resume_from - max(start, first_frame)
+            print(f'Resuming: {rendered} frame(s) already rendered')
+
+        def load_frame(path):
+            return open_frame(path).convert("RGB").resize(
+                (initial_width, p.height), Image.LANCZOS)
 
         processing.fix_seed(p)
         batch_count = p.n_iter
+        initial_p_seed = p.seed
 
         p.batch_size = 1
         p.n_iter = 1
@@ -265,11 +448,20 @@ class Script(scripts.Script):
         initial_seed = None
         initial_info = None
 
-        initial_width = p.width
         initial_img = reference_imgs[0]  # p.init_images[0]
+        composite = CompositeBuilder(initial_width, p.height)
+        color_statistics = ColumnColorStatistics(initial_width, p.height) if color_correction_enabled else None
+
+        tag_cache, tagger = None, None
+        if append_interrogation != "None":
+            # Tags are cached on disk by image content and tagger settings
+            tag_cache = TagCache()
+            if append_interrogation == "CLIP":
+                tagger = CachedTagger('CLIP', shared.interrogator.interrogate, tag_cache, tagger_options(opts.data))
+            elif append_interrogation == "DeepBooru":
+                tagger = CachedTagger('DeepBooru', deepbooru.model.tag, tag_cache, tagger_options(opts.data))
         p.init_images = [
-            Image.open(initial_img).convert("RGB").resize(
-                (initial_width, p.height), Image.ANTIALIAS)]
+            frame_cache.get(initial_img, (initial_width, p.height))]
 
         # grids = []
         # all_images = []
@@ -279,259 +471,357 @@ class Script(scripts.Script):
             original_prompt = original_prompt.rstrip(
                 ', ') + ', ' if not original_prompt.rstrip().endswith(',') else original_prompt.rstrip() + ' '
         original_denoise = p.denoising_strength
-        state.job_count = (loops - 2) * batch_count if given_file else loops * batch_count
+        state.job_count = (loops - first_frame - rendered) * batch_count
+        if sparse:
+            state.job_count -= batch_count * sum(
+                1 for start, end in segments
+                for j in range(resumed[start][0] if start in resumed else max(start, first_frame), end)
+                if j not in key_set)
 
         initial_color_corrections = [
             processing.setup_color_correction(
                 p.init_images[0])]
 
-        # for n in range(batch_count):
-        history = None
-        # frames = []
-        third_image = None
-        third_image_index = 0
-        frame_color_correction = None
-
         # Reset to original init image at the start of each batch
         p.width = initial_width
         p.mask_blur = 0
         p.control_net_resize_mode = "Just Resize"
 
-        for i in range(loops):
-            if state.interrupted:
-                break
-            if given_file and i < 2:
-                p.init_images[0] = Image.open(
-                    history_imgs[-1]).convert("RGB").resize(
-                    (initial_width, p.height), Image.ANTIALIAS)
-                history = p.init_images[0]
-                if third_frame_image != "None":
-                    if third_frame_image == "FirstGen" and i == 0:
-                        third_image = Image.open(
-                            history_imgs[1]).convert("RGB").resize(
-                            (initial_width, p.height), Image.ANTIALIAS)
-                        third_image_index = 0
-                    elif third_frame_image == "OriginalImg" and i == 0:
-                        third_image = Image.open(
-                            history_imgs[0]).convert("RGB").resize(
-                            (initial_width, p.height), Image.ANTIALIAS)
-                        third_image_index = 0
-                    elif third_frame_image == "Historical":
-                        third_image = Image.open(
-                            history_imgs[2]).convert("RGB").resize(
-                            (initial_width, p.height), Image.ANTIALIAS)
-                        third_image_index = (i - 1)
-                continue
-            filename = os.path.basename(reference_imgs[i])
-            print(f'Processing: {reference_imgs[i]}')
-            p.n_iter = 1
-            p.batch_size = 1
-            p.do_not_save_grid = True
-            p.control_net_input_image = Image.open(
-                reference_imgs[i]).convert("RGB").resize(
-                (initial_width, p.height), Image.ANTIALIAS)
-
-            if(i > 0):
-                loopback_image = p.init_images[0]
-                if loopback_source == "Current":
-                    loopback_image = p.control_net_input_image
-                elif loopback_source == "First":
-                    loopback_image = history
-
-                if third_frame_image != "None":
-                    p.width = initial_width * 3
-                    img = Image.new("RGB", (initial_width * 3, p.height))
-                    img.paste(p.init_images[0], (0, 0))
-                    # img.paste(p.init_images[0], (initial_width, 0))
-                    img.paste(loopback_image, (initial_width, 0))
-                    if i == 1:
-                        third_image = p.init_images[0]
-                    img.paste(third_image, (initial_width * 2, 0))
-                    p.init_images = [img]
-                    if color_correction_enabled:
-                        p.color_corrections = [
-                            processing.setup_color_correction(img)]
-
-                    if use_cn:
-                        msk = []
-                        for cn_image in cn_images:
-                            m = Image.new("RGB", (initial_width * 3, p.height))
-                            m.paste(Image.open(cn_image[i - 1]).convert("RGB").resize(
-                                (initial_width, p.height), Image.ANTIALIAS), (0, 0))
-                            m.paste(Image.open(cn_image[i]).convert("RGB").resize(
-                                (initial_width, p.height), Image.ANTIALIAS), (initial_width, 0))
-                            m.paste(Image.open(cn_image[third_image_index]).convert("RGB").resize(
-                                (initial_width, p.height), Image.ANTIALIAS), (initial_width * 2, 0))
-                            msk.append(m)
+        static_frames, diffused_frames, inbetween_errors = [], [], []
+
+        def render_segment(start, end, holds_lease=None):
+            # Renders the frames `start` to `end` (excluded), a chain that
+            # starts over like the first frame. Returns whether every frame
+            # was handled.
+            nonlocal initial_seed, initial_info
+            resume_from, resume_entry, resume_rendered = resumed.get(
+                start, (start, None, 1 if given_file and start == 0 else None))
+
+            history = None
+            third_image = None
+            third_image_index = start
+            p.width = initial_width
+            p.init_images = [frame_cache.get(reference_imgs[start], (initial_width, p.height))]
+            # The seed the frame would get in a single chain
+            p.seed = initial_p_seed if freeze_seed else initial_p_seed + max(0, start - first_frame)
+
+            keys = keyframes_of.get(start)
+
+            def previous_of(i):
+                # The frame rendered before `i`, the previous keyframe in
+                # keyframe mode
+                if keys is not None:
+                    k = bisect.bisect_left(keys, i) - 1
+                    if k >= 0:
+                        return keys[k]
+                return i - 1
+
+            # Static frames reuse the output of the last rendered frame, and are
+            # compared with the reference frame that output was rendered from
+            last_rendered, last_pnginfo = resume_rendered, None
+            signatures = {}
+
+            def reference_signature(j):
+                signature = signatures.get(j)
+                if signature is None:
+                    signature = signatures[j] = frame_signature(
+                        frame_cache.get(reference_imgs[j], (initial_width, p.height)))
+                return signature
+
+            for i in range(start, end):
+                if state.interrupted:
+                    return False
+                if holds_lease is not None and not holds_lease():
+                    print('Another worker took over this scene, moving on')
+                    return False
+                if given_file and i < 2:
+                    p.init_images[0] = open_frame(
+                        history_imgs[-1]).convert("RGB").resize(
+                        (initial_width, p.height), Image.LANCZOS)
+                    history = p.init_images[0]
+                    if third_frame_image != "None":
+                        if third_frame_image == "FirstGen" and i == 0:
+                            third_image = open_frame(
+                                history_imgs[1]).convert("RGB").resize(
+                                (initial_width, p.height), Image.LANCZOS)
+                            third_image_index = 0
+                        elif third_frame_image == "OriginalImg" and i == 0:
+                            third_image = open_frame(
+                                history_imgs[0]).convert("RGB").resize(
+                                (initial_width, p.height), Image.LANCZOS)
+                            third_image_index = 0
+                        elif third_frame_image == "Historical":
+                            third_image = open_frame(
+                                history_imgs[2]).convert("RGB").resize(
+                                (initial_width, p.height), Image.LANCZOS)
+                            third_image_index = (i - 1)
+                    continue
+                if i < resume_from:
+                    print(f'Skipping: {reference_imgs[i]}, already rendered')
+                    if i == resume_from - 1:
+                        # Restore the state the loop would have after rendering this
+                        # frame, reading back only the outputs it depends on
+                        given_history = given_file and start == 0
+                        first_output = history_imgs[1] if given_history else output_path(start)
+                        p.init_images = [load_frame(output_path(i))]
+                        history = load_frame(history_imgs[-1] if given_history else first_output)
+                        if third_frame_image == "Historical":
+                            third_image = load_frame(output_path(max(start, previous_of(i))))
+                            third_image_index = previous_of(i)
+                        elif third_frame_image == "OriginalImg" and given_history:
+                            third_image = load_frame(history_imgs[0])
+                            third_image_index = 0
+                        elif third_frame_image != "None":
+                            third_image = load_frame(first_output)
+                            third_image_index = start
+                        p.seed = resume_entry['seed'] if freeze_seed else resume_entry['seed'] + 1
+                    continue
+                if sparse and i not in key_set:
+                    # Synthesized after the next keyframe
+                    continue
+                filename = output_name(i)
+                previous = previous_of(i)
+                if skip_static and last_rendered is not None and i > start:
+                    with tracer.stage('static', filename):
+                        difference = frame_difference(reference_signature(i), reference_signature(last_rendered))
+                    if difference * 100 <= static_threshold:
+                        held = output_name(last_rendered)
+                        print(f'Static: {reference_imgs[i]}, {difference * 100:.2f}% from {held}, reusing its output')
+                        if last_pnginfo is None:
+                            # Rendered before this run, the infotext is read back
+                            last_pnginfo = read_pnginfo(output_path(last_rendered))
+                        # The chain goes on as if the previous output had been
+                        # rendered again: same init image, history and seed
+                        seed = p.seed
+                        # A copy, Pillow keeps the options of a save on the image
+                        # and the previous output may still be being written
+                        writer.save(
+                            p.init_images[0].copy(),
+                            os.path.join(
+                                output_dir,
+                                filename),
+                            dict(last_pnginfo, static_frame=held),
+                            functools.partial(manifest.record, filename, fingerprints[i], seed=seed, static=True) if manifest is not None else None)
+                        if third_frame_image != "None" and (i == start + 1 or third_frame_image == "Historical"):
+                            third_image = p.init_images[0]
+                            if third_frame_image == "Historical":
+                                third_image_index = (i - 1)
+                        if not freeze_seed:
+                            p.seed = seed + 1
+                        static_frames.append(filename)
+                        state.job_count -= batch_count
+                        continue
+                print(f'Processing: {reference_imgs[i]}')
+                p.n_iter = 1
+                p.batch_size = 1
+                p.do_not_save_grid = True
+                with tracer.stage('decode', filename):
+                    p.control_net_input_image = frame_cache.get(reference_imgs[i], (initial_width, p.height))
+
+                with tracer.stage('composite', filename):
+                    if i > start:
+                        # The output of the previous rendered frame
+                        previous_output = p.init_images[0]
+                        loopback_image = p.init_images[0]
+                        if loopback_source == "Current":
+                            loopback_image = p.control_net_input_image
+                        elif loopback_source == "First":
+                            loopback_image = history
+
+                        if third_frame_image != "None":
+                            if previous == start:
+                                third_image = p.init_images[0]
+                            columns = 3
+                        else:
+                            columns = 2
+                        p.width = initial_width * columns
+                        column_images = [p.init_images[0], loopback_image, third_image][:columns]
+                        img = composite.build('init', column_images)
+                        p.init_images = [img]
+                        if color_correction_enabled:
+                            # Same as `processing.setup_color_correction(img)`, from the
+                            # histograms of the columns that were already analysed
+                            p.color_corrections = [color_statistics.correction(img, column_images)]
+
+                        frame_indexes = (previous, i, third_image_index)[:columns]
+                        if use_cn:
+                            msk = [
+                                composite.build(f'cn{k}', [frame_cache.get(cn_image[j], (initial_width, p.height)) for j in frame_indexes])
+                                for k, cn_image in enumerate(cn_images)]
+                        else:
+                            msk = composite.build('cn', [frame_cache.get(reference_imgs[j], (initial_width, p.height)) for j in frame_indexes])
+                        p.control_net_input_image = msk
+
+                        p.image_mask = composite.latent_mask(columns)
+                        p.denoising_strength = original_denoise
                     else:
-                        msk = Image.new("RGB", (initial_width * 3, p.height))
-                        msk.paste(Image.open(reference_imgs[i - 1]).convert("RGB").resize(
-                            (initial_width, p.height), Image.ANTIALIAS), (0, 0))
-                        msk.paste(p.control_net_input_image, (initial_width, 0))
-                        msk.paste(Image.open(reference_imgs[third_image_index]).convert("RGB").resize(
-                            (initial_width, p.height), Image.ANTIALIAS), (initial_width * 2, 0))
-                    p.control_net_input_image = msk
-
-                    latent_mask = Image.new(
-                        "RGB", (initial_width * 3, p.height), "black")
-                    latent_draw = ImageDraw.Draw(latent_mask)
-                    latent_draw.rectangle(
-                        (initial_width, 0, initial_width * 2, p.height), fill="white")
-                    p.image_mask = latent_mask
-                    p.denoising_strength = original_denoise
-                else:
-                    p.width = initial_width * 2
-                    img = Image.new("RGB", (initial_width * 2, p.height))
-                    img.paste(p.init_images[0], (0, 0))
-                    # img.paste(p.init_images[0], (initial_width, 0))
-                    img.paste(loopback_image, (initial_width, 0))
-                    p.init_images = [img]
-                    if color_correction_enabled:
-                        p.color_corrections = [
-                            processing.setup_color_correction(img)]
-
-                    if use_cn:
-                        msk = []
-                        for cn_image in cn_images:
-                            m = Image.new("RGB", (initial_width * 2, p.height))
-                            m.paste(Image.open(cn_image[i - 1]).convert("RGB").resize(
-                                (initial_width, p.height), Image.ANTIALIAS), (0, 0))
-                            m.paste(Image.open(cn_image[i]).convert("RGB").resize(
-                                (initial_width, p.height), Image.ANTIALIAS), (initial_width, 0))
-                    else:
-                        msk = Image.new("RGB", (initial_width * 2, p.height))
-                        msk.paste(Image.open(reference_imgs[i - 1]).convert("RGB").resize(
-                            (initial_width, p.height), Image.ANTIALIAS), (0, 0))
-                        msk.paste(p.control_net_input_image, (initial_width, 0))
-                    p.control_net_input_image = msk
-                    # frames.append(msk)
-
-                    # latent_mask = Image.new("RGB", (initial_width*2, p.height), "white")
-                    # latent_draw = ImageDraw.Draw(latent_mask)
-                    # latent_draw.rectangle((0,0,initial_width,p.height), fill="black")
-                    latent_mask = Image.new(
-                        "RGB", (initial_width * 2, p.height), "black")
-                    latent_draw = ImageDraw.Draw(latent_mask)
-                    latent_draw.rectangle(
-                        (initial_width, 0, initial_width * 2, p.height), fill="white")
-
-                    # p.latent_mask = latent_mask
-                    p.image_mask = latent_mask
-                    p.denoising_strength = original_denoise
-            else:
-                p.init_images = [p.init_images[0].resize((initial_width, p.height), Image.ANTIALIAS)]
-                latent_mask = Image.new(
-                    "RGB", (initial_width, p.height), "white")
-                # p.latent_mask = latent_mask
-                p.image_mask = latent_mask
-                p.denoising_strength = first_denoise
-                if use_cn:
-                    p.control_net_input_image = [Image.open(cn_image[0]).resize((initial_width, p.height), Image.ANTIALIAS) for cn_image in cn_images]
-                else:
-                    p.control_net_input_image = p.control_net_input_image.resize((initial_width, p.height), Image.ANTIALIAS)
-                # frames.append(p.control_net_input_image)
-
-            # if opts.img2img_color_correction:
-            #     p.color_corrections = initial_color_corrections
-
-            if append_interrogation != "None":
-                p.prompt = original_prompt
-                if append_interrogation == "CLIP":
-                    p.prompt += shared.interrogator.interrogate(
-                        p.init_images[0])
-                elif append_interrogation == "DeepBooru":
-                    p.prompt += deepbooru.model.tag(p.init_images[0])
-
-            if use_csv or use_txt:
-                p.prompt = original_prompt + prompt_list[i]
-
-            # state.job = f"Iteration {i + 1}/{loops}, batch {n + 1}/{batch_count}"
-
-            processed = processing.process_images(p)
-
-            if initial_seed is None:
-                initial_seed = processed.seed
-                initial_info = processed.info
-
-            init_img = processed.images[0]
-            if(i > 0):
-                init_img = init_img.crop(
-                    (initial_width, 0, initial_width * 2, p.height))
-
-            comments = {}
-            if len(model_hijack.comments) > 0:
-                for comment in model_hijack.comments:
-                    comments[comment] = 1
-
-            info = processing.create_infotext(
-                p,
-                p.all_prompts,
-                p.all_seeds,
-                p.all_subseeds,
-                comments,
-                0,
-                0)
-            pnginfo = {}
-            if info is not None:
-                pnginfo['parameters'] = info
-
-            params = ImageSaveParams(init_img, p, filename, pnginfo)
-            before_image_saved_callback(params)
-            fullfn_without_extension, extension = os.path.splitext(
-                filename)
-
-            info = params.pnginfo.get('parameters', None)
-
-            def exif_bytes():
-                return piexif.dump({
-                    'Exif': {
-                        piexif.ExifIFD.UserComment: piexif.helper.UserComment.dump(info or '', encoding='unicode')
-                    },
-                })
-
-            if extension.lower() == '.png':
-                pnginfo_data = PngImagePlugin.PngInfo()
-                for k, v in params.pnginfo.items():
-                    pnginfo_data.add_text(k, str(v))
-
-                init_img.save(
+                        p.init_images = [p.init_images[0].resize((initial_width, p.height), Image.LANCZOS)]
+                        p.image_mask = composite.latent_mask(1)
+                        p.denoising_strength = first_denoise
+                        if use_cn:
+                            p.control_net_input_image = [frame_cache.get(cn_image[start], (initial_width, p.height), mode=None) for cn_image in cn_images]
+                        else:
+                            p.control_net_input_image = p.control_net_input_image.resize((initial_width, p.height), Image.LANCZOS)
+                        # frames.append(p.control_net_input_image)
+
+                # if opts.img2img_color_correction:
+                #     p.color_corrections = initial_color_corrections
+
+                if append_interrogation != "None":
+                    p.prompt = original_prompt
+                    with tracer.stage('tag', filename):
+                        p.prompt += tagger(p.init_images[0])
+
+                if use_csv or use_txt:
+                    p.prompt = original_prompt + prompt_list[i]
+
+                # state.job = f"Iteration {i + 1}/{loops}, batch {n + 1}/{batch_count}"
+
+                with tracer.stage('generate', filename):
+                    processed = processing.process_images(p)
+
+                if initial_seed is None:
+                    initial_seed = processed.seed
+                    initial_info = processed.info
+
+                init_img = processed.images[0]
+                if i > start:
+                    init_img = init_img.crop(
+                        (initial_width, 0, initial_width * 2, p.height))
+
+                with tracer.stage('infotext', filename):
+                    comments = {}
+                    if len(model_hijack.comments) > 0:
+                        for comment in model_hijack.comments:
+                            comments[comment] = 1
+
+                    info = processing.create_infotext(
+                        p,
+                        p.all_prompts,
+                        p.all_seeds,
+                        p.all_subseeds,
+                        comments,
+                        0,
+                        0)
+                    pnginfo = {}
+                    if info is not None:
+                        pnginfo['parameters'] = info
+
+                    params = ImageSaveParams(init_img, p, filename, pnginfo)
+                    before_image_saved_callback(params)
+
+                writer.save(
+                    init_img,
                     os.path.join(
                         output_dir,
                         filename),
-                    pnginfo=pnginfo_data)
+                    params.pnginfo,
+                    functools.partial(manifest.record, filename, fingerprints[i], seed=processed.seed) if manifest is not None else None)
 
-            elif extension.lower() in ('.jpg', '.jpeg', '.webp'):
-                init_img.save(os.path.join(output_dir, filename))
-
-                if opts.enable_pnginfo and info is not None:
-                    piexif.insert(
-                        exif_bytes(), os.path.join(
-                            output_dir, filename))
-            else:
-                init_img.save(os.path.join(output_dir, filename))
-
-            if third_frame_image != "None":
-                if third_frame_image == "FirstGen" and i == 0:
-                    third_image = init_img
-                    third_image_index = 0
-                elif third_frame_image == "OriginalImg" and i == 0:
-                    third_image = initial_img[0]
-                    third_image_index = 0
-                elif third_frame_image == "Historical":
-                    third_image = processed.images[0].crop(
-                        (0, 0, initial_width, p.height))
-                    third_image_index = (i - 1)
-
-            p.init_images = [init_img]
-            if(freeze_seed):
-                p.seed = processed.seed
+                if third_frame_image != "None":
+                    if third_frame_image == "FirstGen" and i == start:
+                        third_image = init_img
+                        third_image_index = start
+                    elif third_frame_image == "OriginalImg" and i == start:
+                        third_image = initial_img[0]
+                        third_image_index = start
+                    elif third_frame_image == "Historical":
+                        third_image = processed.images[0].crop(
+                            (0, 0, initial_width, p.height))
+                        third_image_index = previous
+
+                p.init_images = [init_img]
+                last_rendered, last_pnginfo = i, params.pnginfo
+                if skip_static:
+                    signatures = {i: reference_signature(i)}
+                if(freeze_seed):
+                    p.seed = processed.seed
+                else:
+                    p.seed = processed.seed + 1
+                # p.seed = processed.seed
+                if i == start:
+                    history = init_img
+
+                if sparse:
+                    diffused_frames.append(filename)
+                    # The frames since the previous keyframe, warped from both
+                    for j in range(previous + 1, i):
+                        name = output_name(j)
+                        with tracer.stage('inbetween', name):
+                            img, error = warper.inbetween(
+                                reference(j),
+                                [(reference(previous), previous_output, i - j), (reference(i), init_img, j - previous)])
+                        inbetween_errors.append(error)
+                        writer.save(
+                            img,
+                            output_path(j),
+                            dict(params.pnginfo, inbetween=f'{output_name(previous)}, {filename}'),
+                            functools.partial(manifest.record, name, fingerprints[j], synthesized=True) if manifest is not None else None)
+                # history.append(processed.images[0])
+                # frames.append(processed.images[0])
+            return not state.interrupted
+
+        writer = ImageWriter(int(encoder_threads), save_exif=opts.enable_pnginfo, tracer=tracer, encoder=encoder)
+        try:
+            if shard:
+                # Scenes do not depend on each other, workers sharing the
+                # output directory claim them through lease files
+                # A run with other inputs or settings is another job
+                job = fingerprint(
+                    [os.path.basename(path) for path in reference_imgs], fingerprints, encoder, cuts)
+                leases = LeaseManager(os.path.join(output_dir, LEASE_DIR_NAME, job[:16]))
+                if resume:
+                    # Scenes finished by an earlier run whose outputs were
+                    # deleted or changed since are rendered again. The markers
+                    # are read first, the outputs of a scene are recorded
+                    # before it is marked done.
+                    finished = [k for k in range(len(segments)) if leases.is_done(k)]
+                    current = RunManifest(output_dir)
+                    for k in finished:
+                        start, end = segments[k]
+                        if any(current.get(output_name(i), fingerprints[i]) is None
+                               for i in range(max(start, first_frame), end)):
+                            leases.reopen(k)
+                print(f'Distributed: {len(segments)} scene(s), worker {leases.worker}')
+                try:
+                    for k in leases.claims(range(len(segments)), interrupted=lambda: state.interrupted):
+                        print(f'Distributed: rendering scene {k + 1} of {len(segments)}')
+                        if render_segment(*segments[k], functools.partial(leases.holds, k)):
+                            # The scene is only done once its outputs are on disk
+                            writer.flush()
+                            leases.mark_done(k)
+                        else:
+                            leases.release(k)
+                finally:
+                    leases.close()
             else:
-                p.seed = processed.seed + 1
-            # p.seed = processed.seed
-            if i == 0:
-                history = init_img
-            # history.append(processed.images[0])
-            # frames.append(processed.images[0])
+                for start, end in segments:
+                    if not render_segment(start, end):
+                        break
+        finally:
+            writer.close()
+            close_videos()
+            print(f'Frame cache: {frame_cache.summary()}')
+            if color_statistics is not None:
+                print(f'Color correction: {color_statistics.misses} of '
+                      f'{color_statistics.hits + color_statistics.misses} column(s) analysed')
+            if skip_static:
+                total = loops - first_frame - rendered
+                print(f'Static frames: {len(static_frames)} of {total} frame(s) reused the previous output'
+                      + (f': {", ".join(static_frames)}' if static_frames else ''))
+            if sparse:
+                total = max(1, len(diffused_frames) + len(inbetween_errors))
+                print(f'Keyframes: {len(diffused_frames)} frame(s) diffused ({len(diffused_frames) / total:.0%}), '
+                      f'{len(inbetween_errors)} synthesized ({len(inbetween_errors) / total:.0%})'
+                      + (f', warp error {np.mean(inbetween_errors):.2%} on average, {max(inbetween_errors):.2%} at most'
+                         if inbetween_errors else ''))
+            if tag_cache is not None:
+                tag_cache.close()
+                print(f'Tag cache: {tag_cache.summary()}')
+            if trace:
+                tracer.close()
+                print(f'Timing trace written to {tracer.path}')
+                print(tracer.summary())
 
         # grid = images.image_grid(history, rows=1)
         # if opts.grid_save: